@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Measures how deploying, checking, backing up and destroying synthetic
+# deployments scale with their size, against a fake GCE API, e.g.
+#
+#     python benchmarks/scaling.py --sizes 10,100,1000 --output bench.json
+#
+# See nixops_gcp.benchmark for the deployments and phases.
+
+import argparse
+import datetime
+import importlib.metadata
+import json
+import os
+import platform
+import sys
+
+import nixops.backends
+
+from nixops_gcp.benchmark import deployment_spec, run_benchmark
+
+
+def skip_ssh_check():
+    """
+    Make checking a machine only check its GCE instance, in the process
+    of a phase.
+
+    MachineState._check also probes the machine over SSH. The fake
+    machines can't be reached, so checking would wait for each of them to
+    time out, and the benchmark measures the GCE part of it only. This
+    replaces the method of the class for the whole process, which is why
+    it is done here and not by the plugin.
+    """
+    nixops.backends.MachineState._check = lambda self, res: None
+
+
+def package_version():
+    try:
+        return importlib.metadata.version("nixops_gcp")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Measure deploying, checking, backing up and destroying "
+        "synthetic deployments against a fake GCE API."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=[10, 100, 1000],
+        help="comma-separated numbers of machines to benchmark",
+    )
+    parser.add_argument(
+        "--disks", type=int, default=2, help="disks per machine, including the root"
+    )
+    parser.add_argument("--firewall-rules", type=int, default=20)
+    parser.add_argument("--machines-per-pool", type=int, default=50)
+    parser.add_argument("--buckets", type=int, default=5)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds every request takes"
+    )
+    parser.add_argument(
+        "--operation-duration",
+        type=float,
+        default=0.0,
+        help="seconds operations take to complete",
+    )
+    parser.add_argument(
+        "--output", help="file to write the results to instead of stdout"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the log of the deployments"
+    )
+    args = parser.parse_args(args)
+
+    report = {
+        "version": package_version(),
+        "python": platform.python_version(),
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "latency": args.latency,
+        "operation_duration": args.operation_duration,
+        "environment": {
+            k: v for k, v in sorted(os.environ.items()) if k.startswith("NIXOPS_GCP_")
+        },
+        "runs": [],
+    }
+    for machines in args.sizes:
+        spec = deployment_spec(
+            machines,
+            args.disks,
+            args.firewall_rules,
+            args.machines_per_pool,
+            args.buckets,
+        )
+        report["runs"].append(
+            run_benchmark(
+                spec,
+                args.latency,
+                args.operation_duration,
+                args.verbose,
+                worker_setup=skip_ssh_check,
+            )
+        )
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        json.dump(report, output, indent=2)
+        output.write("\n")
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
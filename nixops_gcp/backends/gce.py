@@ -4,6 +4,9 @@ from typing import (
     Dict,
     Optional,
 )
+import contextlib
+import functools
+import threading
 import time
 
 from nixops import known_hosts
@@ -27,7 +30,12 @@ import nixops_gcp.resources.gce_static_ip
 import nixops_gcp.resources.gce_disk
 import nixops_gcp.resources.gce_image
 import nixops_gcp.resources.gce_network
+from nixops_gcp.inventory import SnapshotIndex
 from nixops_gcp.backends.options import ImageOptions
+from nixops_gcp.batch import instance_inserts
+from nixops_gcp.operations import wait_until
+from nixops_gcp.provisioning import disk_fan_out, limit_chains, run_chains
+from nixops_gcp.retention import backups_to_prune
 
 import libcloud.common.google
 from libcloud.compute.types import NodeState
@@ -81,6 +89,7 @@ class GCEDefinition(MachineDefinition, ResourceDefinition):
         self.network = self.config.gce.network
         self.subnet = self.config.gce.subnet
         self.labels = dict(self.config.gce.labels)
+        self.backup_retention = dict(self.config.gce.backupRetention)
 
         def opt_disk_name(dname: Optional[str]) -> Optional[str]:
             return (
@@ -162,7 +171,11 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
 
     def __init__(self, depl, name, id):
         MachineState.__init__(self, depl, name, id)
-        self._conn = None
+        self._batch_lock = threading.RLock()
+        self._node_lock = threading.Lock()
+        self._node_scope = 0
+        self._node_generation = 0
+        self._cached_node = None
 
     @property
     def resource_id(self):
@@ -180,8 +193,51 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
     def full_name(self):
         return "GCE machine '{0}'".format(self.machine_name)
 
-    def node(self):
-        return self.connect().ex_get_node(self.machine_name, self.region)
+    def node(self, fresh=False):
+        with self._node_lock:
+            if self._node_scope and not fresh and self._cached_node is not None:
+                return self._cached_node
+            generation = self._node_generation
+        # the lock isn't held during the GET, so it can't serialise callers
+        node = self.connect().ex_get_node(self.machine_name, self.region)
+        self._cache_node(node, generation)
+        return node
+
+    def _cache_node(self, node, generation=None):
+        with self._node_lock:
+            # a node fetched before the last change is stale
+            if self._node_scope and generation in (None, self._node_generation):
+                self._cached_node = node
+
+    def _node_changed(self):
+        """Drop the memoized node after an operation that modified it."""
+        with self._node_lock:
+            self._node_generation += 1
+            self._cached_node = None
+        self.inventory_changed("instances", self.machine_name)
+
+    @contextlib.contextmanager
+    def _memoized_node(self):
+        """
+        Within this scope, node() reuses the last fetched node until an
+        operation changes it, so fingerprints stay fresh without a GET per
+        call.
+        """
+        with self._node_lock:
+            self._node_scope += 1
+        try:
+            yield
+        finally:
+            with self._node_lock:
+                self._node_scope -= 1
+                if not self._node_scope:
+                    self._cached_node = None
+
+    def inventory_node(self):
+        return self.inventory().node(self.connect(), self.machine_name, self.region)
+
+    def inventory_volume(self, name, region):
+        return self.inventory().volume(self.connect(), name, region)
 
     def address_to(self, resource):
         """Return the IP address to be used to access "resource" from this machine."""
@@ -208,12 +264,14 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
         }
 
     def update_block_device_mapping(self, k, v):
-        x = self.block_device_mapping
-        if v == None:
-            x.pop(k, None)
-        else:
-            x[k] = v
-        self.block_device_mapping = x
+        # disks are created and attached concurrently
+        with self._batch_lock:
+            x = self.block_device_mapping
+            if v == None:
+                x.pop(k, None)
+            else:
+                x[k] = v
+            self.block_device_mapping = x
 
     def _delete_volume(self, volume_id, region, allow_keep=False):
         if not self.depl.logger.confirm(
@@ -229,13 +287,15 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
             disk.destroy()
         except libcloud.common.google.ResourceNotFoundError:
             self.warn("seems to have been destroyed already")
+        self.inventory_changed("disks", volume_id)
 
     def _node_deleted(self):
-        self.vm_id = None
-        self.state = self.STOPPED
-        for k, v in self.block_device_mapping.items():
-            v["needsAttach"] = True
-            self.update_block_device_mapping(k, v)
+        with self.state_batch():
+            self.vm_id = None
+            self.state = self.STOPPED
+            for k, v in self.block_device_mapping.items():
+                v["needsAttach"] = True
+                self.update_block_device_mapping(k, v)
 
     defn_properties = [
         "tags",
@@ -254,6 +314,25 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
         return self.vm_id or self.block_device_mapping
 
     def create(self, defn, check, allow_reboot, allow_recreate):
+        # state writes are coalesced; flush_state() is called right after
+        # operations which must not be repeated if nixops is interrupted
+        with self._memoized_node(), self.state_batch(), self._inserting(defn):
+            self._create(defn, check, allow_reboot, allow_recreate)
+
+    def _inserting(self, defn):
+        # a machine without an instance will most likely insert one, so the
+        # inserts of machines created concurrently wait for each other
+        if self.vm_id:
+            return contextlib.nullcontext()
+        return instance_inserts.expecting(
+            (
+                self.defn_project(defn),
+                self.defn_service_account(defn),
+                self.defn_access_key_path(defn),
+            )
+        )
+
+    def _create(self, defn, check, allow_reboot, allow_recreate):
         assert isinstance(defn, GCEDefinition)
 
         self.no_project_change(defn)
@@ -286,7 +365,7 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
 
         if check:
             try:
-                node = self.node()
+                node = self.inventory_node()
                 if self.vm_id:
 
                     if node.state == NodeState.TERMINATED:
@@ -328,7 +407,9 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
 
                     if self.ipAddress:
                         try:
-                            address = self.connect().ex_get_address(self.ipAddress)
+                            address = self.inventory().address(
+                                self.connect(), self.ipAddress
+                            )
                             if self.public_ipv4 and self.public_ipv4 != address.address:
                                 self.warn(
                                     "static IP Address {0} assigned to this machine has unexpectely "
@@ -434,9 +515,7 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
             for k, v in defn.block_device_mapping.items():
                 disk_name = v["disk_name"] or v["disk"]
                 try:
-                    disk = self.connect().ex_get_volume(
-                        disk_name, v.get("region", None)
-                    )
+                    disk = self.inventory_volume(disk_name, v.get("region", None))
                     if k not in self.block_device_mapping and v["disk_name"]:
                         self.warn_not_supposed_to_exist(
                             resource_name=disk_name, valuable_data=True
@@ -458,68 +537,18 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
                         )
                         self.update_block_device_mapping(k, None)
 
-        # create missing disks
-        for k, v in defn.block_device_mapping.items():
-            if k in self.block_device_mapping:
-                continue
-
-            if v["disk"] is None:
-                img = ImageOptions(**v["image"])
-
-                extra_msg = (
-                    " from snapshot '{0}'".format(v["snapshot"])
-                    if v["snapshot"]
-                    else " from image family '{0}'".format(img.family)
-                    if img.family
-                    else " from image '{0}'".format(img.name)
-                    if img.name
-                    else ""
-                )
-                if img.project:
-                    extra_msg += " in project '{0}'".format(img.project)
-                self.log(
-                    "creating GCE disk of {0} GiB{1}...".format(
-                        v["size"] if v["size"] else "auto", extra_msg
-                    )
-                )
-
-                if hasattr(img, "_type") and img._type == "gce-image":
-                    img = self.depl.active_resources.get(img._name).image()
-                else:
-                    img = retrieve_gce_image(self.connect(), img=img)
-                v["region"] = defn.region
-                try:
-                    volume = self.connect().create_volume(
-                        size=v["size"],
-                        name=v["disk_name"],
-                        location=v["region"],
-                        snapshot=v["snapshot"],
-                        image=img,
-                        use_existing=False,
-                        ex_disk_type="pd-" + v["diskType"],
-                        ex_image_family=None,
-                    )
-                except AttributeError:
-                    # libcloud bug: The region we're trying to create the disk
-                    # in doesn't exist.
-                    raise Exception(
-                        "tried creating a disk in nonexistent "
-                        "region %r" % v["region"]
-                    )
-                except libcloud.common.google.ResourceExistsError:
-                    raise Exception(
-                        "tried creating a disk that already exists; "
-                        "please run 'deploy --check' to fix this"
-                    )
-                except libcloud.common.google.ResourceNotFoundError:
-                    raise Exception(
-                        "The snapshot '{0}' to be used for the volume creation does not exist".format(
-                            v["snapshot"]
-                        )
-                    )
-
-            v["needsAttach"] = True
-            self.update_block_device_mapping(k, v)
+        # create missing disks; they are independent of each other, and the
+        # boot disk only has to exist before the instance is created below
+        run_chains(
+            limit_chains(
+                [
+                    [functools.partial(self._create_disk, defn, k, v)]
+                    for k, v in defn.block_device_mapping.items()
+                    if k not in self.block_device_mapping
+                ],
+                disk_fan_out(),
+            )
+        )
 
         if self.vm_id:
             if self.instance_type != defn.instance_type:
@@ -557,8 +586,69 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
         if self.node().state == NodeState.STOPPED:
             self.start()
 
+    def _create_disk(self, defn, k, v):
+        if v["disk"] is None:
+            img = ImageOptions(**v["image"])
+
+            extra_msg = (
+                " from snapshot '{0}'".format(v["snapshot"])
+                if v["snapshot"]
+                else " from image family '{0}'".format(img.family)
+                if img.family
+                else " from image '{0}'".format(img.name)
+                if img.name
+                else ""
+            )
+            if img.project:
+                extra_msg += " in project '{0}'".format(img.project)
+            self.log(
+                "creating GCE disk of {0} GiB{1}...".format(
+                    v["size"] if v["size"] else "auto", extra_msg
+                )
+            )
+
+            if hasattr(img, "_type") and img._type == "gce-image":
+                img = self.depl.active_resources.get(img._name).image()
+            else:
+                img = retrieve_gce_image(self.connect(), img=img)
+            v["region"] = defn.region
+            try:
+                volume = self.connect().create_volume(
+                    size=v["size"],
+                    name=v["disk_name"],
+                    location=v["region"],
+                    snapshot=v["snapshot"],
+                    image=img,
+                    use_existing=False,
+                    ex_disk_type="pd-" + v["diskType"],
+                    ex_image_family=None,
+                )
+            except AttributeError:
+                # libcloud bug: The region we're trying to create the disk
+                # in doesn't exist.
+                raise Exception(
+                    "tried creating a disk in nonexistent region %r" % v["region"]
+                )
+            except libcloud.common.google.ResourceExistsError:
+                raise Exception(
+                    "tried creating a disk that already exists; "
+                    "please run 'deploy --check' to fix this"
+                )
+            except libcloud.common.google.ResourceNotFoundError:
+                raise Exception(
+                    "The snapshot '{0}' to be used for the volume creation does not exist".format(
+                        v["snapshot"]
+                    )
+                )
+            self.inventory_changed("disks", v["disk_name"])
+
+        v["needsAttach"] = True
+        self.update_block_device_mapping(k, v)
+        self.flush_state()
+
     def create_node(self, defn):
 
+        set_scheduling = False
         if not self.vm_id:
             self.log("creating {0}...".format(self.full_name))
             boot_disk = next(
@@ -614,6 +704,7 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
                     "tried creating an instance that already exists; "
                     "please run 'deploy --check' to fix this"
                 )
+            self._cache_node(node)
             self.vm_id = self.machine_name
             self.state = self.STARTING
             self.ssh_pinged = False
@@ -625,20 +716,17 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
             for k, v in self.block_device_mapping.items():
                 v["needsAttach"] = True
                 self.update_block_device_mapping(k, v)
-            # set scheduling config here instead of triggering an update using None values
+            self.flush_state()
+            # set scheduling config below instead of triggering an update using None values
             # because we might be called with defn = self, thus modifying self would ruin defn
-            self.connect().ex_set_node_scheduling(
-                node,
-                automatic_restart=defn.automatic_restart,
-                on_host_maintenance=defn.on_host_maintenance,
-            )
-            self.automatic_restart = defn.automatic_restart
-            self.on_host_maintenance = defn.on_host_maintenance
+            set_scheduling = True
 
         # Update instance type
         if self.instance_type != defn.instance_type:
             self.connect().ex_set_machine_type(self.node(), defn.instance_type)
+            self._node_changed()
             self.instance_type = defn.instance_type
+            self.flush_state()
 
         # Update service account
         if self.email != defn.email or self.scopes != defn.scopes:
@@ -655,80 +743,98 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
             self.connect().connection.async_request(
                 request, method="POST", data=service_account
             )
+            self._node_changed()
             self.email = defn.email
             self.scopes = defn.scopes
-
-        # Apply labels to node and disks just created
+            self.flush_state()
+
+        # GCE rejects an operation on an instance while another one is
+        # running on it, so the remaining updates of the instance run one
+        # after the other; the labels of its disks are set alongside them.
+        instance = [
+            functools.partial(self._attach_disk, k, v)
+            for k, v in self._disks_to_attach(defn)
+        ]
+        disks = []
         if self.labels != defn.labels:
-            self.log("updating node labels")
-            node = self.node()
-            labels_request = "/zones/%s/instances/%s" % (
-                node.extra["zone"].name,
-                node.name,
-            )
-            response = (
-                self.connect().connection.request(labels_request, method="GET").object
-            )
-            body = {
+            instance.append(functools.partial(self._update_labels, defn))
+            disks.append(functools.partial(self._update_disk_labels, defn))
+        if self.metadata != defn.metadata:
+            instance.append(functools.partial(self._update_metadata, defn))
+        if self.tags != defn.tags:
+            instance.append(functools.partial(self._update_tags, defn))
+        if self.public_ipv4 is None or self.ipAddress != defn.ipAddress:
+            instance.append(functools.partial(self._update_public_ip, defn))
+        if (
+            set_scheduling
+            or self.automatic_restart != defn.automatic_restart
+            or self.on_host_maintenance != defn.on_host_maintenance
+        ):
+            instance.append(functools.partial(self._update_scheduling, defn))
+        run_chains([instance, disks])
+        if self.labels != defn.labels:
+            self.labels = defn.labels
+            self.flush_state()
+
+    def _update_labels(self, defn):
+        # Apply labels to the node; its disks are labelled alongside
+        self.log("updating node labels")
+        node = self.node()
+        self.connect().connection.async_request(
+            "/zones/%s/instances/%s/setLabels" % (node.extra["zone"].name, node.name),
+            method="POST",
+            data={
                 "labels": defn.labels,
-                "labelFingerprint": response["labelFingerprint"],
-            }
-            request = "/zones/%s/instances/%s/setLabels" % (
-                node.extra["zone"].name,
-                node.name,
+                "labelFingerprint": node.extra["labelFingerprint"],
+            },
+        )
+        self._node_changed()
+
+    def _update_disk_labels(self, defn):
+        # the label fingerprints of the disks are fetched in one batch, and
+        # their labels set in another
+        self.log("updating disks labels")
+        disks = self.connect().connection.batch()
+        for k, v in self.block_device_mapping.items():
+            disk_name = v["disk_name"]
+            if not (
+                ("disk" in disk_name or "part" in disk_name)
+                and (disk_name.startswith(self.machine_name))
+            ):
+                continue
+            disks.add(
+                "/zones/%s/disks/%s" % (self.region, disk_name),
+                method="GET",
+                resource="GCE disk '{0}'".format(disk_name),
             )
-            self.connect().connection.async_request(request, method="POST", data=body)
-            self.labels = defn.labels
-            self.log("updating disks labels")
-            for k, v in self.block_device_mapping.items():
-                disk_name = v["disk_name"]
-                if not (
-                    ("disk" in disk_name or "part" in disk_name)
-                    and (disk_name.startswith(node.name))
-                ):
-                    continue
-                disk_labels_request = "/zones/%s/disks/%s" % (
-                    node.extra["zone"].name,
-                    disk_name,
-                )
-                response = (
-                    self.connect()
-                    .connection.request(disk_labels_request, method="GET")
-                    .object
-                )
-                body = {
+        batch = self.connect().connection.batch()
+        for disk in disks.execute(wait=False):
+            batch.add(
+                "/zones/%s/disks/%s/setLabels" % (self.region, disk.object["name"]),
+                data={
                     "labels": defn.labels,
-                    "labelFingerprint": response["labelFingerprint"],
-                }
-                request = "/zones/%s/disks/%s/setLabels" % (
-                    node.extra["zone"].name,
-                    disk_name,
-                )
-                self.connect().connection.async_request(
-                    request, method="POST", data=body
-                )
+                    "labelFingerprint": disk.object["labelFingerprint"],
+                },
+                resource=disk.resource,
+            )
+        batch.execute()
 
-        # Attach missing volumes
+    def _disks_to_attach(self, defn):
+        # Return the missing volumes to attach; the boot disk was attached
+        # when the instance was created, so only its state is updated here
+        disks = []
         for k, v in self.block_device_mapping.items():
             defn_v = defn.block_device_mapping.get(k, None)
             if v.get("needsAttach", False) and defn_v:
-                disk_name = v["disk_name"]
-                disk_volume = v["disk_name"] or v["disk"]
-                disk_region = v.get("region", None)
                 v["readOnly"] = defn_v["readOnly"]
                 v["bootDisk"] = defn_v["bootDisk"]
                 v["deleteOnTermination"] = defn_v["deleteOnTermination"]
                 v["passphrase"] = defn_v["passphrase"]
-                self.log("attaching GCE disk '{0}'...".format(disk_volume))
-                if not v.get("bootDisk", False):
-                    self.connect().attach_volume(
-                        self.node(),
-                        self.connect().ex_get_volume(disk_volume, disk_region),
-                        device=disk_name,
-                        ex_mode=("READ_ONLY" if v["readOnly"] else "READ_WRITE"),
-                    )
-                del v["needsAttach"]
-                self.update_block_device_mapping(k, v)
+                if v.get("bootDisk", False):
+                    del v["needsAttach"]
+                    self.update_block_device_mapping(k, v)
+                else:
+                    disks.append((k, v))
 
             # generate LUKS key if the model didn't specify one
             if (
@@ -739,29 +845,52 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
                 v["generatedKey"] = generate_random_string(length=256)
                 self.update_block_device_mapping(k, v)
 
-        if self.metadata != defn.metadata:
-            self.log("setting new metadata values")
-            node = self.node()
-            meta = self.gen_metadata(self.full_metadata(defn.metadata))
-            request = "/zones/%s/instances/%s/setMetadata" % (
-                node.extra["zone"].name,
-                node.name,
-            )
-            metadata_data = {}
-            metadata_data["items"] = meta["items"]
-            metadata_data["kind"] = meta["kind"]
-            metadata_data["fingerprint"] = node.extra["metadata"]["fingerprint"]
+        return disks
 
-            self.connect().connection.async_request(
-                request, method="POST", data=metadata_data
-            )
-            self.metadata = defn.metadata
+    def _attach_disk(self, k, v):
+        disk_volume = v["disk_name"] or v["disk"]
+        self.log("attaching GCE disk '{0}'...".format(disk_volume))
+        self.connect().attach_volume(
+            self.node(),
+            self.connect().ex_get_volume(disk_volume, v.get("region", None)),
+            device=v["disk_name"],
+            ex_mode=("READ_ONLY" if v["readOnly"] else "READ_WRITE"),
+        )
+        self._node_changed()
+        del v["needsAttach"]
+        self.update_block_device_mapping(k, v)
+        self.flush_state()
 
-        if self.tags != defn.tags:
-            self.log("updating tags")
-            self.connect().ex_set_node_tags(self.node(), defn.tags)
-            self.tags = defn.tags
+    def _update_metadata(self, defn):
+        self.log("setting new metadata values")
+        node = self.node()
+        meta = self.gen_metadata(self.full_metadata(defn.metadata))
+        metadata_data = {}
+        metadata_data["items"] = meta["items"]
+        metadata_data["kind"] = meta["kind"]
+        metadata_data["fingerprint"] = node.extra["metadata"]["fingerprint"]
+        self.connect().connection.async_request(
+            "/zones/%s/instances/%s/setMetadata" % (node.extra["zone"].name, node.name),
+            method="POST",
+            data=metadata_data,
+        )
+        self._node_changed()
+        self.metadata = defn.metadata
+        self.flush_state()
 
+    def _update_tags(self, defn):
+        self.log("updating tags")
+        node = self.node()
+        self.connect().connection.async_request(
+            "/zones/%s/instances/%s/setTags" % (node.extra["zone"].name, node.name),
+            method="POST",
+            data={"items": defn.tags, "fingerprint": node.extra["tags_fingerprint"]},
+        )
+        self._node_changed()
+        self.tags = defn.tags
+        self.flush_state()
+
+    def _update_public_ip(self, defn):
         if self.public_ipv4 and self.ipAddress != defn.ipAddress:
             self.log("detaching old public IP address {0}".format(self.public_ipv4))
             self.connect().connection.async_request(
@@ -770,8 +899,10 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
                 ),
                 method="POST",
             )
+            self._node_changed()
             self.public_ipv4 = None
             self.ipAddress = None
+            self.flush_state()
 
         if self.public_ipv4 is None:
             self.log(
@@ -793,30 +924,31 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
                     else None,
                 },
             )
+            self._node_changed()
             self.ipAddress = defn.ipAddress
             self.public_ipv4 = self.node().public_ips[0]
+            self.flush_state()
             self.log("got public IP: {0}".format(self.public_ipv4))
             known_hosts.add(self.public_ipv4, self.public_host_key)
             self.ssh.reset()
             self.ssh_pinged = False
 
-        if (
-            self.automatic_restart != defn.automatic_restart
-            or self.on_host_maintenance != defn.on_host_maintenance
-        ):
-            self.log("setting scheduling configuration")
-            self.connect().ex_set_node_scheduling(
-                self.node(),
-                automatic_restart=defn.automatic_restart,
-                on_host_maintenance=defn.on_host_maintenance,
-            )
-            self.automatic_restart = defn.automatic_restart
-            self.on_host_maintenance = defn.on_host_maintenance
+    def _update_scheduling(self, defn):
+        self.log("setting scheduling configuration")
+        self.connect().ex_set_node_scheduling(
+            self.node(),
+            automatic_restart=defn.automatic_restart,
+            on_host_maintenance=defn.on_host_maintenance,
+        )
+        self._node_changed()
+        self.automatic_restart = defn.automatic_restart
+        self.on_host_maintenance = defn.on_host_maintenance
 
     def reboot(self, hard=False):
         if hard:
             self.log("sending hard reset to GCE machine...")
             self.node().reboot()
+            self._node_changed()
             self.state = self.STARTING
         else:
             MachineState.reboot(self, hard=hard)
@@ -836,8 +968,10 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
             if node and (node.state == NodeState.STOPPED):
                 self.log("starting GCE machine")
                 self.connect().ex_start_node(node)
-                self.public_ipv4 = self.node().public_ips[0]
-                self.private_ipv4 = self.node().private_ips[0]
+                self._node_changed()
+                node = self.node()
+                self.public_ipv4 = node.public_ips[0]
+                self.private_ipv4 = node.private_ips[0]
                 known_hosts.add(self.public_ipv4, self.public_host_key)
                 self.wait_for_ssh(check=True)
                 self.send_keys()
@@ -877,10 +1011,11 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
         if node.state != NodeState.TERMINATED:
             self.log_start("stopping GCE machine... ")
             self.connect().ex_stop_node(node)
+            self._node_changed()
             self.state = self.STOPPING
 
             def check_stopped():
-                return self.node().state == NodeState.STOPPED
+                return self.node(fresh=True).state == NodeState.STOPPED
 
             if check_wait(
                 check_stopped, initial=3, max_tries=100, exception=False
@@ -912,20 +1047,27 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
             known_hosts.remove(self.public_ipv4, self.public_host_key)
             self.log("destroying the GCE machine...")
             node.destroy()
+            self._node_changed()
 
         except libcloud.common.google.ResourceNotFoundError:
             self.warn("seems to have been destroyed already")
-        self._node_deleted()
 
-        # Destroy volumes created for this instance.
-        for k, v in self.block_device_mapping.items():
-            if v.get("deleteOnTermination", False):
-                self._delete_volume(v["disk_name"], v["region"], True)
-            self.update_block_device_mapping(k, None)
+        with self.state_batch():
+            self._node_deleted()
+
+            # Destroy volumes created for this instance.
+            for k, v in self.block_device_mapping.items():
+                if v.get("deleteOnTermination", False):
+                    self._delete_volume(v["disk_name"], v["region"], True)
+                self.update_block_device_mapping(k, None)
 
         return True
 
     def after_activation(self, defn):
+        with self.state_batch():
+            self._detach_removed_disks(defn)
+
+    def _detach_removed_disks(self, defn):
         # Detach volumes that are no longer in the deployment spec.
         for k, v in self.block_device_mapping.items():
             if k not in defn.block_device_mapping:
@@ -949,6 +1091,7 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
                         self.connect().detach_volume(volume, node)
                         v["needsAttach"] = True
                         self.update_block_device_mapping(k, v)
+                        self.flush_state()
 
                     if v.get("deleteOnTermination", False):
                         self._delete_volume(disk_name, v["region"])
@@ -978,8 +1121,12 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
         )
 
     def _check(self, res):
+        with self.state_batch():
+            self._check_node(res)
+
+    def _check_node(self, res):
         try:
-            node = self.node()
+            node = self.inventory_node()
             res.exists = True
             res.is_up = (
                 node.state == NodeState.RUNNING or node.state == NodeState.REBOOTING
@@ -1004,9 +1151,7 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
                         # Try to get a disk; if we can't get it, then it's
                         # been destroyed.
                         try:
-                            self.connect().ex_get_volume(
-                                disk_name, v.get("region", None)
-                            )
+                            self.inventory_volume(disk_name, v.get("region", None))
                         except libcloud.common.google.ResourceNotFoundError:
                             res.messages.append(
                                 "disk {0} is destroyed".format(disk_name)
@@ -1055,131 +1200,196 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
                 " specification; consider running 'deploy' first; the backup may be incomplete"
             )
 
+        # all snapshots are requested in one batch, so that they start at
+        # almost the same time
         backup = {}
-        _backups = self.backups
+        batch = self.connect().connection.batch()
+
+        def snapshot_started(k, snapshot_name):
+            return lambda operation: backup.update({k: snapshot_name})
+
         for k, v in self.block_device_mapping.items():
             disk_name = v["disk_name"] or v["disk"]
             if devices == [] or k in devices or disk_name in devices:
-                volume = self.connect().ex_get_volume(disk_name, v.get("region", None))
+                volume = self.inventory_volume(disk_name, v.get("region", None))
                 snapshot_name = "backup-{0}-{1}".format(backup_id, disk_name[-32:])
                 self.log(
                     "initiating snapshotting of disk '{0}': '{1}'".format(
                         disk_name, snapshot_name
                     )
                 )
-                self.connect().connection.request(
+                data = {
+                    "name": snapshot_name,
+                    "description": "backup of disk {0} attached to {1}".format(
+                        volume.name, self.machine_name
+                    ),
+                }
+                if defn.labels:
+                    data["labels"] = defn.labels
+                batch.add(
                     "/zones/%s/disks/%s/createSnapshot"
                     % (volume.extra["zone"].name, volume.name),
-                    method="POST",
-                    data={
-                        "name": snapshot_name,
-                        "description": "backup of disk {0} attached to {1}".format(
-                            volume.name, self.machine_name
-                        ),
-                    },
+                    data=data,
+                    resource="GCE disk '{0}'".format(disk_name),
+                    callback=snapshot_started(k, snapshot_name),
                 )
 
-                # Apply labels to snapshot just created
-                self.wait_for_snapshot_initiated(snapshot_name)
-
-                if defn.labels:
-                    self.log("updating labels of snapshot '{0}'".format(snapshot_name))
-                    self.connect().connection.request(
-                        "/global/snapshots/%s/setLabels" % (snapshot_name),
-                        method="POST",
-                        data={
-                            "labels": defn.labels,
-                            "labelFingerprint": self.connect()
-                            .connection.request(
-                                "/global/snapshots/{0}".format(snapshot_name),
-                                method="GET",
-                            )
-                            .object["labelFingerprint"],
-                        },
-                    )
-
-                backup[k] = snapshot_name
+        try:
+            batch.execute(wait=False)
+        finally:
+            # record the snapshots which were started even if others failed
+            self.snapshots_changed()
+            _backups = self.backups
             _backups[backup_id] = backup
             self.backups = _backups
 
-    def wait_for_snapshot_initiated(self, snapshot_name):
-        while True:
-            try:
-                snapshot = self.connect().ex_get_snapshot(snapshot_name)
-                if snapshot.status in "READY" "CREATING" "UPLOADING":
-                    self.log_end(" done")
-                    break
-                else:
+        self.wait_for_snapshots_initiated(backup_id, list(backup.values()))
+        self.prune_backups(defn, keep=[backup_id])
+
+    def wait_for_snapshots_initiated(self, backup_id, snapshot_names):
+        prefix = "backup-{0}-".format(backup_id)
+
+        def check_initiated():
+            # one listing covers all snapshots of the backup
+            index = SnapshotIndex.fetch(self.connect(), prefix)
+            for snapshot_name in snapshot_names:
+                status = index.status(self.connect(), snapshot_name)
+                if status is None:
+                    self.log_continue(".")
+                    return False
+                if status not in ("READY", "CREATING", "UPLOADING"):
                     raise Exception(
                         "snapshot '{0}' is in an unexpected state {1}".format(
-                            snapshot_name, snapshot.status
+                            snapshot_name, status
                         )
                     )
-            except libcloud.common.google.ResourceNotFoundError:
-                self.log_continue(".")
-                time.sleep(1)
+            return True
+
+        self.log_start("waiting for snapshots to be initiated...")
+        wait_until(check_initiated)
+        self.log_end(" done")
 
     def restore(self, defn, backup_id, devices=[]):
         self.log("restoring {0} to backup '{1}'".format(self.full_name, backup_id))
 
         self.stop()
 
+        # the disks are independent, so each is replaced concurrently; only
+        # the snapshots of this backup are listed
+        index = SnapshotIndex.fetch(self.connect(), "backup-{0}-".format(backup_id))
+        chains = []
         for k, v in self.block_device_mapping.items():
             disk_name = v["disk_name"] or v["disk"]
             s_id = self.backups[backup_id].get(disk_name, None)
             if s_id and (devices == [] or k in devices or disk_name in devices):
-                try:
-                    snapshot = self.connect().ex_get_snapshot(s_id)
-                except libcloud.common.google.ResourceNotFoundError:
+                snapshot = index.snapshot(self.connect(), s_id)
+                if snapshot is None:
                     self.warn(
                         "snapshot {0} for disk {1} is missing; skipping".format(
                             s_id, disk_name
                         )
                     )
                     continue
+                chains.append(
+                    [functools.partial(self._restore_disk, v, disk_name, snapshot)]
+                )
+        run_chains(limit_chains(chains, disk_fan_out()))
 
-                try:
-                    self.log("destroying disk {0}".format(disk_name))
-                    self.connect().ex_get_volume(
-                        disk_name, v.get("region", None)
-                    ).destroy()
-                except libcloud.common.google.ResourceNotFoundError:
-                    self.warn(
-                        "disk {0} seems to have been destroyed already".format(
-                            disk_name
-                        )
-                    )
+    def _restore_disk(self, v, disk_name, snapshot):
+        started = time.time()
+        try:
+            self.log("destroying disk {0}".format(disk_name))
+            self.connect().ex_get_volume(disk_name, v.get("region", None)).destroy()
+        except libcloud.common.google.ResourceNotFoundError:
+            self.warn("disk {0} seems to have been destroyed already".format(disk_name))
 
-                self.log(
-                    "creating disk {0} from snapshot '{1}'".format(disk_name, s_id)
-                )
-                self.connect().create_volume(
-                    None,
-                    disk_name,
-                    v.get("region", None),
-                    ex_disk_type="pd-" + v.get("type", "standard"),
-                    snapshot=snapshot,
-                    use_existing=False,
-                )
+        self.log(
+            "creating disk {0} from snapshot '{1}'".format(disk_name, snapshot.name)
+        )
+        self.connect().create_volume(
+            None,
+            disk_name,
+            v.get("region", None),
+            ex_disk_type="pd-" + v.get("type", "standard"),
+            snapshot=snapshot,
+            use_existing=False,
+        )
+        self.inventory_changed("disks", disk_name)
+        self.log(
+            "restored disk {0} in {1:.1f}s".format(disk_name, time.time() - started)
+        )
 
     def remove_backup(self, backup_id, keep_physical=False):
-        self.log("removing backup {0}".format(backup_id))
+        self.remove_backups([backup_id], keep_physical)
+
+    def remove_backups(self, backup_ids, keep_physical=False):
+        """
+        Remove the given backups. Their snapshots are looked up in the
+        project's shared snapshot index and deleted concurrently, in
+        batches.
+        """
         _backups = self.backups
-        if not backup_id in _backups.keys():
-            self.warn("backup {0} not found; skipping".format(backup_id))
-        else:
+        for backup_id in backup_ids:
+            self.log("removing backup {0}".format(backup_id))
+            if not backup_id in _backups.keys():
+                self.warn("backup {0} not found; skipping".format(backup_id))
+        backup_ids = [b for b in backup_ids if b in _backups.keys()]
+        if not backup_ids:
+            return
+
+        index = self.snapshot_index()
+        remaining = {b: set() for b in backup_ids}
+        batch = self.connect().connection.batch()
+
+        removed = []
+
+        def snapshot_removed(backup_id, snapshot_id):
+            def callback(operation):
+                remaining[backup_id].discard(snapshot_id)
+                removed.append(snapshot_id)
+
+            return callback
+
+        for backup_id in backup_ids:
             for d_name, snapshot_id in _backups[backup_id].items():
-                try:
-                    self.log("removing snapshot {0}".format(snapshot_id))
-                    self.connect().ex_get_snapshot(snapshot_id).destroy()
-                except libcloud.common.google.ResourceNotFoundError:
+                if index.status(self.connect(), snapshot_id) is None:
                     self.warn("snapshot {0} not found; skipping".format(snapshot_id))
+                    continue
+                self.log("removing snapshot {0}".format(snapshot_id))
+                remaining[backup_id].add(snapshot_id)
+                batch.add(
+                    "/global/snapshots/%s" % snapshot_id,
+                    method="DELETE",
+                    resource="GCE snapshot '{0}'".format(snapshot_id),
+                    callback=snapshot_removed(backup_id, snapshot_id),
+                )
 
-            _backups.pop(backup_id)
+        try:
+            batch.execute()
+        finally:
+            # forget the backups whose snapshots are all gone
+            self.snapshots_removed(removed)
+            _backups = self.backups
+            for backup_id, snapshot_ids in remaining.items():
+                if not snapshot_ids:
+                    _backups.pop(backup_id, None)
             self.backups = _backups
 
+    def prune_backups(self, defn, keep=()):
+        """Remove the backups not kept by the machine's retention policy."""
+        prune = backups_to_prune(self.backups.keys(), defn.backup_retention, keep)
+        if prune:
+            self.log(
+                "pruning {0} backups not kept by the retention policy".format(
+                    len(prune)
+                )
+            )
+            self.remove_backups(prune)
+
     def get_backups(self):
-        self.connect()
+        # one listing of the project's backup snapshots instead of a GET
+        # per snapshot
+        index = self.snapshot_index() if self.backups else None
         backups = {}
         for b_id, snapshots in self.backups.items():
             backups[b_id] = {}
@@ -1196,17 +1406,16 @@ class GCEState(MachineState[GCEDefinition], ResourceState):
                     )
                 else:
                     snapshot_id = snapshots[disk_name]
-                    try:
-                        snapshot = self.connect().ex_get_snapshot(snapshot_id)
-                        if snapshot.status != "READY":
-                            backup_status = "running"
-                    except libcloud.common.google.ResourceNotFoundError:
+                    status = index.status(self.connect(), snapshot_id)
+                    if status is None:
                         info.append(
                             "{0} - {1} - {2} - snapshot has disappeared".format(
                                 self.name, disk_name, snapshot_id
                             )
                         )
                         backup_status = "unavailable"
+                    elif status != "READY":
+                        backup_status = "running"
             for d_name, s_id in snapshots.items():
                 if not any(
                     d_name == v["disk_name"] or d_name == v["disk"]
@@ -43,6 +43,12 @@ class SchedulingOptions(ResourceOptions):
     preemptible: bool
 
 
+class BackupRetentionOptions(ResourceOptions):
+    hourly: Optional[int]
+    daily: Optional[int]
+    weekly: Optional[int]
+
+
 class InstanceserviceAccountOptions(ResourceOptions):
     email: str
     scopes: Sequence[str]
@@ -50,6 +56,7 @@ class InstanceserviceAccountOptions(ResourceOptions):
 
 class GceOptions(ResourceOptions):
     accessKey: str
+    backupRetention: BackupRetentionOptions
     blockDeviceMapping: Mapping[str, GCEDiskOptions]
     bootstrapImage: ImageOptions
     canIpForward: bool
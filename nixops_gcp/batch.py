@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+# Compute API batch requests. Many calls are sent as the parts of a single
+# multipart/mixed request to batch/compute/v1, and each part of the
+# response is mapped back to the call, and so the resource, it belongs to.
+
+import collections
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from libcloud.common.google import (
+    GoogleBaseError,
+    InvalidRequestError,
+    ResourceExistsError,
+    ResourceNotFoundError,
+)
+
+from nixops_gcp.metrics import api_metrics, current_resource
+from nixops_gcp.operations import operation_waiter
+from nixops_gcp.provisioning import ParallelError
+from nixops_gcp.throttling import IDEMPOTENT_METHODS, retry_policy
+
+BATCH_URL = "https://www.googleapis.com/batch/compute/v1"
+
+_ERRORS = {
+    400: InvalidRequestError,
+    404: ResourceNotFoundError,
+    409: ResourceExistsError,
+}
+
+
+class BatchCall(object):
+    """A single call of a batch, and its outcome once the batch was sent."""
+
+    def __init__(self, method, action, data, resource, callback):
+        self.method = method
+        self.action = action
+        self.data = data
+        self.resource = resource
+        self.callback = callback
+        # the nixops resource making the call, see nixops_gcp.metrics
+        self.owner = current_resource.get()
+        self.object = None
+        self.error = None
+
+    def set_response(self, status, body):
+        try:
+            parsed = json.loads(body) if body.strip() else {}
+        except ValueError:
+            parsed = None
+        if 200 <= status < 300 and parsed is not None and "error" not in parsed:
+            self.object = parsed
+            return
+
+        code, message = None, body
+        if isinstance(parsed, dict) and isinstance(parsed.get("error"), dict):
+            error = parsed["error"]
+            code = (error.get("errors") or [{}])[0].get("reason", error.get("code"))
+            message = error.get("message", message)
+        self.error = _ERRORS.get(status, GoogleBaseError)(
+            "{0}: {1}".format(self.resource, message), status, code
+        )
+
+
+class ComputeBatch(object):
+    """
+    Collects Compute API calls and sends them in as few batch requests as
+    possible.
+
+    Calls are added with add() and sent by execute(), which by default
+    also waits for the operations they started. The callback of each
+    successful call is then called with its result; failures are raised
+    afterwards, tagged with the resource they belong to.
+    """
+
+    # the API accepts up to 1000 calls per batch, but large batches are
+    # more likely to be throttled as a whole
+    max_calls = 100
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def add(self, action, method="POST", data=None, resource=None, callback=None):
+        call = BatchCall(method, action, data, resource or action, callback)
+        self.calls.append(call)
+        return call
+
+    def execute(self, wait=True):
+        calls, self.calls = self.calls, []
+        for i in range(0, len(calls), self.max_calls):
+            self._send_with_retries(calls[i : i + self.max_calls])
+
+        if wait:
+            self._wait(calls)
+
+        errors = []
+        for call in calls:
+            if call.error is not None:
+                errors.append(call.error)
+            elif call.callback is not None:
+                call.callback(call.object)
+        if len(errors) == 1:
+            raise errors[0]
+        if errors:
+            raise ParallelError(errors)
+        return calls
+
+    def _wait(self, calls):
+        factory = self.connection.pooled_connection()
+        futures = [
+            (call, operation_waiter.submit(call, factory, resource=call.owner))
+            for call in calls
+            if call.error is None and call.object.get("kind") == "compute#operation"
+        ]
+        for call, future in futures:
+            try:
+                call.object = future.result().object
+            except Exception as e:
+                call.error = e
+
+    def _send_with_retries(self, calls):
+        # calls of a batch are throttled or fail individually, so the ones
+        # which may be retried are sent again in a smaller batch
+        attempt = 0
+        while calls:
+            self._send(calls)
+            calls = [
+                call
+                for call in calls
+                if call.error is not None
+                and attempt < retry_policy.max_retries
+                and retry_policy.is_retryable(
+                    call.error, call.method in IDEMPOTENT_METHODS
+                )
+            ]
+            if calls:
+                time.sleep(max(retry_policy.delay(attempt, c.error) for c in calls))
+                for call in calls:
+                    call.error = None
+            attempt += 1
+
+    def _send(self, calls):
+        boundary = "batch_" + uuid.uuid4().hex
+        parts = []
+        for i, call in enumerate(calls):
+            parts.append(
+                "--{0}\r\n"
+                "Content-Type: application/http\r\n"
+                "Content-ID: <{1}>\r\n"
+                "\r\n"
+                "{2} {3} HTTP/1.1\r\n"
+                "Content-Type: application/json\r\n"
+                "\r\n"
+                "{4}\r\n".format(
+                    boundary,
+                    i,
+                    call.method,
+                    self.connection.morph_action_hook(call.action),
+                    json.dumps(call.data) if call.data is not None else "",
+                )
+            )
+        parts.append("--{0}--\r\n".format(boundary))
+
+        started = time.time()
+        response = self.connection.request(
+            BATCH_URL,
+            method="POST",
+            data="".join(parts),
+            headers={"Content-Type": "multipart/mixed; boundary=" + boundary},
+            # the calls count against the quotas individually
+            quota="read" if all(c.method == "GET" for c in calls) else "write",
+            cost=len(calls),
+        )
+        for content_id, status, body in parse_multipart(response):
+            calls[content_id].set_response(status, body)
+        for call in calls:
+            if call.object is None and call.error is None:
+                call.error = GoogleBaseError(
+                    "{0}: missing from the batch response".format(call.resource),
+                    None,
+                    None,
+                )
+        for call in calls:
+            api_metrics.record_batched_call(
+                call.method,
+                self.connection.morph_action_hook(call.action),
+                time.time() - started,
+                call.error is not None,
+                call.owner,
+            )
+
+
+def parse_multipart(response):
+    """
+    Yield (content id, HTTP status, body) for each part of a batch
+    response.
+    """
+    match = re.search(r'boundary="?([^";]+)"?', response.headers["content-type"])
+    if match is None:
+        raise GoogleBaseError("batch response is not multipart", response.status, None)
+    for part in response.body.split("--" + match.group(1)):
+        part = part.strip()
+        if not part or part == "--":
+            continue
+        # part headers, then the status line and headers, then the body
+        sections = re.split(r"\r?\n\r?\n", part, maxsplit=2) + [""]
+        content_id = re.search(r"Content-ID:\s*<response-(\d+)>", sections[0], re.I)
+        if content_id is None:
+            continue
+        status = int(sections[1].split()[1])
+        body = sections[2]
+        yield int(content_id.group(1)), status, body
+
+
+class _CallGroup(object):
+    def __init__(self):
+        self.calls = []
+        self.error = None
+        self.done = threading.Event()
+
+
+class CallCoalescer(object):
+    """
+    Sends calls which concurrent threads make within a short window as
+    one batch, and waits for the operations they start together.
+
+    Threads which are about to make a call say so with expecting(). The
+    first thread to make a call waits until the other expected threads
+    made theirs, or the window has passed, then sends the batch for
+    everyone; the others wait for their result. A call nobody else is
+    expected to join is sent right away. The window is
+    $NIXOPS_GCP_COALESCE_WINDOW seconds (0.2 if unset); 0 disables
+    coalescing.
+    """
+
+    def __init__(self, window=None):
+        if window is None:
+            window = float(os.environ.get("NIXOPS_GCP_COALESCE_WINDOW", 0.2))
+        self.window = window
+        self._cond = threading.Condition()
+        self._groups = {}
+        # number of threads expected to make a call, by pool key
+        self._expected = collections.Counter()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def expecting(self, key):
+        """
+        Within this scope, the calling thread is expected to make a call
+        on a connection with the given pool key.
+        """
+        with self._cond:
+            self._expected[key] += 1
+            self._local.__dict__.setdefault("keys", []).append(key)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._called(key)
+
+    def _called(self, key):
+        # with self._cond held
+        keys = self._local.__dict__.get("keys", [])
+        if key in keys:
+            keys.remove(key)
+            self._expected[key] -= 1
+            self._cond.notify_all()
+
+    def call(self, connection, action, data, resource=None):
+        """Make the call and return it once its operation has completed."""
+        key = connection.pool_key
+        with self._cond:
+            self._called(key)
+            group = self._groups.get(key)
+            leader = group is None
+            if leader:
+                group = self._groups[key] = _CallGroup()
+            call = BatchCall("POST", action, data, resource or action, None)
+            group.calls.append(call)
+
+        if leader:
+            with self._cond:
+                self._cond.wait_for(lambda: self._expected[key] <= 0, self.window)
+                del self._groups[key]
+            batch = ComputeBatch(connection)
+            batch.calls = group.calls
+            try:
+                batch.execute()
+            except Exception as e:
+                # failed calls are reported to their callers below; if the
+                # batch itself failed, every caller gets its error
+                if any(c.object is None and c.error is None for c in group.calls):
+                    group.error = e
+            finally:
+                group.done.set()
+        else:
+            group.done.wait()
+
+        if group.error is not None:
+            raise group.error
+        if call.error is not None:
+            raise call.error
+        return call
+
+
+instance_inserts = CallCoalescer()
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+# Scaling benchmark of the plugin against the fake GCE API, run by
+# benchmarks/scaling.py.
+#
+# For each size, a synthetic deployment of N machines with M disks each,
+# a network with K firewall rules, target pools and buckets is created,
+# checked, backed up and destroyed by the plugin's resource states. Each
+# phase runs in a process of its own, as each nixops command does,
+# against a nixops_gcp.fake_gcp server in this process which counts the
+# requests of each phase. The wall time, peak RSS and HTTP calls per
+# endpoint of each phase are written as JSON, so that releases can be
+# compared. Requests are rate limited as configured
+# with $NIXOPS_GCP_READ_RATE and $NIXOPS_GCP_WRITE_RATE; set them to 0
+# to measure the plugin alone.
+
+import collections.abc
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import typing
+
+import nixops.parallel
+import nixops.statefile
+from nixops.resources import ResourceOptions
+
+from nixops_gcp.backends.gce import GCEDefinition, GCEMachineOptions
+from nixops_gcp.backends.options import (
+    GceOptions,
+    GCEDiskOptions,
+    ImageOptions,
+    InstanceserviceAccountOptions,
+    SchedulingOptions,
+)
+from nixops_gcp.fake_gcp import FakeGCP, FakeGCPServer
+from nixops_gcp.resources.gce_network import GCENetworkDefinition
+from nixops_gcp.resources.gce_target_pool import GCETargetPoolDefinition
+from nixops_gcp.resources.gse_bucket import GSEBucketDefinition
+from nixops_gcp.resources.types.gce_network import GceNetworkOptions
+from nixops_gcp.resources.types.gce_target_pool import GceTargetPoolOptions
+from nixops_gcp.resources.types.gse_bucket import GseBucketOptions
+from nixops_gcp.retention import BACKUP_ID_FORMAT
+
+PHASES = ["create", "deploy-check", "check", "backup", "get-backups", "destroy"]
+
+PROJECT = "nixops-benchmark"
+ZONE = "europe-west1-b"
+IMAGE = {"family": "nixos-image-23-05", "project": "nixos-cloud"}
+CREDENTIALS = {
+    "project": PROJECT,
+    "serviceAccount": "benchmark@{0}.iam.gserviceaccount.com".format(PROJECT),
+    "accessKey": os.devnull,
+}
+NETWORK = "benchmark-network"
+DISK_PREFIX = "/dev/disk/by-id/scsi-0Google_PersistentDisk_"
+
+
+def default_value(option_type):
+    origin = typing.get_origin(option_type)
+    args = typing.get_args(option_type)
+    if origin is typing.Union:
+        return None if type(None) in args else default_value(args[0])
+    if origin is typing.Literal:
+        return args[0]
+    if origin in (collections.abc.Sequence, list):
+        return []
+    if origin in (collections.abc.Mapping, dict):
+        return {}
+    if isinstance(option_type, type) and issubclass(option_type, ResourceOptions):
+        return options(option_type)
+    return {bool: False, int: 0, str: ""}.get(option_type)
+
+
+def options(options_type, **values):
+    """
+    Return the configuration of an options class as nix would evaluate
+    it, with the given values and empty defaults for the other options.
+    """
+    config = {
+        name: default_value(option_type)
+        for name, option_type in typing.get_type_hints(options_type).items()
+        if not name.startswith("_")
+    }
+    config.update(values)
+    return config
+
+
+def deployment_spec(machines, disks, firewall_rules, machines_per_pool, buckets):
+    return {
+        "machines": machines,
+        "disks": disks,
+        "firewall_rules": firewall_rules,
+        "machines_per_pool": machines_per_pool,
+        "target_pools": math.ceil(machines / machines_per_pool),
+        "buckets": buckets,
+    }
+
+
+class SyntheticDeployment(object):
+    """
+    A generated deployment, with the definitions and states of its
+    resources. The deployment is created in the state file if uuid is
+    None, and opened otherwise.
+
+    Resources are deployed in layers: the network and buckets, then the
+    machines, then the target pools holding them. The resources of a
+    layer are handled concurrently, one thread each, as nixops does.
+    """
+
+    def __init__(self, spec, state_file, uuid=None):
+        self.spec = spec
+        self.statefile = nixops.statefile.StateFile(state_file, writable=True)
+        if uuid is None:
+            self.depl = self.statefile.create_deployment()
+        else:
+            self.depl = self.statefile.open_deployment(uuid)
+        self.depl.logger.set_autoresponse("y")
+
+        self.machines = ["machine-{0}".format(i) for i in range(spec["machines"])]
+        pools = ["pool-{0}".format(i) for i in range(spec["target_pools"])]
+        buckets = ["bucket-{0}".format(i) for i in range(spec["buckets"])]
+        self.layers = [["network"] + buckets, self.machines, pools]
+
+        self.definitions = {"network": self.network("network")}
+        self.definitions.update((m, self.machine(m)) for m in self.machines)
+        per_pool = spec["machines_per_pool"]
+        self.definitions.update(
+            (p, self.target_pool(p, self.machines[i * per_pool : (i + 1) * per_pool]))
+            for i, p in enumerate(pools)
+        )
+        self.definitions.update((b, self.bucket(b)) for b in buckets)
+
+        with self.depl._db:
+            self.states = {
+                name: self.depl.resources.get(name)
+                or self.depl._create_resource(name, defn.get_type())
+                for name, defn in self.definitions.items()
+            }
+
+    def network(self, name):
+        firewall = {
+            "allow-{0}".format(i): {
+                "allowed": {"tcp": [10000 + i]},
+                "sourceRanges": None,
+                "sourceTags": [],
+                "targetTags": ["benchmark"],
+            }
+            for i in range(self.spec["firewall_rules"])
+        }
+        return GCENetworkDefinition(
+            name,
+            options(GceNetworkOptions, name=NETWORK, firewall=firewall, **CREDENTIALS),
+        )
+
+    def machine(self, name, **overrides):
+        # overrides replace the generated gce options of the machine
+        def disk(disk_name, **values):
+            return options(
+                GCEDiskOptions,
+                disk_name=disk_name,
+                diskType="standard",
+                deleteOnTermination=True,
+                **values
+            )
+
+        block_device_mapping = {
+            "{0}{1}-root".format(DISK_PREFIX, name): disk(
+                "root", image=options(ImageOptions, **IMAGE), bootDisk=True
+            )
+        }
+        for i in range(1, self.spec["disks"]):
+            block_device_mapping["{0}{1}-data{2}".format(DISK_PREFIX, name, i)] = disk(
+                "data{0}".format(i), size=10
+            )
+
+        gce = dict(
+            machineName=name,
+            region=ZONE,
+            instanceType="n1-standard-1",
+            network=NETWORK,
+            tags=["benchmark"],
+            labels={"deployment": "benchmark"},
+            rootDiskType="standard",
+            bootstrapImage=options(ImageOptions, **IMAGE),
+            blockDeviceMapping=block_device_mapping,
+            scheduling=options(
+                SchedulingOptions,
+                automaticRestart=True,
+                onHostMaintenance="MIGRATE",
+            ),
+            instanceServiceAccount=options(
+                InstanceserviceAccountOptions, email="default"
+            ),
+            **CREDENTIALS
+        )
+        gce.update(overrides)
+        return GCEDefinition(
+            name,
+            options(
+                GCEMachineOptions, nixosRelease="23.05", gce=options(GceOptions, **gce)
+            ),
+        )
+
+    def target_pool(self, name, machines):
+        return GCETargetPoolDefinition(
+            name,
+            options(
+                GceTargetPoolOptions,
+                name=name,
+                region=ZONE.rsplit("-", 1)[0],
+                machines=machines,
+                **CREDENTIALS
+            ),
+        )
+
+    def bucket(self, name, **overrides):
+        # overrides replace the generated options of the bucket
+        bucket = dict(
+            name="{0}-{1}".format(PROJECT, name),
+            location="EU",
+            storageClass="STANDARD",
+            **CREDENTIALS
+        )
+        bucket.update(overrides)
+        return GSEBucketDefinition(name, options(GseBucketOptions, **bucket))
+
+    def parallel(self, names, worker_fun):
+        nixops.parallel.run_tasks(
+            nr_workers=-1,
+            tasks=[self.states[name] for name in names],
+            worker_fun=worker_fun,
+        )
+
+    def deploy(self, check):
+        for layer in self.layers:
+            self.parallel(
+                layer,
+                lambda r: r.create(
+                    self.definitions[r.name],
+                    check=check,
+                    allow_reboot=False,
+                    allow_recreate=False,
+                ),
+            )
+
+    def create(self):
+        self.deploy(check=False)
+
+    def deploy_check(self):
+        self.deploy(check=True)
+
+    def check(self):
+        self.parallel(self.machines, lambda m: m.check())
+
+    def backup(self):
+        backup_id = time.strftime(BACKUP_ID_FORMAT, time.gmtime())
+        self.parallel(
+            self.machines, lambda m: m.backup(self.definitions[m.name], backup_id)
+        )
+
+    def get_backups(self):
+        self.parallel(self.machines, lambda m: m.get_backups())
+
+    def destroy(self):
+        def destroy(r):
+            if not r.destroy(wipe=False):
+                raise Exception("{0} wasn't destroyed".format(r.name))
+
+        for layer in reversed(self.layers):
+            self.parallel(layer, destroy)
+
+
+def init_worker(endpoint, home, verbose, setup):
+    os.environ["NIXOPS_GCP_API_ENDPOINT"] = endpoint
+    # the known hosts entries of the fake machines go here, not to ~/.ssh
+    os.environ["HOME"] = home
+    if not verbose:
+        sys.stderr = open(os.devnull, "w")
+    if setup is not None:
+        setup()
+
+
+def run_phase(phase, spec, state_file, uuid):
+    """
+    Run a phase of the deployment and return its uuid and the outcome:
+    the wall time in seconds, the peak RSS of the process in KiB and the
+    traceback if it failed.
+    """
+    started = time.monotonic()
+    error = None
+    try:
+        deployment = SyntheticDeployment(spec, state_file, uuid)
+        uuid = deployment.depl.uuid
+        started = time.monotonic()
+        getattr(deployment, phase.replace("-", "_"))()
+    except Exception:
+        error = traceback.format_exc()
+    return uuid, {
+        "wall_time": round(time.monotonic() - started, 3),
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "error": error,
+    }
+
+
+def run_benchmark(
+    spec, latency=0.0, operation_duration=0.0, verbose=False, worker_setup=None
+):
+    """
+    Run the phases for a deployment of the given spec and return their
+    results, stopping at the first phase which fails. worker_setup, if
+    given, is called in the process of each phase before it runs.
+    """
+    api = FakeGCP(latency, operation_duration)
+    server = FakeGCPServer(api).start()
+    state_dir = tempfile.mkdtemp(prefix="nixops-gcp-benchmark-")
+    state_file = os.path.join(state_dir, "benchmark.nixops")
+    context = multiprocessing.get_context("spawn")
+
+    result = dict(spec, phases={})
+    uuid = None
+    try:
+        for phase in PHASES:
+            calls = api.calls.copy()
+            # each phase runs in a process of its own, as each nixops
+            # command does, starting with empty caches
+            with context.Pool(
+                1,
+                initializer=init_worker,
+                initargs=(server.url, state_dir, verbose, worker_setup),
+            ) as pool:
+                uuid, outcome = pool.apply(run_phase, (phase, spec, state_file, uuid))
+            calls = api.calls - calls
+            outcome["http_calls"] = sum(calls.values())
+            outcome["calls"] = dict(sorted(calls.items()))
+            result["phases"][phase] = outcome
+            print(
+                "{0} machines: {1} took {2:.1f}s, {3} HTTP calls{4}".format(
+                    spec["machines"],
+                    phase,
+                    outcome["wall_time"],
+                    outcome["http_calls"],
+                    "; failed" if outcome["error"] else "",
+                ),
+                file=sys.stderr,
+            )
+            if outcome["error"]:
+                break
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+        server.shutdown()
+        server.server_close()
+    return result
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+# Recording and replaying of GCE and GSE API traffic.
+#
+# With $NIXOPS_GCP_CASSETTE set and $NIXOPS_GCP_CASSETTE_MODE=record, every
+# request the plugin's connections make and the response it got are written
+# to that cassette file when the command exits; OAuth token exchanges are
+# not. With $NIXOPS_GCP_CASSETTE_MODE=replay (the default), the responses
+# are served from the cassette instead, without network access or
+# credentials, so that a recorded deploy can be rerun as a reproducible
+# performance test. Each response is delayed by the time it originally took
+# times $NIXOPS_GCP_REPLAY_SCALE (1 if unset; 0 replays as fast as
+# possible). Cassettes are JSON lines, gzipped if the name ends in .gz.
+
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from libcloud.http import LibcloudConnection
+
+# headers of responses which are kept, the ones the plugin looks at
+RECORDED_HEADERS = {"content-type", "retry-after"}
+
+# parts of request bodies which differ between runs, e.g. the boundary
+# of a batch request
+VOLATILE = re.compile(r"batch_[0-9a-f]{32}")
+
+# served for operation waits missing from a cassette, e.g. one recorded
+# while operations were polled, so that they are polled on replay too
+MISSING_WAIT_ENDPOINT = {
+    "status": 404,
+    "reason": "Not Found",
+    "headers": {"content-type": "application/json"},
+    "response": json.dumps(
+        {
+            "error": {
+                "code": 404,
+                "message": "The wait endpoint was not recorded",
+                "errors": [{"domain": "global", "reason": "notFound"}],
+            }
+        }
+    ),
+}
+
+
+def body_digest(body):
+    if not body:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    return hashlib.sha1(VOLATILE.sub("", body).encode()).hexdigest()
+
+
+def _open(path, mode, compressed):
+    if compressed:
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+
+class ReplayedResponse(object):
+    """A recorded response, looking like the requests one libcloud reads."""
+
+    def __init__(self, interaction):
+        self.status_code = interaction["status"]
+        self.reason = interaction["reason"]
+        self.headers = interaction["headers"]
+        self.text = interaction["response"]
+        self.content = self.text.encode()
+        self.request = None
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class Cassette(object):
+    """
+    Interactions with the API in the order they were made.
+
+    On replay, a request gets the first unused response recorded for the
+    same method and URL, preferring one whose request had the same body.
+    Concurrent requests may be made in another order than they were
+    recorded in, but those for the same URL, e.g. the polls of an
+    operation, come in the recorded order. Once they are used up, the last
+    response is served again. An operation wait which wasn't recorded is
+    answered as if the wait endpoint didn't exist.
+    """
+
+    def __init__(self, path=None, mode=None, scale=None):
+        self._settings = (path, mode, scale)
+        self._configured = False
+        self.started = time.time()
+        self.interactions = []
+        self._by_request = None
+        self._lock = threading.Lock()
+        self._config_lock = threading.Lock()
+
+    def _configure(self):
+        # the settings are read on first use rather than on import, so that
+        # invalid ones fail the first request instead of loading the plugin
+        if self._configured:
+            return
+        with self._config_lock:
+            if self._configured:
+                return
+            path, mode, scale = self._settings
+            path = path or os.environ.get("NIXOPS_GCP_CASSETTE")
+            mode = (
+                (mode or os.environ.get("NIXOPS_GCP_CASSETTE_MODE", "replay"))
+                if path
+                else None
+            )
+            if mode not in (None, "record", "replay"):
+                raise Exception(
+                    "$NIXOPS_GCP_CASSETTE_MODE must be 'record' or 'replay', "
+                    "not '{0}'".format(mode)
+                )
+            if scale is None:
+                try:
+                    scale = float(os.environ.get("NIXOPS_GCP_REPLAY_SCALE", 1))
+                except ValueError:
+                    raise Exception(
+                        "$NIXOPS_GCP_REPLAY_SCALE must be a number, not '{0}'".format(
+                            os.environ["NIXOPS_GCP_REPLAY_SCALE"]
+                        )
+                    )
+            self._path, self._mode, self._scale = path, mode, scale
+            if mode == "record":
+                atexit.register(self.save)
+            self._configured = True
+
+    @property
+    def path(self):
+        self._configure()
+        return self._path
+
+    @property
+    def mode(self):
+        self._configure()
+        return self._mode
+
+    @property
+    def scale(self):
+        self._configure()
+        return self._scale
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def record(self, method, url, body, response, started):
+        interaction = {
+            "at": round(started - self.started, 6),
+            "duration": round(time.time() - started, 6),
+            "method": method.upper(),
+            "url": url,
+            "body": body_digest(body),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {
+                k.lower(): v
+                for k, v in response.headers.items()
+                if k.lower() in RECORDED_HEADERS
+            },
+            "response": response.text,
+        }
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def save(self):
+        with self._lock:
+            interactions = sorted(self.interactions, key=lambda i: i["at"])
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".cassette-")
+        os.close(fd)
+        try:
+            with _open(tmp_path, "w", self.path.endswith(".gz")) as f:
+                for interaction in interactions:
+                    f.write(json.dumps(interaction, separators=(",", ":")) + "\n")
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _load(self):
+        if self._by_request is None:
+            self._by_request = {}
+            with _open(self.path, "r", self.path.endswith(".gz")) as f:
+                for line in f:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        interaction["used"] = False
+                        self._by_request.setdefault(
+                            (interaction["method"], interaction["url"]), []
+                        ).append(interaction)
+        return self._by_request
+
+    def replay(self, method, url, body):
+        """Return the recorded response to a request, after its delay."""
+        digest = body_digest(body)
+        with self._lock:
+            candidates = self._load().get((method.upper(), url))
+            if not candidates and method.upper() == "POST" and url.endswith("/wait"):
+                return ReplayedResponse(MISSING_WAIT_ENDPOINT)
+            if not candidates:
+                raise Exception(
+                    "no response to {0} {1} was recorded in {2}".format(
+                        method.upper(), url, self.path
+                    )
+                )
+            unused = [i for i in candidates if not i["used"]]
+            interaction = next(
+                (i for i in unused if i["body"] == digest),
+                unused[0] if unused else candidates[-1],
+            )
+            interaction["used"] = True
+        if self.scale > 0:
+            time.sleep(interaction["duration"] * self.scale)
+        return ReplayedResponse(interaction)
+
+
+class CassetteConnection(LibcloudConnection):
+    """
+    HTTP connection of the GCE and GSE connections, recording requests to
+    or replaying them from the cassette if one is set.
+    """
+
+    def request(
+        self, method, url, body=None, headers=None, raw=False, stream=False, hooks=None
+    ):
+        if cassette.replaying:
+            self.response = cassette.replay(method, url, body)
+            return
+        started = time.time()
+        super().request(
+            method, url, body=body, headers=headers, raw=raw, stream=stream, hooks=hooks
+        )
+        if cassette.recording:
+            cassette.record(method, url, body, self.response, started)
+
+
+cassette = Cassette()
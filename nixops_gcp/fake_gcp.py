@@ -0,0 +1,1133 @@
+# -*- coding: utf-8 -*-
+
+# In-memory stand-in for the subset of the Compute Engine v1 and Cloud
+# Storage JSON APIs used by nixops-gcp, so that deployments can be run and
+# measured without a Google Cloud project.
+#
+# Start it with
+#
+#     python -m nixops_gcp.fake_gcp --port 8089 --latency 0.05
+#
+# and point nixops at it with NIXOPS_GCP_API_ENDPOINT=http://127.0.0.1:8089.
+# Every request takes --latency seconds. Operations complete after
+# --operation-duration seconds, or after the time --duration TYPE=SECONDS
+# gives for their operation type (insert, delete, setLabels, ...).
+#
+# As with GCE, an operation on an instance is rejected with
+# resourceNotReady while another operation on it is still running.
+#
+# The fake is lenient where the plugin doesn't care: no quotas or
+# permissions are enforced, and public image families always resolve.
+
+import argparse
+import collections
+import datetime
+import hashlib
+import http.server
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+
+API_URL = "https://www.googleapis.com"
+COMPUTE_PATH = "/compute/v1/projects/"
+STORAGE_PATH = "/storage/v1/b"
+BATCH_PATH = "/batch/compute/v1"
+
+# zones of the regions the fake knows about
+REGIONS = {
+    "asia-east1": "abc",
+    "europe-west1": "bcd",
+    "europe-west4": "abc",
+    "us-central1": "abcf",
+    "us-east1": "bcd",
+}
+
+KINDS = {
+    "addresses": "address",
+    "autoscalers": "autoscaler",
+    "disks": "disk",
+    "firewalls": "firewall",
+    "forwardingRules": "forwardingRule",
+    "httpHealthChecks": "httpHealthCheck",
+    "images": "image",
+    "instanceGroupManagers": "instanceGroupManager",
+    "instanceTemplates": "instanceTemplate",
+    "instances": "instance",
+    "networks": "network",
+    "routes": "route",
+    "snapshots": "snapshot",
+    "targetPools": "targetPool",
+}
+
+SCHEDULING = {
+    "automaticRestart": True,
+    "onHostMaintenance": "MIGRATE",
+    "preemptible": False,
+}
+
+
+class ApiError(Exception):
+    def __init__(self, status, reason, message):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    def body(self):
+        return {
+            "error": {
+                "code": self.status,
+                "message": self.message,
+                "errors": [
+                    {"domain": "global", "reason": self.reason, "message": self.message}
+                ],
+            }
+        }
+
+
+def not_found(what):
+    return ApiError(404, "notFound", "The resource '{0}' was not found".format(what))
+
+
+def timestamp(t=None):
+    return (
+        datetime.datetime.utcfromtimestamp(t or time.time()).strftime(
+            "%Y-%m-%dT%H:%M:%S.%f"
+        )[:-3]
+        + "-00:00"
+    )
+
+
+def fingerprint(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()[
+        :16
+    ]
+
+
+def stable_id(name):
+    return str(int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:10], 16))
+
+
+def link_name(url):
+    return url.rstrip("/").rsplit("/", 1)[-1] if url else url
+
+
+def zone_region(zone):
+    return zone.rsplit("-", 1)[0]
+
+
+class FakeGCP(object):
+    """
+    State and request handling of the fake APIs.
+
+    handle() serves one request; the HTTP server and batch requests both
+    go through it. calls counts the requests served by method and
+    collection, e.g. for benchmarks to report.
+    """
+
+    def __init__(self, latency=0.0, operation_duration=0.0, durations=None):
+        self.latency = latency
+        self.operation_duration = operation_duration
+        self.durations = dict(durations or {})
+        self.calls = collections.Counter()
+        self._lock = threading.RLock()
+        # (project, scope, collection) -> {name: resource}; scope is
+        # "global", "zones/<zone>" or "regions/<region>"
+        self._store = collections.defaultdict(dict)
+        self._operations = {}
+        # resource URL -> time its last operation completes
+        self._busy = {}
+        self._buckets = {}
+        self._projects = set()
+        self._ids = itertools.count(1000000)
+        self._addresses = itertools.count(1)
+
+    # requests
+
+    def handle(self, method, path, query, body):
+        """Serve a request and return (status, response body)."""
+        try:
+            if path.startswith(COMPUTE_PATH):
+                project, _, rest = path[len(COMPUTE_PATH) :].partition("/")
+                with self._lock:
+                    return 200, self._compute(method, project, rest, query, body)
+            if path == STORAGE_PATH or path.startswith(STORAGE_PATH + "/"):
+                with self._lock:
+                    return self._storage(method, path[len(STORAGE_PATH) :], query, body)
+            raise not_found(path)
+        except ApiError as e:
+            return e.status, e.body()
+
+    def _count(self, method, collection):
+        self.calls["{0} {1}".format(method, collection)] += 1
+
+    def _link(self, project, scope, collection=None, name=None):
+        parts = [API_URL + COMPUTE_PATH + project, scope]
+        if collection:
+            parts.append(collection)
+        if name:
+            parts.append(name)
+        return "/".join(p for p in parts if p)
+
+    def _seed(self, project):
+        # every project starts out with its default network
+        if project in self._projects:
+            return
+        self._projects.add(project)
+        self._insert(
+            project,
+            "global",
+            "networks",
+            {"name": "default", "autoCreateSubnetworks": True},
+        )
+
+    def _compute(self, method, project, rest, query, body):
+        self._seed(project)
+        parts = [urllib.parse.unquote(p) for p in rest.split("/") if p]
+        if not parts:
+            raise not_found(project)
+
+        if parts[0] == "aggregated" and len(parts) == 2 and method == "GET":
+            self._count(method, "aggregated/" + parts[1])
+            return self._aggregated(project, parts[1])
+        if parts[0] in ("zones", "regions") and len(parts) <= 2:
+            self._count(method, parts[0])
+            return self._location(project, parts)
+
+        if parts[0] == "global":
+            scope, parts = "global", parts[1:]
+        elif parts[0] in ("zones", "regions") and len(parts) > 2:
+            scope, parts = "/".join(parts[:2]), parts[2:]
+            # resources can only be put in existing zones and regions
+            self._location(project, scope.split("/"))
+        else:
+            raise not_found(rest)
+
+        collection = parts[0]
+        # custom methods are counted separately, e.g. as instances/setLabels
+        if parts[1:2] == ["family"]:
+            self._count(method, "images/family")
+        else:
+            self._count(method, "/".join(parts[:1] + parts[2:3]))
+        if collection == "operations":
+            return self._operation_request(method, project, scope, parts[1:])
+        if collection in ("machineTypes", "diskTypes") and len(parts) == 2:
+            return self._type(project, scope, collection, parts[1])
+        if collection == "images" and len(parts) == 3 and parts[1] == "family":
+            return self._image_family(project, parts[2])
+        if collection not in KINDS:
+            raise not_found(rest)
+
+        if len(parts) == 1:
+            if method == "GET":
+                return self._list(project, scope, collection, query)
+            if method == "POST":
+                return self._insert_request(project, scope, collection, query, body)
+            if method in ("PUT", "PATCH") and collection == "autoscalers":
+                name = query.get("autoscaler") or body.get("name")
+                return self._update(project, scope, collection, name, body, method)
+        elif len(parts) == 2:
+            name = parts[1]
+            if method == "GET":
+                return self._get(project, scope, collection, name)
+            if method == "DELETE":
+                return self._delete(project, scope, collection, name)
+            if method in ("PUT", "PATCH"):
+                return self._update(project, scope, collection, name, body, method)
+        elif len(parts) == 3 and method == "POST":
+            return self._custom(
+                project, scope, collection, parts[1], parts[2], query, body
+            )
+        raise ApiError(
+            400, "invalid", "{0} {1} is not supported by the fake".format(method, rest)
+        )
+
+    # zones, regions and types
+
+    def _location(self, project, parts):
+        kind = parts[0]
+        if kind == "zones":
+            names = [r + "-" + z for r in sorted(REGIONS) for z in REGIONS[r]]
+        else:
+            names = sorted(REGIONS)
+
+        def location(name):
+            item = {
+                "kind": "compute#" + kind[:-1],
+                "id": stable_id(name),
+                "name": name,
+                "status": "UP",
+                "selfLink": self._link(project, kind, None, name),
+            }
+            if kind == "zones":
+                item["region"] = self._link(project, "regions", None, zone_region(name))
+            else:
+                item["zones"] = [
+                    self._link(project, "zones", None, name + "-" + z)
+                    for z in REGIONS[name]
+                ]
+            return item
+
+        if len(parts) == 1:
+            return {
+                "kind": "compute#{0}List".format(kind[:-1]),
+                "items": [location(n) for n in names],
+            }
+        if parts[1] not in names:
+            raise not_found("projects/{0}/{1}/{2}".format(project, kind, parts[1]))
+        return location(parts[1])
+
+    def _type(self, project, scope, collection, name):
+        item = {
+            "kind": "compute#" + collection[:-1],
+            "id": stable_id(name),
+            "name": name,
+            "zone": scope.split("/")[-1],
+            "selfLink": self._link(project, scope, collection, name),
+        }
+        if collection == "machineTypes":
+            item.update(guestCpus=1, memoryMb=3840, description=name)
+        return item
+
+    # operations
+
+    def _operation(self, project, scope, op_type, target_link):
+        duration = self.durations.get(op_type, self.operation_duration)
+        name = "operation-{0}".format(uuid.uuid4().hex)
+        operation = {
+            "kind": "compute#operation",
+            "id": str(next(self._ids)),
+            "name": name,
+            "operationType": op_type,
+            "targetLink": target_link,
+            "status": "RUNNING" if duration > 0 else "DONE",
+            "progress": 0 if duration > 0 else 100,
+            "insertTime": timestamp(),
+            "selfLink": self._link(project, scope, "operations", name),
+        }
+        if scope != "global":
+            operation[scope.split("/")[0][:-1]] = self._link(
+                project, scope.split("/")[0], None, scope.split("/")[1]
+            )
+        self._operations[(project, scope, name)] = (
+            operation,
+            time.time() + duration,
+        )
+        self._busy[target_link] = time.time() + duration
+        return dict(operation)
+
+    def _operation_state(self, project, scope, name):
+        try:
+            operation, done_at = self._operations[(project, scope, name)]
+        except KeyError:
+            raise not_found(
+                "projects/{0}/{1}/operations/{2}".format(project, scope, name)
+            )
+        if operation["status"] != "DONE" and time.time() >= done_at:
+            operation.update(status="DONE", progress=100, endTime=timestamp())
+        return operation, done_at
+
+    def _operation_request(self, method, project, scope, parts):
+        if len(parts) == 1 and method == "GET":
+            return dict(self._operation_state(project, scope, parts[0])[0])
+        if len(parts) == 2 and parts[1] == "wait" and method == "POST":
+            # like the API, wait for at most about two minutes
+            operation, done_at = self._operation_state(project, scope, parts[0])
+            delay = min(done_at - time.time(), 120)
+            if delay > 0:
+                self._lock.release()
+                try:
+                    time.sleep(delay)
+                finally:
+                    self._lock.acquire()
+            return dict(self._operation_state(project, scope, parts[0])[0])
+        raise not_found("/".join(parts))
+
+    # generic resources
+
+    def _items(self, project, scope, collection):
+        return self._store[(project, scope, collection)]
+
+    def _find(self, project, scope, collection, name):
+        try:
+            return self._items(project, scope, collection)[name]
+        except KeyError:
+            raise not_found(
+                "projects/{0}/{1}/{2}/{3}".format(project, scope, collection, name)
+            )
+
+    def _link_parts(self, project, url):
+        """
+        Return the project and path components of a full or partial URL,
+        which is relative to project if it names none.
+        """
+        path = "/" + urllib.parse.urlsplit(url).path.strip("/")
+        if "/projects/" in path:
+            project, _, path = path.split("/projects/", 1)[1].partition("/")
+        return project, path.strip("/").split("/")
+
+    def _find_link(self, project, url, collection):
+        """Return the resource a full or partial URL refers to."""
+        project, parts = self._link_parts(project, url)
+        if len(parts) < 3 or parts[-2] != collection:
+            raise ApiError(400, "invalid", "Invalid value for field: '{0}'".format(url))
+        return self._find(project, "/".join(parts[:-2]), collection, parts[-1])
+
+    def _get(self, project, scope, collection, name):
+        return self._find(project, scope, collection, name)
+
+    def _list(self, project, scope, collection, query):
+        items = list(self._items(project, scope, collection).values())
+        if query.get("filter"):
+            items = [i for i in items if matches(query["filter"], i)]
+        start = int(query.get("pageToken") or 0)
+        count = int(query.get("maxResults") or 500)
+        result = {
+            "kind": "compute#{0}List".format(KINDS[collection]),
+            "items": items[start : start + count],
+        }
+        if start + count < len(items):
+            result["nextPageToken"] = str(start + count)
+        return result
+
+    def _aggregated(self, project, collection):
+        items = {}
+        for (p, scope, c), resources in sorted(self._store.items()):
+            if p == project and c == collection and resources:
+                items[scope] = {collection: list(resources.values())}
+        return {
+            "kind": "compute#{0}AggregatedList".format(KINDS.get(collection, "")),
+            "items": items,
+        }
+
+    def _insert_request(self, project, scope, collection, query, body):
+        if not body.get("name"):
+            raise ApiError(
+                400, "required", "Required field 'resource.name' not specified"
+            )
+        if collection == "disks" and query.get("sourceImage"):
+            body = dict(body, sourceImage=query["sourceImage"])
+        resource = self._insert(project, scope, collection, body)
+        return self._operation(project, scope, "insert", resource["selfLink"])
+
+    def _insert(self, project, scope, collection, body):
+        items = self._items(project, scope, collection)
+        name = body["name"]
+        if name in items:
+            raise ApiError(
+                409,
+                "alreadyExists",
+                "The resource 'projects/{0}/{1}/{2}/{3}' already exists".format(
+                    project, scope, collection, name
+                ),
+            )
+        resource = dict(body)
+        resource.update(
+            kind="compute#" + KINDS[collection],
+            id=str(next(self._ids)),
+            creationTimestamp=timestamp(),
+            selfLink=self._link(project, scope, collection, name),
+        )
+        if scope != "global":
+            kind, location = scope.split("/")
+            resource[kind[:-1]] = self._link(project, kind, None, location)
+        prepare = getattr(self, "_prepare_" + collection, None)
+        if prepare is not None:
+            prepare(project, scope, resource)
+        items[name] = resource
+        return resource
+
+    def _update(self, project, scope, collection, name, body, method):
+        resource = self._find(project, scope, collection, name)
+        if method == "PUT":
+            kept = {
+                k: resource[k]
+                for k in (
+                    "kind",
+                    "id",
+                    "creationTimestamp",
+                    "selfLink",
+                    "zone",
+                    "region",
+                )
+                if k in resource
+            }
+            resource.clear()
+            resource.update(kept)
+        resource.update({k: v for k, v in body.items() if k not in ("id", "selfLink")})
+        return self._operation(project, scope, "update", resource["selfLink"])
+
+    def _delete(self, project, scope, collection, name):
+        resource = self._find(project, scope, collection, name)
+        cleanup = getattr(self, "_delete_" + collection, None)
+        if cleanup is not None:
+            cleanup(project, scope, resource)
+        del self._items(project, scope, collection)[name]
+        return self._operation(project, scope, "delete", resource["selfLink"])
+
+    def _custom(self, project, scope, collection, name, verb, query, body):
+        resource = self._find(project, scope, collection, name)
+        handler = getattr(self, "_{0}_{1}".format(collection, verb), None)
+        if handler is None and verb == "setLabels":
+            handler = self._set_labels
+        if handler is None:
+            raise ApiError(
+                400,
+                "invalid",
+                "{0}/{1} is not supported by the fake".format(collection, verb),
+            )
+        if collection == "instances":
+            self._require_idle(resource)
+        handler(project, scope, resource, query, body)
+        return self._operation(project, scope, verb, resource["selfLink"])
+
+    def _require_idle(self, resource):
+        if self._busy.get(resource["selfLink"], 0) > time.time():
+            raise ApiError(
+                400,
+                "resourceNotReady",
+                "The resource '{0}' is not ready".format(resource["selfLink"]),
+            )
+
+    def _set_labels(self, project, scope, resource, query, body):
+        if body.get("labelFingerprint") != resource.get("labelFingerprint"):
+            raise ApiError(
+                412,
+                "conditionNotMet",
+                "Labels fingerprint either invalid or resource labels have changed",
+            )
+        resource["labels"] = dict(body.get("labels") or {})
+        resource["labelFingerprint"] = fingerprint(resource["labels"])
+
+    # per-collection defaults and methods
+
+    def _init_labels(self, resource):
+        resource.setdefault("labels", {})
+        resource["labelFingerprint"] = fingerprint(resource["labels"])
+
+    def _prepare_networks(self, project, scope, resource):
+        resource.setdefault("autoCreateSubnetworks", False)
+        resource.setdefault("routingConfig", {"routingMode": "REGIONAL"})
+
+    def _prepare_firewalls(self, project, scope, resource):
+        network = resource.get("network") or "global/networks/default"
+        resource["network"] = self._link(
+            project, "global", "networks", link_name(network)
+        )
+        resource.setdefault("direction", "INGRESS")
+        resource.setdefault("priority", 1000)
+
+    def _prepare_addresses(self, project, scope, resource):
+        n = next(self._addresses)
+        resource.setdefault(
+            "address", "203.0.{0}.{1}".format(113 + n // 250, n % 250 + 1)
+        )
+        resource.update(status="RESERVED", users=[])
+
+    def _prepare_images(self, project, scope, resource):
+        resource.setdefault("diskSizeGb", "10")
+        resource.update(status="READY", sourceType="RAW", archiveSizeBytes="0")
+        self._init_labels(resource)
+
+    def _image_family(self, project, family):
+        images = [
+            i
+            for i in self._items(project, "global", "images").values()
+            if i.get("family") == family and not i.get("deprecated")
+        ]
+        if images:
+            return max(images, key=lambda i: i["creationTimestamp"])
+        # image families of other projects, e.g. public images, always
+        # resolve to an image made up on the spot
+        return self._insert(
+            project,
+            "global",
+            "images",
+            {"name": "{0}-v{1}".format(family, next(self._ids)), "family": family},
+        )
+
+    def _prepare_disks(self, project, scope, resource):
+        size = resource.get("sizeGb")
+        if resource.get("sourceSnapshot"):
+            snapshot = self._find_link(project, resource["sourceSnapshot"], "snapshots")
+            resource["sourceSnapshotId"] = snapshot["id"]
+            size = size or snapshot["diskSizeGb"]
+        elif resource.get("sourceImage"):
+            image = self._image(project, resource["sourceImage"])
+            resource["sourceImage"] = image["selfLink"]
+            resource["sourceImageId"] = image["id"]
+            size = size or image["diskSizeGb"]
+        resource["sizeGb"] = str(size or 10)
+        resource["type"] = self._link(
+            project,
+            scope,
+            "diskTypes",
+            link_name(resource.get("type")) or "pd-standard",
+        )
+        resource.update(status="READY", users=[])
+        self._init_labels(resource)
+
+    def _image(self, project, url):
+        image_project, parts = self._link_parts(project, url)
+        if parts[-2:-1] == ["family"]:
+            return self._image_family(image_project, parts[-1])
+        return self._find_link(project, url, "images")
+
+    def _disks_createSnapshot(self, project, scope, disk, query, body):
+        self._insert(
+            project,
+            "global",
+            "snapshots",
+            dict(
+                body,
+                sourceDisk=disk["selfLink"],
+                sourceDiskId=disk["id"],
+                diskSizeGb=disk["sizeGb"],
+            ),
+        )
+
+    def _prepare_snapshots(self, project, scope, snapshot):
+        snapshot.setdefault("description", "")
+        snapshot.update(
+            storageBytes="0", storageBytesStatus="UP_TO_DATE", status="READY"
+        )
+        self._init_labels(snapshot)
+
+    def _disks_resize(self, project, scope, disk, query, body):
+        disk["sizeGb"] = str(body["sizeGb"])
+
+    def _delete_disks(self, project, scope, disk):
+        if disk.get("users"):
+            raise ApiError(
+                400,
+                "resourceInUseByAnotherResource",
+                "The disk resource '{0}' is already being used by '{1}'".format(
+                    disk["selfLink"], disk["users"][0]
+                ),
+            )
+
+    def _prepare_instances(self, project, scope, instance):
+        instance["machineType"] = self._link(
+            project, scope, "machineTypes", link_name(instance.get("machineType"))
+        )
+        instance["status"] = "RUNNING"
+        instance.setdefault("canIpForward", False)
+        instance.setdefault("serviceAccounts", [])
+        instance["scheduling"] = dict(SCHEDULING, **instance.get("scheduling", {}))
+        tags = instance.get("tags") or {}
+        instance["tags"] = {"items": tags.get("items", [])}
+        instance["tags"]["fingerprint"] = fingerprint(instance["tags"]["items"])
+        metadata = instance.get("metadata") or {}
+        instance["metadata"] = {
+            "kind": "compute#metadata",
+            "items": metadata.get("items", []),
+        }
+        instance["metadata"]["fingerprint"] = fingerprint(instance["metadata"]["items"])
+        self._init_labels(instance)
+
+        interfaces = []
+        for i, nic in enumerate(instance.get("networkInterfaces") or [{}]):
+            nic = dict(nic)
+            nic["name"] = "nic{0}".format(i)
+            nic["network"] = self._link(
+                project,
+                "global",
+                "networks",
+                link_name(nic.get("network")) or "default",
+            )
+            nic["networkIP"] = "10.128.{0}.{1}".format(
+                int(instance["id"]) // 250 % 250, int(instance["id"]) % 250 + 2
+            )
+            nic["accessConfigs"] = [
+                self._access_config(project, scope, c)
+                for c in nic.get("accessConfigs", [])
+            ]
+            interfaces.append(nic)
+        instance["networkInterfaces"] = interfaces
+
+        disks = []
+        for i, attached in enumerate(instance.get("disks") or []):
+            attached = dict(attached)
+            params = attached.pop("initializeParams", None)
+            if params is not None:
+                disk = self._insert(
+                    project,
+                    scope,
+                    "disks",
+                    {
+                        "name": params.get("diskName") or instance["name"],
+                        "sizeGb": params.get("diskSizeGb"),
+                        "sourceImage": params.get("sourceImage"),
+                        "type": params.get("diskType"),
+                    },
+                )
+                attached["source"] = disk["selfLink"]
+            disks.append(self._attach(instance, attached, i))
+        instance["disks"] = disks
+
+    def _access_config(self, project, scope, config):
+        config = dict(config)
+        config.setdefault("name", "External NAT")
+        config.setdefault("type", "ONE_TO_ONE_NAT")
+        config["kind"] = "compute#accessConfig"
+        if not config.get("natIP"):
+            n = next(self._addresses)
+            config["natIP"] = "198.51.{0}.{1}".format(100 + n // 250, n % 250 + 1)
+        return config
+
+    def _attach(self, instance, attached, index):
+        disk = self._find_link(self._scope_of(instance)[0], attached["source"], "disks")
+        disk["users"] = disk.get("users", []) + [instance["selfLink"]]
+        attached.update(
+            kind="compute#attachedDisk",
+            source=disk["selfLink"],
+            index=index,
+            type=attached.get("type", "PERSISTENT"),
+            mode=attached.get("mode", "READ_WRITE"),
+            boot=attached.get("boot", index == 0),
+            autoDelete=attached.get("autoDelete", False),
+            deviceName=attached.get("deviceName") or disk["name"],
+        )
+        return attached
+
+    def _detach(self, instance, attached):
+        try:
+            disk = self._find_link(
+                self._scope_of(instance)[0], attached["source"], "disks"
+            )
+        except ApiError:
+            return
+        disk["users"] = [u for u in disk.get("users", []) if u != instance["selfLink"]]
+        if attached.get("autoDelete"):
+            del self._items(*self._scope_of(disk), "disks")[disk["name"]]
+
+    def _scope_of(self, resource):
+        parts = urllib.parse.urlsplit(resource["selfLink"]).path.split("/")
+        # /compute/v1/projects/<project>/<scope...>/<collection>/<name>
+        return parts[4], "/".join(parts[5:-2])
+
+    def _delete_instances(self, project, scope, instance):
+        for attached in instance["disks"]:
+            self._detach(instance, attached)
+
+    def _instances_attachDisk(self, project, scope, instance, query, body):
+        instance["disks"].append(
+            self._attach(instance, dict(body), len(instance["disks"]))
+        )
+
+    def _instances_detachDisk(self, project, scope, instance, query, body):
+        device = query.get("deviceName")
+        attached = [d for d in instance["disks"] if d["deviceName"] == device]
+        if not attached:
+            raise ApiError(
+                400,
+                "invalid",
+                "No attached disk found with device name '{0}'".format(device),
+            )
+        self._detach(instance, attached[0])
+        instance["disks"] = [d for d in instance["disks"] if d["deviceName"] != device]
+
+    def _instances_setMetadata(self, project, scope, instance, query, body):
+        if body.get("fingerprint") != instance["metadata"]["fingerprint"]:
+            raise ApiError(
+                412,
+                "conditionNotMet",
+                "Supplied fingerprint does not match current metadata fingerprint",
+            )
+        items = body.get("items", [])
+        instance["metadata"] = {
+            "kind": "compute#metadata",
+            "items": items,
+            "fingerprint": fingerprint(items),
+        }
+
+    def _instances_setTags(self, project, scope, instance, query, body):
+        if body.get("fingerprint") != instance["tags"]["fingerprint"]:
+            raise ApiError(
+                412,
+                "conditionNotMet",
+                "Supplied fingerprint does not match current tags fingerprint",
+            )
+        items = body.get("items", [])
+        instance["tags"] = {"items": items, "fingerprint": fingerprint(items)}
+
+    def _instances_setScheduling(self, project, scope, instance, query, body):
+        # unset fields are reset to their defaults, as with the real API
+        instance["scheduling"] = dict(SCHEDULING, **body)
+
+    def _instances_setMachineType(self, project, scope, instance, query, body):
+        self._require_stopped(instance)
+        instance["machineType"] = self._link(
+            project, scope, "machineTypes", link_name(body["machineType"])
+        )
+
+    def _instances_setServiceAccount(self, project, scope, instance, query, body):
+        self._require_stopped(instance)
+        instance["serviceAccounts"] = [dict(body)]
+
+    def _require_stopped(self, instance):
+        if instance["status"] != "TERMINATED":
+            raise ApiError(
+                400,
+                "resourceNotReady",
+                "The resource '{0}' is not ready".format(instance["selfLink"]),
+            )
+
+    def _instances_start(self, project, scope, instance, query, body):
+        instance["status"] = "RUNNING"
+
+    def _instances_stop(self, project, scope, instance, query, body):
+        instance["status"] = "TERMINATED"
+
+    def _instances_reset(self, project, scope, instance, query, body):
+        instance["status"] = "RUNNING"
+
+    def _nic(self, instance, query):
+        name = query.get("networkInterface", "nic0")
+        for nic in instance["networkInterfaces"]:
+            if nic["name"] == name:
+                return nic
+        raise ApiError(400, "invalid", "Invalid network interface '{0}'".format(name))
+
+    def _instances_addAccessConfig(self, project, scope, instance, query, body):
+        nic = self._nic(instance, query)
+        nic["accessConfigs"] = nic.get("accessConfigs", []) + [
+            self._access_config(project, scope, body)
+        ]
+
+    def _instances_deleteAccessConfig(self, project, scope, instance, query, body):
+        nic = self._nic(instance, query)
+        nic["accessConfigs"] = [
+            c
+            for c in nic.get("accessConfigs", [])
+            if c["name"] != query.get("accessConfig")
+        ]
+
+    def _prepare_targetPools(self, project, scope, pool):
+        pool.setdefault("instances", [])
+        pool.setdefault("healthChecks", [])
+        pool.setdefault("sessionAffinity", "NONE")
+
+    def _targetPools_addInstance(self, project, scope, pool, query, body):
+        for i in body["instances"]:
+            link = self._find_link(project, i["instance"], "instances")["selfLink"]
+            if link not in pool["instances"]:
+                pool["instances"].append(link)
+
+    def _targetPools_removeInstance(self, project, scope, pool, query, body):
+        links = {link_name(i["instance"]) for i in body["instances"]}
+        pool["instances"] = [i for i in pool["instances"] if link_name(i) not in links]
+
+    def _targetPools_addHealthCheck(self, project, scope, pool, query, body):
+        for h in body["healthChecks"]:
+            link = self._find_link(project, h["healthCheck"], "httpHealthChecks")
+            if link["selfLink"] not in pool["healthChecks"]:
+                pool["healthChecks"].append(link["selfLink"])
+
+    def _targetPools_removeHealthCheck(self, project, scope, pool, query, body):
+        names = {link_name(h["healthCheck"]) for h in body["healthChecks"]}
+        pool["healthChecks"] = [
+            h for h in pool["healthChecks"] if link_name(h) not in names
+        ]
+
+    def _prepare_httpHealthChecks(self, project, scope, check):
+        for k, v in [
+            ("port", 80),
+            ("requestPath", "/"),
+            ("checkIntervalSec", 5),
+            ("timeoutSec", 5),
+            ("unhealthyThreshold", 2),
+            ("healthyThreshold", 2),
+        ]:
+            if check.get(k) is None:
+                check[k] = v
+
+    def _prepare_forwardingRules(self, project, scope, rule):
+        if not rule.get("IPAddress"):
+            n = next(self._addresses)
+            rule["IPAddress"] = "192.0.2.{0}".format(n % 250 + 1)
+        rule.setdefault("IPProtocol", "TCP")
+
+    def _forwardingRules_setTarget(self, project, scope, rule, query, body):
+        rule["target"] = body["target"]
+
+    def _prepare_routes(self, project, scope, route):
+        route.setdefault("priority", 1000)
+        route["network"] = self._link(
+            project, "global", "networks", link_name(route.get("network")) or "default"
+        )
+
+    def _prepare_instanceGroupManagers(self, project, scope, manager):
+        manager["instanceGroup"] = self._link(
+            project, scope, "instanceGroups", manager["name"]
+        )
+        manager.setdefault("targetPools", [])
+        manager["currentActions"] = {"none": manager.get("targetSize", 0)}
+
+    def _instanceGroupManagers_resize(self, project, scope, manager, query, body):
+        manager["targetSize"] = int(query["size"])
+        manager["currentActions"] = {"none": manager["targetSize"]}
+
+    def _instanceGroupManagers_setInstanceTemplate(
+        self, project, scope, manager, query, body
+    ):
+        manager["instanceTemplate"] = body["instanceTemplate"]
+
+    def _instanceGroupManagers_setTargetPools(
+        self, project, scope, manager, query, body
+    ):
+        manager["targetPools"] = list(body.get("targetPools", []))
+
+    # storage
+
+    def _storage(self, method, rest, query, body):
+        name = urllib.parse.unquote(rest.strip("/"))
+        self._count(method, "buckets")
+        if not name:
+            if method == "POST":
+                if body.get("name") in self._buckets:
+                    raise ApiError(
+                        409,
+                        "conflict",
+                        "You already own this bucket. Please select another name.",
+                    )
+                bucket = dict(body)
+                bucket.update(
+                    kind="storage#bucket",
+                    id=body["name"],
+                    selfLink=API_URL + STORAGE_PATH + "/" + body["name"],
+                    projectNumber=stable_id(query.get("project", "")),
+                    timeCreated=timestamp(),
+                    updated=timestamp(),
+                    metageneration="1",
+                )
+                bucket["location"] = (bucket.get("location") or "US").upper()
+                bucket.setdefault("storageClass", "STANDARD")
+                self._buckets[body["name"]] = bucket
+                return 200, bucket
+            if method == "GET":
+                return 200, {
+                    "kind": "storage#buckets",
+                    "items": list(self._buckets.values()),
+                }
+        elif name in self._buckets:
+            bucket = self._buckets[name]
+            if method == "GET":
+                return 200, bucket
+            if method == "DELETE":
+                del self._buckets[name]
+                return 204, None
+            if method in ("PATCH", "PUT"):
+                if method == "PUT":
+                    bucket = {
+                        k: bucket[k]
+                        for k in (
+                            "kind",
+                            "id",
+                            "selfLink",
+                            "projectNumber",
+                            "timeCreated",
+                        )
+                    }
+                bucket.update(body)
+                bucket["updated"] = timestamp()
+                bucket["metageneration"] = str(
+                    int(self._buckets[name]["metageneration"]) + 1
+                )
+                self._buckets[name] = bucket
+                return 200, bucket
+        else:
+            raise ApiError(404, "notFound", "Not Found")
+        raise ApiError(
+            400, "invalid", "{0} is not supported by the fake".format(method)
+        )
+
+
+def matches(expression, resource):
+    """Whether a resource matches a list filter like 'name eq "web-.*"'."""
+    m = re.match(r'^\s*(\w+)\s+(eq|ne)\s+"?(.*?)"?\s*$', expression)
+    if m is None:
+        raise ApiError(
+            400, "invalid", "Invalid list filter expression '{0}'".format(expression)
+        )
+    field, op, pattern = m.groups()
+    found = re.fullmatch(pattern, str(resource.get(field, ""))) is not None
+    return found if op == "eq" else not found
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        api = self.server.api
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if api.latency:
+            time.sleep(api.latency)
+
+        if url.path == BATCH_PATH and method == "POST":
+            api.calls["POST batch"] += 1
+            try:
+                boundary, body = serve_batch(
+                    api, raw.decode("utf-8"), self.headers.get("Content-Type", "")
+                )
+            except ApiError as e:
+                self.respond(e.status, json.dumps(e.body()), "application/json")
+            else:
+                self.respond(200, body, "multipart/mixed; boundary=" + boundary)
+            return
+
+        try:
+            body = json.loads(raw.decode("utf-8")) if raw.strip() else {}
+        except ValueError:
+            status, body = 400, ApiError(400, "parseError", "Parse Error").body()
+        else:
+            status, body = api.handle(method, url.path, query, body)
+        self.respond(
+            status,
+            json.dumps(body) if body is not None else "",
+            "application/json; charset=UTF-8",
+        )
+
+    def respond(self, status, body, content_type):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_batch(api, body, content_type):
+    """Serve the calls of a batch request; return the response boundary and body."""
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if match is None:
+        raise ApiError(400, "invalid", "batch request is not multipart")
+    boundary = "batch_" + uuid.uuid4().hex
+    parts = []
+    for part in body.split("--" + match.group(1)):
+        part = part.strip()
+        if not part or part == "--":
+            continue
+        # part headers, then the request line and headers, then the body
+        sections = re.split(r"\r?\n\r?\n", part, maxsplit=2) + [""]
+        content_id = re.search(r"Content-ID:\s*<([^>]*)>", sections[0], re.I)
+        method, target = sections[1].split()[:2]
+        url = urllib.parse.urlsplit(target)
+        try:
+            data = json.loads(sections[2]) if sections[2].strip() else {}
+            status, result = api.handle(
+                method, url.path, dict(urllib.parse.parse_qsl(url.query)), data
+            )
+        except ValueError:
+            status, result = 400, ApiError(400, "parseError", "Parse Error").body()
+        parts.append(
+            "--{0}\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-ID: <response-{1}>\r\n"
+            "\r\n"
+            "HTTP/1.1 {2} {3}\r\n"
+            "Content-Type: application/json; charset=UTF-8\r\n"
+            "\r\n"
+            "{4}\r\n".format(
+                boundary,
+                content_id.group(1) if content_id else "",
+                status,
+                http.server.BaseHTTPRequestHandler.responses.get(status, ("",))[0],
+                json.dumps(result) if result is not None else "",
+            )
+        )
+    parts.append("--{0}--\r\n".format(boundary))
+    return boundary, "".join(parts)
+
+
+class FakeGCPServer(http.server.ThreadingHTTPServer):
+    """HTTP server for a FakeGCP; port 0 picks a free port."""
+
+    daemon_threads = True
+    # deployments open a connection per resource thread at once
+    request_queue_size = 1024
+
+    def __init__(self, api=None, host="127.0.0.1", port=0, verbose=False):
+        self.api = api or FakeGCP()
+        self.verbose = verbose
+        super().__init__((host, port), RequestHandler)
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(*self.server_address[:2])
+
+    def start(self):
+        """Serve in a background thread and return the server."""
+        threading.Thread(
+            target=self.serve_forever, name="nixops-gcp-fake", daemon=True
+        ).start()
+        return self
+
+
+def parse_duration(value):
+    op_type, _, seconds = value.partition("=")
+    return op_type, float(seconds)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Serve a fake Compute Engine and Cloud Storage API."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds every request takes"
+    )
+    parser.add_argument(
+        "--operation-duration",
+        type=float,
+        default=0.0,
+        help="seconds operations take to complete",
+    )
+    parser.add_argument(
+        "--duration",
+        type=parse_duration,
+        action="append",
+        default=[],
+        metavar="TYPE=SECONDS",
+        help="seconds operations of a type take to complete",
+    )
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(args)
+
+    api = FakeGCP(args.latency, args.operation_duration, dict(args.duration))
+    server = FakeGCPServer(api, args.host, args.port, args.verbose)
+    print("serving on {0}".format(server.url), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,33 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import copy
 import os
 import re
+import threading
+import time
+import urllib.parse
 
 from nixops.util import attr_property
 import nixops.resources
+import nixops.util
 
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
+import libcloud.compute.drivers.gce
 from libcloud.common.google import (
     ResourceNotFoundError,
     GoogleBaseError,
 )
 
+from nixops_gcp.batch import ComputeBatch, instance_inserts
+from nixops_gcp.cassette import CassetteConnection, cassette
+from nixops_gcp.image_cache import gce_images
+from nixops_gcp.inventory import gce_inventories, gce_snapshots
+from nixops_gcp.metrics import api_metrics, current_resource, endpoint_template
+from nixops_gcp.operations import operation_waiter
+from nixops_gcp.throttling import IDEMPOTENT_METHODS, rate_limits, retry_policy
+from nixops_gcp.token_cache import SharedCredential, offline_token_file, token_cache
+from nixops_gcp.tracing import SPAN_KIND_CLIENT, traced_method, tracer
+
 
 def optional_string(elem):
     return elem.get("value") if elem is not None else None
@@ -36,12 +51,290 @@ def ensure_positive(value, name):
         raise Exception("{0} must be a positive integer".format(name))
 
 
+INSTANCE_INSERT = re.compile(r"^/zones/[^/]+/instances$")
+
+
+def instrumented_request(connection, action, method, request):
+    """
+    Return request(), recording it in the API metrics and as a span of
+    the current trace.
+    """
+    path = connection.morph_action_hook(action)
+    started = time.time()
+    failed = True
+    with tracer.span(
+        "{0} {1}".format(method, endpoint_template(path)),
+        SPAN_KIND_CLIENT,
+        **{"http.method": method, "http.target": path}
+    ) as span:
+        try:
+            response = request()
+            failed = False
+            span.set_attribute("http.status_code", response.status)
+            return response
+        finally:
+            api_metrics.record_request(method, path, time.time() - started, failed)
+
+
+class GCEResponse(libcloud.compute.drivers.gce.GCEResponse):
+    def parse_body(self):
+        # batch responses are parsed by nixops_gcp.batch
+        if self.headers.get("content-type", "").startswith("multipart/"):
+            return self.body
+        try:
+            return super().parse_body()
+        except GoogleBaseError as e:
+            # how long a throttled request should wait, see nixops_gcp.throttling
+            e.retry_after = self.headers.get("retry-after")
+            raise
+
+
+class GCEConnection(libcloud.compute.drivers.gce.GCEConnection):
+    """
+    GCE connection which hands the operations it starts to the shared
+    operation waiter instead of polling each one in a fixed-interval loop.
+
+    All requests are rate limited per project and quota, and retried if
+    they are throttled or fail transiently; see nixops_gcp.throttling.
+    Each attempt is recorded by nixops_gcp.metrics and nixops_gcp.tracing,
+    and can be recorded to or replayed from a cassette; see
+    nixops_gcp.cassette.
+    """
+
+    responseCls = GCEResponse
+    conn_class = CassetteConnection
+
+    def request(
+        self,
+        action,
+        params=None,
+        data=None,
+        headers=None,
+        method="GET",
+        quota=None,
+        cost=1,
+        **kwargs
+    ):
+        """
+        Make a request, charging cost tokens of the read or write quota,
+        by default depending on the method.
+        """
+        # waiting for an operation only reads it
+        read_only = method == "GET" or action.endswith("/wait")
+        bucket = rate_limits.bucket(
+            getattr(self, "pool_key", (None,))[0],
+            quota or ("read" if read_only else "write"),
+        )
+
+        def attempt():
+            bucket.acquire(cost)
+            return instrumented_request(
+                self,
+                action,
+                method,
+                lambda: super(GCEConnection, self).request(
+                    action,
+                    params=params,
+                    data=data,
+                    headers=headers,
+                    method=method,
+                    **kwargs
+                ),
+            )
+
+        return retry_policy.call(
+            attempt, read_only or method in IDEMPOTENT_METHODS, bucket
+        )
+
+    def add_default_headers(self, headers):
+        # keep the content type of batch requests
+        content_type = headers.get("Content-Type")
+        headers = super().add_default_headers(headers)
+        if content_type:
+            headers["Content-Type"] = content_type
+        return headers
+
+    def encode_data(self, data):
+        # already encoded, e.g. the body of a batch request
+        if isinstance(data, str):
+            return data
+        return super().encode_data(data)
+
+    def request_filtered_items(self, action, filter_expr, page_size=500):
+        """
+        Return all items of a list call matching the filter expression,
+        following the result pages.
+        """
+        items = []
+        params = {"filter": filter_expr, "maxResults": page_size}
+        while True:
+            response = self.request(action, method="GET", params=params).object
+            items.extend(response.get("items", []))
+            if not response.get("nextPageToken"):
+                return items
+            params["pageToken"] = response["nextPageToken"]
+
+    def resource_url(self, path):
+        """Return the full URL of a resource of the project, e.g. a zone."""
+        # always Google's host, even if requests go to another endpoint
+        return "https://{0}{1}/{2}".format(type(self).host, self.request_path, path)
+
+    def pooled_connection(self):
+        """
+        Return a callable giving the calling thread's connection for the
+        same project and credentials as this one.
+        """
+        key = self.pool_key
+        return lambda: gce_drivers.get(*key).connection
+
+    def batch(self):
+        return ComputeBatch(self)
+
+    def async_request(
+        self, action, params=None, data=None, headers=None, method="GET", context=None
+    ):
+        if (
+            method == "POST"
+            and params is None
+            and instance_inserts.window > 0
+            and INSTANCE_INSERT.match(action)
+        ):
+            # instances created by concurrent threads share a batch request
+            return instance_inserts.call(
+                self, action, data, "GCE machine '{0}'".format(data["name"])
+            )
+        response = self.request(
+            action, params=params, data=data, headers=headers, method=method
+        )
+        return operation_waiter.wait(response, self)
+
+    def submit_request(self, action, params=None, data=None, method="POST"):
+        """
+        Start an operation and return a future resolving to its completed
+        response, so that many operations can be awaited together.
+        """
+        response = self.request(action, params=params, data=data, method=method)
+        return operation_waiter.submit(response, self.pooled_connection())
+
+
+class GCENodeDriver(libcloud.compute.drivers.gce.GCENodeDriver):
+    connectionCls = GCEConnection
+
+
+def api_endpoint():
+    """
+    Return (host, port, secure) of the endpoint $NIXOPS_GCP_API_ENDPOINT
+    points requests at instead of Google's APIs, e.g. a local
+    nixops_gcp.fake_gcp server, or None if it isn't set.
+    """
+    url = os.environ.get("NIXOPS_GCP_API_ENDPOINT")
+    if not url:
+        return None
+    parts = urllib.parse.urlsplit(url)
+    secure = parts.scheme == "https"
+    return parts.hostname, parts.port or (443 if secure else 80), secure
+
+
+def use_api_endpoint(connection, endpoint):
+    connection.host, connection.port, connection.secure = endpoint
+    connection.connection = None
+
+
+class GCEDriverPool(object):
+    """
+    Process-wide registry of GCE drivers keyed by
+    (project, service account, access key path).
+
+    libcloud connections keep per-request state, so each thread gets its
+    own driver; all drivers for a key are cloned from a single authenticated
+    driver and share its credential, so the OAuth token exchange happens
+    once per key instead of once per resource. Tokens are also persisted in
+    the on-disk token cache so later invocations can reuse them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._local = threading.local()
+
+    def get(self, project, service_account, access_key_path):
+        key = (project, service_account, access_key_path)
+        drivers = self._local.__dict__.setdefault("drivers", {})
+        driver = drivers.get(key)
+        if driver is None:
+            driver = self._clone(self._template(key))
+            drivers[key] = driver
+        return driver
+
+    def _template(self, key):
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None:
+                project, service_account, access_key_path = key
+                endpoint = api_endpoint()
+                if endpoint is None and not cassette.replaying:
+                    token_path = token_cache.path(service_account, access_key_path)
+                    with token_cache.locked(token_path):
+                        template = GCENodeDriver(
+                            service_account,
+                            access_key_path,
+                            project=project,
+                            credential_file=token_path,
+                        )
+                    template.connection.oauth2_credential = SharedCredential(
+                        template.connection.oauth2_credential, token_path
+                    )
+                else:
+                    # neither the endpoint nor a replayed cassette checks
+                    # tokens, so don't get one
+                    template = GCENodeDriver(
+                        service_account,
+                        access_key_path,
+                        project=project,
+                        auth_type="IA",
+                        credential_file=offline_token_file(),
+                    )
+                    if endpoint is not None:
+                        use_api_endpoint(template.connection, endpoint)
+                template.connection.pool_key = key
+                self._templates[key] = template
+            return template
+
+    @staticmethod
+    def _clone(template):
+        driver = copy.copy(template)
+        connection = copy.copy(template.connection)
+        # the clone gets its own HTTP connection and request state
+        connection.driver = driver
+        connection.connection = None
+        connection.gce_params = None
+        connection.context = {}
+        connection.connect()
+        driver.connection = connection
+        driver._ex_volume_dict = {}
+        return driver
+
+
+gce_drivers = GCEDriverPool()
+
+
 def retrieve_gce_image(_conn, img):
     """
     Retrieve GCENodeImage based on family or name of the image
     Takes object as imageOptions submodule : {'project', 'name', 'family'}
     Returns the image object to be used for disks creation
+    Resolutions are cached, see nixops_gcp.image_cache
     """
+    if not (img.name or img.family):
+        return _lookup_gce_image(_conn, img)
+    return gce_images.resolve(
+        _conn,
+        (_conn.project, img.project, img.family, img.name),
+        lambda: _lookup_gce_image(_conn, img),
+    )
+
+
+def _lookup_gce_image(_conn, img):
     if img.name or img.family:
         # libcloud expects project to be empty list or a list of projects
         if not img.project:
@@ -156,22 +449,136 @@ class ResourceDefinition(nixops.resources.ResourceDefinition):
             self.access_key_path = self.config.accessKey
 
 
+# lifecycle methods recorded as spans for every resource type
+TRACED_METHODS = [
+    "create",
+    "create_node",
+    "_check",
+    "backup",
+    "restore",
+    "destroy",
+    "after_activation",
+]
+
+
+def _stored_value(value):
+    # the value as the state file returns it, so that attr_property
+    # converts a pending value the same way as a stored one
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
+
+
 class ResourceState(nixops.resources.ResourceState):
 
     project = attr_property("gce.project", None)
     service_account = attr_property("gce.serviceAccount", None)
     access_key_path = attr_property("gce.accessKey", None)
 
+    # pending attribute writes while inside state_batch(), None otherwise
+    _pending_attrs = None
+    _batch_depth = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in TRACED_METHODS:
+            if name in cls.__dict__:
+                setattr(cls, name, traced_method(cls.__dict__[name], name))
+
     def __init__(self, depl, name, id):
         nixops.resources.ResourceState.__init__(self, depl, name, id)
-        self._conn = None
+        self._batch_lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def state_batch(self):
+        """
+        Keep attribute writes in memory and store them in a single
+        transaction when the outermost batch ends, or earlier on
+        flush_state(). Reads within the batch see the pending values.
+        """
+        with self._batch_lock:
+            if not self._batch_depth:
+                self._pending_attrs = {}
+            self._batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._batch_lock:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self.flush_state()
+                    self._pending_attrs = None
+
+    def flush_state(self):
+        with self._batch_lock:
+            if self._pending_attrs:
+                attrs, self._pending_attrs = self._pending_attrs, {}
+                nixops.resources.ResourceState._set_attrs(self, attrs)
+
+    def _get_attr(self, name, default=nixops.util.undefined):
+        with self._batch_lock:
+            if self._pending_attrs is not None and name in self._pending_attrs:
+                value = self._pending_attrs[name]
+                return nixops.util.undefined if value is None else value
+        return super()._get_attr(name, default)
+
+    def _set_attrs(self, attrs):
+        with self._batch_lock:
+            if self._pending_attrs is not None:
+                self._pending_attrs.update(
+                    (k, _stored_value(v)) for k, v in attrs.items()
+                )
+                return
+        super()._set_attrs(attrs)
+
+    def _set_attr(self, name, value):
+        self._set_attrs({name: value})
+
+    def _del_attr(self, name):
+        self._set_attrs({name: None})
 
     def connect(self):
-        if not self._conn:
-            self._conn = get_driver(Provider.GCE)(
-                self.service_account, self.access_key_path, project=self.project
-            )
-        return self._conn
+        # calls made from here on are accounted to this resource
+        current_resource.set(self.name)
+        return gce_drivers.get(self.project, self.service_account, self.access_key_path)
+
+    def inventory(self):
+        """
+        Return the snapshot of instances, disks and addresses of this
+        resource's project, shared by all resources being checked.
+        """
+        return gce_inventories.get(
+            (self.project, self.service_account, self.access_key_path),
+            self.connect(),
+        )
+
+    def inventory_changed(self, kind, name):
+        """
+        Drop an instance, disk or address this resource changed from the
+        inventory snapshot, so that checks see it as it is now.
+        """
+        gce_inventories.forget(
+            (self.project, self.service_account, self.access_key_path), kind, name
+        )
+
+    def snapshot_index(self):
+        """Return the index of this resource's project's backup snapshots."""
+        return gce_snapshots.get(
+            (self.project, self.service_account, self.access_key_path),
+            self.connect(),
+        )
+
+    def snapshots_changed(self):
+        gce_snapshots.invalidate(
+            (self.project, self.service_account, self.access_key_path)
+        )
+
+    def snapshots_removed(self, names):
+        gce_snapshots.forget(
+            (self.project, self.service_account, self.access_key_path), names
+        )
 
     @property
     def credentials_prefix(self):
@@ -314,8 +721,9 @@ class ResourceState(nixops.resources.ResourceState):
     # after resource is created or updated and checking that
     # the state is out of sync with the definition
     def copy_properties(self, defn):
-        for attr in self.defn_properties:
-            setattr(self, attr, getattr(defn, attr))
+        with self.state_batch():
+            for attr in self.defn_properties:
+                setattr(self, attr, getattr(defn, attr))
 
     def properties_changed(self, defn):
         return any(
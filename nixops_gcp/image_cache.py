@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Cache of image and image family resolutions, so that deploying many
+# machines and disks from the same image resolves it once.
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from libcloud.compute.drivers.gce import GCENodeImage
+
+
+class ImageCache(object):
+    """
+    Resolved images keyed by (project, image project, family, name).
+
+    Entries expire after $NIXOPS_GCP_IMAGE_TTL seconds (300 if unset),
+    so that new images of a family are picked up; a TTL of 0 disables the
+    cache. If $NIXOPS_GCP_IMAGE_CACHE_FILE is set, entries are also kept
+    in that file so later invocations can reuse them.
+    """
+
+    def __init__(self, ttl=None, path=None):
+        if ttl is None:
+            ttl = float(os.environ.get("NIXOPS_GCP_IMAGE_TTL", 300))
+        self.ttl = ttl
+        self.path = path or os.environ.get("NIXOPS_GCP_IMAGE_CACHE_FILE")
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._entries = None
+
+    def resolve(self, driver, key, lookup):
+        """
+        Return the image for key, calling lookup() to resolve it if there
+        is no fresh entry.
+        """
+        if self.ttl <= 0:
+            return lookup()
+        key = json.dumps(key)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # machines and disks using the same image wait for one lookup
+        with key_lock:
+            entry = self._load().get(key)
+            if entry is not None and entry["expires"] > time.time():
+                return GCENodeImage(
+                    entry["id"], entry["name"], driver, extra=entry["extra"]
+                )
+            image = lookup()
+            self._store(
+                key,
+                {
+                    "expires": time.time() + self.ttl,
+                    "id": image.id,
+                    "name": image.name,
+                    # licenses are libcloud objects and aren't needed to
+                    # create disks
+                    "extra": {k: v for k, v in image.extra.items() if k != "licenses"},
+                },
+            )
+            return image
+
+    def _load(self):
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._read()
+            return self._entries
+
+    def _read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        now = time.time()
+        return {k: v for k, v in entries.items() if v.get("expires", 0) > now}
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            if not self.path:
+                return
+            # merge with entries written by other invocations meanwhile; if
+            # two write at once one update is lost, which only costs a lookup
+            entries = self._read()
+            entries.update(self._entries)
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".images-")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+
+gce_images = ImageCache()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+# Project-wide snapshots of GCE instances, disks and addresses, so that
+# checking a deployment costs one aggregatedList call per kind and project
+# instead of one GET per resource.
+
+import os
+import re
+import threading
+import time
+
+from libcloud.common.google import ResourceNotFoundError
+
+
+def _location_name(location):
+    # accepts a zone/region name or URL, a libcloud location object or None
+    if location is None:
+        return None
+    return getattr(location, "name", location).split("/")[-1]
+
+
+class Inventory(object):
+    """
+    Instances, disks and addresses of a project indexed by name, then by
+    zone or region name.
+
+    Lookups fall back to a direct GET when a name is not in the snapshot,
+    since the resource may have been created after it was taken, or was
+    forgotten because nixops changed it since.
+    """
+
+    def __init__(self, instances=None, disks=None, addresses=None):
+        self.created = time.time()
+        self.instances = instances or {}
+        self.disks = disks or {}
+        self.addresses = addresses or {}
+
+    def forget(self, kind, name):
+        """Drop a resource from the snapshot, e.g. after changing it."""
+        getattr(self, kind).pop(name, None)
+
+    @classmethod
+    def fetch(cls, driver):
+        return cls(
+            instances=cls._fetch_kind(driver, "instances"),
+            disks=cls._fetch_kind(driver, "disks"),
+            addresses=cls._fetch_kind(driver, "addresses"),
+        )
+
+    @staticmethod
+    def _fetch_kind(driver, kind):
+        index = {}
+        items = driver.connection.request_aggregated_items(kind)["items"]
+        for scope, v in items.items():
+            for item in v.get(kind, []):
+                index.setdefault(item["name"], {})[_location_name(scope)] = item
+        return index
+
+    @staticmethod
+    def _lookup(index, name, location):
+        by_location = index.get(name, {})
+        location = _location_name(location)
+        if location is None:
+            # same as libcloud: pick the first location in sorted order
+            return next((by_location[k] for k in sorted(by_location)), None)
+        return by_location.get(location)
+
+    def node(self, driver, name, zone=None):
+        item = self._lookup(self.instances, name, zone)
+        if item is None:
+            return driver.ex_get_node(name, zone)
+        # libcloud would list the project's disks again to find the boot
+        # disk, so it is resolved from the snapshot here instead
+        node = driver._to_node(dict(item, disks=[]))
+        node.extra["disks"] = list(item.get("disks", []))
+        for disk in node.extra["disks"]:
+            if disk.get("boot") and disk.get("type") == "PERSISTENT":
+                source = disk["source"].split("/")
+                node.extra["boot_disk"] = self.volume(driver, source[-1], source[-3])
+        return node
+
+    def node_url(self, driver, name, zone=None):
+        """Return the URL of the named instance, in any zone by default."""
+        item = self._lookup(self.instances, name, zone)
+        if item is None:
+            return driver.ex_get_node(name, zone or "all").extra["selfLink"]
+        return item["selfLink"]
+
+    def volume(self, driver, name, zone=None):
+        item = self._lookup(self.disks, name, zone)
+        if item is None:
+            return driver.ex_get_volume(name, zone)
+        return driver._to_storage_volume(item)
+
+    def address(self, driver, name, region=None):
+        item = self._lookup(self.addresses, name, region)
+        if item is None:
+            return driver.ex_get_address(name, region)
+        return driver._to_address(item)
+
+
+class InventoryCache(object):
+    """
+    Inventories keyed by (project, service account, access key path),
+    shared by all resources of a command and refreshed after a TTL.
+
+    The TTL defaults to $NIXOPS_GCP_INVENTORY_TTL seconds (60 if unset);
+    a TTL of 0 disables snapshots so every lookup is a direct GET.
+    """
+
+    def __init__(self, ttl=None):
+        if ttl is None:
+            ttl = float(os.environ.get("NIXOPS_GCP_INVENTORY_TTL", 60))
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._inventories = {}
+
+    def get(self, key, driver):
+        if self.ttl <= 0:
+            return Inventory()
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # resources checked in parallel wait for a single fetch
+        with key_lock:
+            inventory = self._inventories.get(key)
+            if inventory is None or time.time() - inventory.created > self.ttl:
+                inventory = Inventory.fetch(driver)
+                self._inventories[key] = inventory
+            return inventory
+
+    def forget(self, key, kind, name):
+        """
+        Make the next lookup of a resource nixops changed a direct GET,
+        instead of reading it from a snapshot taken before the change.
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # a snapshot being fetched may predate the change as well
+        with key_lock:
+            inventory = self._inventories.get(key)
+            if inventory is not None:
+                inventory.forget(kind, name)
+
+    def clear(self):
+        with self._lock:
+            self._inventories = {}
+
+
+gce_inventories = InventoryCache()
+
+
+class SnapshotIndex(object):
+    """
+    Snapshots of a project whose names start with a prefix, indexed by
+    name and fetched with a single filtered, paginated list.
+    """
+
+    def __init__(self, prefix, snapshots=None):
+        self.prefix = prefix
+        self.snapshots = snapshots or {}
+
+    @classmethod
+    def fetch(cls, driver, prefix):
+        items = driver.connection.request_filtered_items(
+            "/global/snapshots", 'name eq "{0}.*"'.format(re.escape(prefix))
+        )
+        return cls(prefix, {item["name"]: item for item in items})
+
+    def status(self, driver, name):
+        """
+        Return the status of the named snapshot, or None if it doesn't
+        exist. Snapshots outside of the prefix are looked up directly.
+        """
+        if not name.startswith(self.prefix):
+            try:
+                return driver.ex_get_snapshot(name).status
+            except ResourceNotFoundError:
+                return None
+        item = self.snapshots.get(name)
+        return item["status"] if item is not None else None
+
+    def snapshot(self, driver, name):
+        """Return the named snapshot, or None if it doesn't exist."""
+        if not name.startswith(self.prefix):
+            try:
+                return driver.ex_get_snapshot(name)
+            except ResourceNotFoundError:
+                return None
+        item = self.snapshots.get(name)
+        return driver._to_snapshot(item) if item is not None else None
+
+    def forget(self, name):
+        self.snapshots.pop(name, None)
+
+
+class SnapshotIndexCache(object):
+    """
+    Snapshot indexes keyed like InventoryCache.
+
+    By default every get() lists the snapshots again. When
+    $NIXOPS_GCP_CACHE_SNAPSHOTS is set to a non-zero value, an index is
+    kept for the lifetime of the command. It is dropped when nixops
+    creates snapshots of that project itself, and the snapshots nixops
+    deletes are dropped from it.
+    """
+
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.environ.get("NIXOPS_GCP_CACHE_SNAPSHOTS", "0") not in ("", "0")
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._indexes = {}
+
+    def get(self, key, driver, prefix="backup-"):
+        if not self.enabled:
+            return SnapshotIndex.fetch(driver, prefix)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            index = self._indexes.get((key, prefix))
+            if index is None:
+                index = SnapshotIndex.fetch(driver, prefix)
+                self._indexes[(key, prefix)] = index
+            return index
+
+    def invalidate(self, key):
+        with self._lock:
+            self._indexes = {k: v for k, v in self._indexes.items() if k[0] != key}
+
+    def forget(self, key, names):
+        with self._lock:
+            indexes = [v for k, v in self._indexes.items() if k[0] == key]
+        for index in indexes:
+            for name in names:
+                index.forget(name)
+
+
+gce_snapshots = SnapshotIndexCache()
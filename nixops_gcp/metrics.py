@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+# Accounting of GCE and GSE API calls.
+#
+# Every HTTP request made through the plugin's connections is counted and
+# timed per (HTTP method, endpoint template, nixops resource), and the time
+# operations took to complete is recorded separately per (operation type,
+# endpoint template, resource), so that the calls dominating a slow deploy
+# can be found. If $NIXOPS_GCP_METRICS_FILE is set, a report is written to
+# that file when the nixops command exits: a Prometheus textfile if its name
+# ends in .prom, JSON otherwise.
+
+import atexit
+import contextvars
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+# API prefixes kept as they are in endpoint templates
+API_PREFIX = re.compile(r"^/(batch/)?(compute|storage)/v1(?=/|$)")
+
+# placeholders for the members of collections other than {name}
+PLACEHOLDERS = {
+    "projects": "{project}",
+    "zones": "{zone}",
+    "regions": "{region}",
+    "family": "{family}",
+}
+
+# path segments which are never names, e.g. of images/family/{family}
+KEYWORDS = {"family"}
+
+# path segments which aren't followed by a member name
+SCOPES = {"global", "aggregated"}
+
+# name of the nixops resource the calls of the current thread are made for
+current_resource = contextvars.ContextVar("nixops_gcp_resource", default=None)
+
+
+def endpoint_template(path):
+    """
+    Return the template of an API path or URL, with the names of projects,
+    zones, regions and resources replaced by placeholders, e.g.
+    /compute/v1/projects/{project}/zones/{zone}/instances/{name}/setLabels.
+    """
+    path = urllib.parse.urlsplit(path).path
+    prefix = API_PREFIX.match(path)
+    if prefix is not None:
+        path = path[prefix.end() :]
+    template = []
+    collection = None
+    for segment in path.split("/"):
+        if not segment:
+            continue
+        if collection is None or segment in KEYWORDS:
+            template.append(segment)
+            collection = None if segment in SCOPES else segment
+        else:
+            template.append(PLACEHOLDERS.get(collection, "{name}"))
+            collection = None
+    path = "".join("/" + segment for segment in template)
+    return (prefix.group(0) if prefix else "") + path or "/"
+
+
+class Histogram(object):
+    """Count, sum and cumulative bucket counts of observed durations."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, duration, error=False):
+        self.count += 1
+        self.sum += duration
+        if error:
+            self.errors += 1
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "sum": round(self.sum, 6),
+            "buckets": dict(zip(map(str, BUCKETS), self.buckets)),
+        }
+
+
+class ApiMetrics(object):
+    """
+    Histograms of API request durations and operation wait times.
+
+    Nothing is recorded unless a report file is set.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("NIXOPS_GCP_METRICS_FILE")
+        self.started = time.time()
+        self.requests = {}
+        self.batched_calls = {}
+        self.operation_waits = {}
+        self._lock = threading.Lock()
+        if self.path:
+            atexit.register(self.write_report)
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _observe(self, histograms, key, duration, error):
+        with self._lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(duration, error)
+
+    def record_request(self, method, path, duration, error=False, resource=None):
+        """Record an HTTP request made for resource, by default the current one."""
+        if not self.enabled:
+            return
+        self._observe(
+            self.requests,
+            (method, endpoint_template(path), resource or current_resource.get()),
+            duration,
+            error,
+        )
+
+    def record_batched_call(self, method, path, duration, error=False, resource=None):
+        """Record a call sent as a part of a batch request."""
+        if not self.enabled:
+            return
+        self._observe(
+            self.batched_calls,
+            (method, endpoint_template(path), resource or current_resource.get()),
+            duration,
+            error,
+        )
+
+    def record_wait(self, operation, duration, resource=None):
+        """Record how long an operation took from being started to completing."""
+        if not self.enabled:
+            return
+        self._observe(
+            self.operation_waits,
+            (
+                operation.get("operationType"),
+                endpoint_template(operation.get("targetLink", "")),
+                resource or current_resource.get(),
+            ),
+            duration,
+            "error" in operation,
+        )
+
+    def report(self):
+        def entries(histograms, labels):
+            # the ones taking the most time in total first
+            return [
+                dict(zip(labels, key), **h.to_json())
+                for key, h in sorted(
+                    histograms.items(), key=lambda kv: (-kv[1].sum, str(kv[0]))
+                )
+            ]
+
+        with self._lock:
+            return {
+                "command": sys.argv,
+                "started": self.started,
+                "duration": round(time.time() - self.started, 6),
+                "requests": entries(self.requests, ["method", "endpoint", "resource"]),
+                "batched_calls": entries(
+                    self.batched_calls, ["method", "endpoint", "resource"]
+                ),
+                "operation_waits": entries(
+                    self.operation_waits, ["operation", "endpoint", "resource"]
+                ),
+            }
+
+    def prometheus_report(self):
+        report = self.report()
+        lines = []
+        for name, errors_name, key, labels, help_text in [
+            (
+                "nixops_gcp_api_request_duration_seconds",
+                "nixops_gcp_api_request_errors_total",
+                "requests",
+                ["method", "endpoint", "resource"],
+                "Duration of GCE and GSE API requests.",
+            ),
+            (
+                "nixops_gcp_api_batched_call_duration_seconds",
+                "nixops_gcp_api_batched_call_errors_total",
+                "batched_calls",
+                ["method", "endpoint", "resource"],
+                "Duration of the batch requests API calls were sent in.",
+            ),
+            (
+                "nixops_gcp_operation_wait_seconds",
+                "nixops_gcp_operation_errors_total",
+                "operation_waits",
+                ["operation", "endpoint", "resource"],
+                "Time GCE operations took from being started to completing.",
+            ),
+        ]:
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} histogram".format(name))
+            errors = []
+            for entry in report[key]:
+                values = [(l, entry[l]) for l in labels]
+                for bound, count in entry["buckets"].items():
+                    lines.append(
+                        sample(name + "_bucket", values + [("le", bound)], count)
+                    )
+                lines.append(
+                    sample(name + "_bucket", values + [("le", "+Inf")], entry["count"])
+                )
+                lines.append(sample(name + "_sum", values, entry["sum"]))
+                lines.append(sample(name + "_count", values, entry["count"]))
+                errors.append(sample(errors_name, values, entry["errors"]))
+            lines.append("# TYPE {0} counter".format(errors_name))
+            lines.extend(errors)
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path=None):
+        path = path or self.path
+        if path.endswith(".prom"):
+            content = self.prometheus_report()
+        else:
+            content = json.dumps(self.report(), indent=2) + "\n"
+        # written atomically, so a textfile collector never reads half of it
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+def sample(name, labels, value):
+    return "{0}{{{1}}} {2}".format(
+        name,
+        ",".join(
+            '{0}="{1}"'.format(l, label_value(v) if v is not None else "")
+            for l, v in labels
+        ),
+        value,
+    )
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+api_metrics = ApiMetrics()
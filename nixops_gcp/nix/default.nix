@@ -17,5 +17,7 @@
     gseBuckets = evalResources ./gse-bucket.nix (zipAttrs resourcesByType.gseBuckets or []);
     gceImages = evalResources ./gce-image.nix (zipAttrs resourcesByType.gceImages  or []);
     gceRoutes = evalResources ./gce-routes.nix (zipAttrs resourcesByType.gceRoutes or []);
+    gceInstanceTemplates = evalResources ./gce-instance-template.nix (zipAttrs resourcesByType.gceInstanceTemplates or []);
+    gceInstanceGroupManagers = evalResources ./gce-instance-group-manager.nix (zipAttrs resourcesByType.gceInstanceGroupManagers or []);
   };
 }
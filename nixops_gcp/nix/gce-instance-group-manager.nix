@@ -0,0 +1,104 @@
+{ config, lib, pkgs, uuid, name, ... }:
+
+with lib;
+with import <nixops/lib.nix> lib;
+
+let
+  resourceName = x: if builtins.typeOf x == "string" then x else x.name;
+in
+{
+
+  options = (import ./gce-credentials.nix lib "instance group manager") // {
+
+    name = mkOption {
+      example = "my-instance-group";
+      default = "n-${shorten_uuid uuid}-${name}";
+      type = types.str;
+      description = "Description of the GCE managed instance group. This is the <literal>Name</literal> tag of the instance group manager.";
+    };
+
+    region = mkOption {
+      example = "europe-west1-b";
+      type = types.str;
+      description = "The GCE datacenter zone in which the instances are created.";
+    };
+
+    instanceTemplate = mkOption {
+      example = "resources.gceInstanceTemplates.web";
+      type = types.either types.str (resource "gce-instance-template");
+      apply = resourceName;
+      description = ''
+        GCE instance template resource or name of an instance template not
+        managed by NixOps, from which the instances are created. Changing it
+        only affects instances created afterwards.
+      '';
+    };
+
+    baseInstanceName = mkOption {
+      default = config.name;
+      type = types.str;
+      description = ''
+        The prefix of the names of the instances in the group.
+      '';
+    };
+
+    targetSize = mkOption {
+      default = 1;
+      type = types.int;
+      description = ''
+        The number of instances in the group. Ignored while autoscaling is
+        enabled.
+      '';
+    };
+
+    targetPools = mkOption {
+      default = [];
+      example = [ "resources.gceTargetPools.web" ];
+      type = types.listOf (types.either types.str (resource "gce-target-pool"));
+      apply = map resourceName;
+      description = ''
+        GCE target pool resources or names of target pools not managed by
+        NixOps, to which all instances of the group are added.
+      '';
+    };
+
+    autoscaling.maxReplicas = mkOption {
+      default = null;
+      example = 10;
+      type = types.nullOr types.int;
+      description = ''
+        The maximum number of instances the autoscaler may scale the group
+        to. Autoscaling is disabled if this is not set.
+      '';
+    };
+
+    autoscaling.minReplicas = mkOption {
+      default = 1;
+      type = types.int;
+      description = ''
+        The minimum number of instances the autoscaler may scale the group to.
+      '';
+    };
+
+    autoscaling.cpuUtilization = mkOption {
+      default = 0.6;
+      type = types.float;
+      description = ''
+        The average CPU utilization of the group that the autoscaler aims for.
+      '';
+    };
+
+    autoscaling.coolDownPeriod = mkOption {
+      default = 60;
+      type = types.int;
+      description = ''
+        Number of seconds the autoscaler waits after an instance started
+        before collecting information from it.
+      '';
+    };
+
+  };
+
+  config._type = "gce-instance-group-manager";
+
+}
@@ -0,0 +1,111 @@
+{ config, lib, pkgs, uuid, name, ... }:
+
+with lib;
+with import <nixops/lib.nix> lib;
+
+let
+  imageOptions = import ./image-options.nix;
+in
+{
+
+  options = (import ./gce-credentials.nix lib "instance template") // {
+
+    name = mkOption {
+      example = "my-instance-template";
+      default = "n-${shorten_uuid uuid}-${name}";
+      type = types.str;
+      description = ''
+        Description of the GCE instance template. This is the
+        <literal>Name</literal> tag of the template. Templates can't be
+        modified or renamed; to change a template, define a new
+        gce-instance-template resource and use it instead.
+      '';
+    };
+
+    instanceType = mkOption {
+      default = "g1-small";
+      example = "n1-standard-1";
+      type = types.str;
+      description = "GCE instance type of the instances created from the template.";
+    };
+
+    image = mkOption {
+      example = { family = "nixos-20-09"; project = "operations"; };
+      type = with types; either (resource "gce-image") (submodule imageOptions);
+      description = ''
+        The image, image family or image-resource from which to create the
+        boot disks of the instances. Changing the image has no effect if the
+        template already exists.
+      '';
+    };
+
+    rootDiskSize = mkOption {
+      default = null;
+      example = 200;
+      type = types.nullOr types.int;
+      description = ''
+        Root disk size in GiB. Defaults to the size of the image.
+      '';
+    };
+
+    rootDiskType = mkOption {
+      default = "standard";
+      type = types.addCheck types.str
+        (v: elem v [ "standard" "ssd" ]);
+      description = ''
+        The root disk type of the instances: either "standard" (default) or "ssd".
+      '';
+    };
+
+    network = mkOption {
+      default = null;
+      example = "resources.gceNetworks.verySecureNetwork";
+      type = types.nullOr ( types.either types.str (resource "gce-network") );
+      apply = x: if builtins.elem (builtins.typeOf x) [ "string" "null" ] then x else x.name;
+      description = ''
+        The GCE Network to make the instances a part of. Can be either
+        a gceNetworks resource or a name of a network not managed by NixOps.
+      '';
+    };
+
+    tags = mkOption {
+      default = [ ];
+      example = [ "random" "tags" ];
+      type = types.listOf types.str;
+      description = ''
+        Tags to assign to the instances. These can be used in firewall and
+        networking rules and are additionally available as metadata.
+      '';
+    };
+
+    labels = (import ./common-gce-options.nix { inherit lib; }).labels;
+
+    metadata = mkOption {
+      default = {};
+      example = { loglevel = "warn"; };
+      type = types.attrsOf types.str;
+      description = ''
+        Metadata to assign to the instances.
+      '';
+    };
+
+    preemptible = mkOption {
+      default = false;
+      type = types.bool;
+      description = "Whether the instances are preemptible.";
+    };
+
+    canIpForward = mkOption {
+      default = false;
+      type = types.bool;
+      description = ''
+        Allows the instances to send and receive packets with non-matching
+        destination or source IPs.
+      '';
+    };
+
+  };
+
+  config._type = "gce-instance-template";
+
+}
@@ -391,6 +391,34 @@ in
         '';
       };
 
+      backupRetention.hourly = mkOption {
+        default = null;
+        type = types.nullOr types.ints.positive;
+        description = ''
+          Number of hours for which to keep the newest backup of this machine
+          when older backups are pruned after each backup.
+        '';
+      };
+
+      backupRetention.daily = mkOption {
+        default = null;
+        type = types.nullOr types.ints.positive;
+        description = ''
+          Number of days for which to keep the newest backup of this machine
+          when older backups are pruned after each backup.
+        '';
+      };
+
+      backupRetention.weekly = mkOption {
+        default = null;
+        type = types.nullOr types.ints.positive;
+        description = ''
+          Number of weeks for which to keep the newest backup of this machine
+          when older backups are pruned after each backup. Backups are only
+          pruned if at least one of the retention counts is set.
+        '';
+      };
+
     };
 
     fileSystems = mkOption {
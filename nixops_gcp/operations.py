@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+# Tracking of GCE zone, region and global operations.
+#
+# Every operation started through a pooled GCE connection is waited for
+# here instead of in libcloud's fixed-interval poll loop. Blocking waits
+# use the operations/.../wait long-poll endpoint; callers which start many
+# operations at once can submit them and get futures, which a background
+# thread resolves by polling with adaptive backoff on a small pool.
+
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+from libcloud.common.types import LibcloudError
+from libcloud.common.google import ResourceNotFoundError
+
+from nixops_gcp.metrics import api_metrics, current_resource
+from nixops_gcp.tracing import current_span, tracer
+
+
+def wait_until(check, min_interval=0.25, max_interval=5.0, backoff=1.5, timeout=180):
+    """
+    Call check() until it returns a true value, sleeping with exponential
+    backoff in between, and return that value. Raises LibcloudError once
+    timeout seconds have passed.
+    """
+    deadline = time.time() + timeout
+    interval = min_interval
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.time() + interval > deadline:
+            raise LibcloudError("Job did not complete in {0} seconds".format(timeout))
+        time.sleep(interval)
+        interval = min(interval * backoff, max_interval)
+
+
+def operation_span_name(operation):
+    return "{0} operation".format(operation.get("operationType"))
+
+
+def operation_attributes(operation):
+    return {
+        "gcp.operation": operation.get("name"),
+        "gcp.operation.type": operation.get("operationType"),
+        "gcp.operation.target": operation.get("targetLink"),
+    }
+
+
+class _PendingOperation(object):
+    def __init__(self, operation, connection_factory, deadline, interval, resource):
+        self.operation = operation
+        self.connection_factory = connection_factory
+        self.deadline = deadline
+        self.interval = interval
+        self.resource = resource
+        self.span = tracer.start_span(
+            operation_span_name(operation), **operation_attributes(operation)
+        )
+        self.started = time.time()
+        self.future = concurrent.futures.Future()
+
+
+class OperationWaiter(object):
+    """
+    Waits for GCE operations to complete.
+
+    The first poll of an operation is scheduled after roughly half the
+    time operations of the same type took recently, then the poll interval
+    grows exponentially up to max_interval. Due polls run on a pool of
+    poll_workers threads, so a throttled or retried poll doesn't hold up
+    the others.
+    """
+
+    min_interval = 0.5
+    max_interval = 10.0
+    backoff = 1.5
+    timeout = 180
+    poll_workers = 8
+
+    def __init__(self):
+        self.use_wait_endpoint = True
+        self._cond = threading.Condition()
+        self._pending = []
+        self._sequence = itertools.count()
+        self._durations = {}
+        self._durations_lock = threading.Lock()
+        self._thread = None
+        self._executor = None
+
+    def expected_duration(self, operation):
+        return self._durations.get(operation.get("operationType"))
+
+    def _record_duration(self, operation, duration):
+        op_type = operation.get("operationType")
+        with self._durations_lock:
+            previous = self._durations.get(op_type)
+            self._durations[op_type] = (
+                duration if previous is None else 0.7 * previous + 0.3 * duration
+            )
+
+    def _first_interval(self, operation):
+        expected = self.expected_duration(operation)
+        if expected is None:
+            return self.min_interval
+        return min(max(self.min_interval, expected / 2), self.max_interval)
+
+    def submit(self, response, connection_factory, timeout=None, resource=None):
+        """
+        Track the operation in the given response and return a future
+        resolving to the response of the completed operation.
+
+        connection_factory is called from the polling thread to get a
+        connection to poll with. The polls and the wait are accounted to
+        resource, by default the current one; see nixops_gcp.metrics.
+        """
+        operation = response.object
+        if operation.get("status") == "DONE":
+            future = concurrent.futures.Future()
+            future.set_result(response)
+            return future
+
+        pending = _PendingOperation(
+            operation,
+            connection_factory,
+            time.time() + (timeout or self.timeout),
+            self._first_interval(operation),
+            resource or current_resource.get(),
+        )
+        self._schedule(pending, pending.interval)
+        return pending.future
+
+    def wait(self, response, connection, timeout=None):
+        """
+        Block until the operation in the given response has completed and
+        return the response describing the completed operation.
+        """
+        timeout = timeout or self.timeout
+        started = time.time()
+        deadline = started + timeout
+        if self.use_wait_endpoint:
+            with tracer.span(
+                operation_span_name(response.object),
+                **operation_attributes(response.object)
+            ):
+                response = self._wait_endpoint(response, connection, deadline, timeout)
+        if response.object.get("status") != "DONE":
+            # polled operations are traced as they are polled
+            return self.submit(
+                response, lambda: connection, deadline - time.time()
+            ).result()
+        self._record_duration(response.object, time.time() - started)
+        api_metrics.record_wait(response.object, time.time() - started)
+        return response
+
+    def _wait_endpoint(self, response, connection, deadline, timeout):
+        # returns the operation as it was when the endpoint turned out to
+        # be unavailable, if it did
+        operation = response.object
+        while operation.get("status") != "DONE":
+            if time.time() > deadline:
+                raise LibcloudError(
+                    "Job did not complete in {0} seconds".format(timeout)
+                )
+            try:
+                response = connection.request(
+                    operation["selfLink"] + "/wait", method="POST"
+                )
+            except ResourceNotFoundError:
+                # if the operation itself can be fetched, it's the endpoint
+                # which is missing, and operations are polled from now on;
+                # otherwise this raises the error of the operation
+                response = connection.request(operation["selfLink"], method="GET")
+                self.use_wait_endpoint = False
+                return response
+            operation = response.object
+        return response
+
+    def _schedule(self, pending, delay):
+        with self._cond:
+            heapq.heappush(
+                self._pending, (time.time() + delay, next(self._sequence), pending)
+            )
+            if self._thread is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.poll_workers,
+                    thread_name_prefix="nixops-gcp-poll",
+                )
+                self._thread = threading.Thread(
+                    target=self._run, name="nixops-gcp-operations", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                due, _, pending = self._pending[0]
+                now = time.time()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                heapq.heappop(self._pending)
+            try:
+                self._executor.submit(self._poll, pending)
+            except Exception as e:
+                pending.future.set_exception(e)
+
+    def _poll(self, pending):
+        # a failure, even in the bookkeeping, fails only this operation
+        try:
+            self._poll_once(pending)
+        except Exception as e:
+            if not pending.future.done():
+                pending.future.set_exception(e)
+
+    def _poll_once(self, pending):
+        current_resource.set(pending.resource)
+        current_span.set(pending.span)
+        try:
+            response = pending.connection_factory().request(
+                pending.operation["selfLink"], method="GET"
+            )
+        except Exception as e:
+            pending.span.end(e)
+            pending.future.set_exception(e)
+            return
+
+        if response.object.get("status") == "DONE":
+            self._record_duration(response.object, time.time() - pending.started)
+            api_metrics.record_wait(
+                response.object, time.time() - pending.started, pending.resource
+            )
+            pending.span.end(response.object.get("error"))
+            pending.future.set_result(response)
+        elif time.time() > pending.deadline:
+            error = LibcloudError(
+                "operation {0} did not complete in time".format(
+                    pending.operation.get("name")
+                )
+            )
+            pending.span.end(error)
+            pending.future.set_exception(error)
+        else:
+            pending.interval = min(pending.interval * self.backoff, self.max_interval)
+            self._schedule(pending, pending.interval)
+
+
+operation_waiter = OperationWaiter()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# Bounded, process-wide thread pool for issuing independent GCE mutations
+# concurrently, both within one resource and across all resources of a
+# deployment.
+
+import concurrent.futures
+import contextvars
+import os
+import threading
+
+_executor = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+def max_workers():
+    return int(os.environ.get("NIXOPS_GCP_MAX_PARALLEL", 16))
+
+
+# bounds the disks of a machine created or restored at once; attaching
+# them is serial, as each attachment is an operation on the instance
+def disk_fan_out():
+    return int(os.environ.get("NIXOPS_GCP_DISK_PARALLEL", 8))
+
+
+def firewall_fan_out():
+    return int(os.environ.get("NIXOPS_GCP_FIREWALL_PARALLEL", 8))
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers(),
+                thread_name_prefix="nixops-gcp",
+                initializer=_mark_worker,
+            )
+        return _executor
+
+
+def _mark_worker():
+    _local.is_worker = True
+
+
+class ParallelError(Exception):
+    """Raised when several concurrently run operations failed."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            "{0} operations failed:\n{1}".format(
+                len(errors), "\n".join("  {0}".format(e) for e in errors)
+            )
+        )
+
+
+def _run_chain(chain):
+    return [step() for step in chain]
+
+
+def limit_chains(chains, limit):
+    """
+    Wrap the given chains so that at most limit of them run at the same
+    time when passed to run_chains. Each wrapped chain has a single step
+    returning the list of step results of the original chain.
+    """
+    semaphore = threading.BoundedSemaphore(max(1, limit))
+
+    def wrap(chain):
+        def run():
+            with semaphore:
+                return _run_chain(chain)
+
+        return [run]
+
+    return [wrap(c) for c in chains if c]
+
+
+def run_chains(chains):
+    """
+    Run the given chains of callables concurrently on the shared pool; the
+    steps of a chain run in order. Waits for every chain to finish, then
+    re-raises the failure if exactly one chain failed, or a ParallelError
+    if several did. Returns the list of step results of each chain.
+    """
+    chains = [c for c in chains if c]
+    # nested calls from a pool thread run inline so they can't deadlock
+    if len(chains) <= 1 or getattr(_local, "is_worker", False):
+        return [_run_chain(c) for c in chains]
+
+    # chains run with the caller's context, e.g. the resource their API
+    # calls are accounted to
+    futures = [
+        executor().submit(contextvars.copy_context().run, _run_chain, c) for c in chains
+    ]
+    concurrent.futures.wait(futures)
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if len(errors) == 1:
+        raise errors[0]
+    if errors:
+        raise ParallelError(errors)
+    return [f.result() for f in futures]
@@ -2,6 +2,8 @@ from . import gce_disk
 from . import gce_forwarding_rule
 from . import gce_http_health_check
 from . import gce_image
+from . import gce_instance_group_manager
+from . import gce_instance_template
 from . import gce_network
 from . import gce_route
 from . import gce_static_ip
@@ -90,7 +90,9 @@ class GCEDiskState(ResourceState):
 
         if check:
             try:
-                disk = self.disk()
+                disk = self.inventory().volume(
+                    self.connect(), self.disk_name, self.region
+                )
                 if self.state == self.UP:
                     self.handle_changed_property(
                         "region", disk.extra["zone"].name, can_fix=False
@@ -102,6 +104,7 @@ class GCEDiskState(ResourceState):
                 else:
                     self.warn_not_supposed_to_exist(valuable_data=True)
                     self.confirm_destroy(disk, self.full_name)
+                    self.inventory_changed("disks", self.disk_name)
 
             except libcloud.common.google.ResourceNotFoundError:
                 self.warn_missing_resource()
@@ -159,6 +162,7 @@ class GCEDiskState(ResourceState):
                         defn.snapshot
                     )
                 )
+            self.inventory_changed("disks", defn.disk_name)
             self.state = self.UP
             self.region = defn.region
             self.size = volume.size
@@ -167,7 +171,11 @@ class GCEDiskState(ResourceState):
     def destroy(self, wipe=False):
         if self.state == self.UP:
             try:
-                return self.confirm_destroy(self.disk(), self.full_name, abort=False)
+                destroyed = self.confirm_destroy(
+                    self.disk(), self.full_name, abort=False
+                )
+                self.inventory_changed("disks", self.disk_name)
+                return destroyed
             except libcloud.common.google.ResourceNotFoundError:
                 self.warn(
                     "tried to destroy {0} which didn't exist".format(self.full_name)
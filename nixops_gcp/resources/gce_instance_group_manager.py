@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+# Automatic provisioning of GCE Managed Instance Groups.
+
+import libcloud.common.google
+
+from nixops.util import attr_property
+from nixops_gcp.gcp_common import ResourceDefinition, ResourceState
+from nixops_gcp.resources.gce_instance_template import GCEInstanceTemplateState
+from nixops_gcp.resources.gce_target_pool import GCETargetPoolState
+from .types.gce_instance_group_manager import GceInstanceGroupManagerOptions
+
+
+def resource_name(url):
+    return url.rsplit("/", 1)[-1]
+
+
+class GCEInstanceGroupManagerDefinition(ResourceDefinition):
+    """Definition of a GCE Managed Instance Group"""
+
+    config: GceInstanceGroupManagerOptions
+
+    @classmethod
+    def get_type(cls):
+        return "gce-instance-group-manager"
+
+    @classmethod
+    def get_resource_type(cls):
+        return "gceInstanceGroupManagers"
+
+    def __init__(self, name, config):
+        super().__init__(name, config)
+
+        self.manager_name = self.config.name
+        self.region = self.config.region
+        self.instance_template = self.config.instanceTemplate
+        self.base_instance_name = self.config.baseInstanceName
+        self.target_size = self.config.targetSize
+        self.target_pools = sorted(self.config.targetPools)
+
+        a = self.config.autoscaling
+        self.autoscaling = (
+            {
+                "maxReplicas": a.maxReplicas,
+                "minReplicas": a.minReplicas,
+                "cpuUtilization": a.cpuUtilization,
+                "coolDownPeriod": a.coolDownPeriod,
+            }
+            if a.maxReplicas is not None
+            else None
+        )
+
+    def show_type(self):
+        return "{0} [{1}]".format(self.get_type(), self.region)
+
+
+class GCEInstanceGroupManagerState(ResourceState):
+    """
+    State of a GCE Managed Instance Group.
+
+    The instances of the group are created from its template and managed
+    by GCE; nixops only reconciles the group itself, so checking and
+    scaling it costs the same number of calls whatever its size.
+    """
+
+    manager_name = attr_property("gce.name", None)
+    region = attr_property("gce.region", None)
+    instance_template = attr_property("gce.instanceTemplate", None)
+    base_instance_name = attr_property("gce.baseInstanceName", None)
+    target_size = attr_property("gce.targetSize", None, int)
+    target_pools = attr_property("gce.targetPools", [], "json")
+    autoscaling = attr_property("gce.autoscaling", None, "json")
+
+    @classmethod
+    def get_type(cls):
+        return "gce-instance-group-manager"
+
+    def __init__(self, depl, name, id):
+        ResourceState.__init__(self, depl, name, id)
+
+    def show_type(self):
+        s = super().show_type()
+        if self.state == self.UP:
+            s = "{0} [{1}; {2}]".format(
+                s,
+                self.region,
+                "autoscaled"
+                if self.autoscaling
+                else "{0} instances".format(self.target_size),
+            )
+        return s
+
+    @property
+    def resource_id(self):
+        return self.manager_name
+
+    nix_name = "gceInstanceGroupManagers"
+
+    @property
+    def full_name(self):
+        return "GCE managed instance group '{0}'".format(self.manager_name)
+
+    defn_properties = [
+        "region",
+        "instance_template",
+        "base_instance_name",
+        "target_size",
+        "target_pools",
+        "autoscaling",
+    ]
+
+    def manager_path(self, action=""):
+        return "/zones/{0}/instanceGroupManagers/{1}{2}".format(
+            self.region, self.manager_name, action
+        )
+
+    def autoscaler_path(self):
+        return "/zones/{0}/autoscalers/{1}".format(self.region, self.manager_name)
+
+    def manager(self):
+        return self.connect().connection.request(self.manager_path()).object
+
+    def template_url(self, name):
+        return self.connect().connection.resource_url(
+            "global/instanceTemplates/{0}".format(name)
+        )
+
+    def target_pool_urls(self, names):
+        # target pools of a group must be in the region of its zone
+        region = self.region.rsplit("-", 1)[0]
+        return [
+            self.connect().connection.resource_url(
+                "regions/{0}/targetPools/{1}".format(region, name)
+            )
+            for name in names
+        ]
+
+    def autoscaler_body(self, autoscaling):
+        return {
+            "name": self.manager_name,
+            "target": self.connect().connection.resource_url(self.manager_path()[1:]),
+            "autoscalingPolicy": {
+                "maxNumReplicas": autoscaling["maxReplicas"],
+                "minNumReplicas": autoscaling["minReplicas"],
+                "coolDownPeriodSec": autoscaling["coolDownPeriod"],
+                "cpuUtilization": {"utilizationTarget": autoscaling["cpuUtilization"]},
+            },
+        }
+
+    def check_autoscaler(self):
+        try:
+            autoscaler = (
+                self.connect().connection.request(self.autoscaler_path()).object
+            )
+        except libcloud.common.google.ResourceNotFoundError:
+            if self.autoscaling is not None:
+                self.warn(
+                    "the autoscaler of {0} has disappeared".format(self.full_name)
+                )
+                self.autoscaling = None
+            return
+        policy = autoscaler["autoscalingPolicy"]
+        self.handle_changed_property(
+            "autoscaling",
+            {
+                "maxReplicas": policy.get("maxNumReplicas"),
+                "minReplicas": policy.get("minNumReplicas"),
+                "cpuUtilization": policy.get("cpuUtilization", {}).get(
+                    "utilizationTarget"
+                ),
+                "coolDownPeriod": policy.get("coolDownPeriodSec"),
+            },
+        )
+
+    def destroy_manager(self):
+        connection = self.connect().connection
+        try:
+            connection.async_request(self.autoscaler_path(), method="DELETE")
+        except libcloud.common.google.ResourceNotFoundError:
+            pass
+        connection.async_request(self.manager_path(), method="DELETE")
+
+    def create(self, defn, check, allow_reboot, allow_recreate):
+        self.no_project_change(defn)
+        self.no_region_change(defn)
+        self.no_property_change(defn, "base_instance_name")
+
+        self.copy_credentials(defn)
+        self.manager_name = defn.manager_name
+
+        if check:
+            try:
+                manager = self.manager()
+                if self.state == self.UP:
+                    with self.state_batch():
+                        self.handle_changed_property(
+                            "instance_template",
+                            resource_name(manager["instanceTemplate"]),
+                        )
+                        self.handle_changed_property(
+                            "target_pools",
+                            sorted(
+                                resource_name(p) for p in manager.get("targetPools", [])
+                            ),
+                        )
+                        self.check_autoscaler()
+                        # the autoscaler changes the size as it sees fit
+                        if self.autoscaling is None:
+                            self.handle_changed_property(
+                                "target_size", manager["targetSize"]
+                            )
+                else:
+                    self.warn_not_supposed_to_exist()
+                    if not self.depl.logger.confirm(
+                        "are you sure you want to destroy {0}?".format(self.full_name)
+                    ):
+                        raise Exception("can't proceed further")
+                    self.log("destroying...")
+                    self.destroy_manager()
+
+            except libcloud.common.google.ResourceNotFoundError:
+                self.warn_missing_resource()
+
+        if self.state != self.UP:
+            self.log("creating {0}...".format(self.full_name))
+            try:
+                self.connect().connection.async_request(
+                    "/zones/{0}/instanceGroupManagers".format(defn.region),
+                    method="POST",
+                    data={
+                        "name": defn.manager_name,
+                        "baseInstanceName": defn.base_instance_name,
+                        "instanceTemplate": self.template_url(defn.instance_template),
+                        "targetSize": defn.target_size,
+                        "targetPools": self.target_pool_urls(defn.target_pools),
+                    },
+                )
+            except libcloud.common.google.ResourceExistsError:
+                raise Exception(
+                    "tried creating a managed instance group that already exists; "
+                    "please run 'deploy --check' to fix this"
+                )
+            with self.state_batch():
+                self.state = self.UP
+                self.copy_properties(defn)
+                self.autoscaling = None
+
+        if not self.properties_changed(defn):
+            return
+
+        connection = self.connect().connection
+        try:
+            if self.instance_template != defn.instance_template:
+                self.log(
+                    "setting the instance template of {0} to '{1}'...".format(
+                        self.full_name, defn.instance_template
+                    )
+                )
+                connection.async_request(
+                    self.manager_path("/setInstanceTemplate"),
+                    method="POST",
+                    data={
+                        "instanceTemplate": self.template_url(defn.instance_template)
+                    },
+                )
+                self.instance_template = defn.instance_template
+
+            if self.target_pools != defn.target_pools:
+                self.log("updating the target pools of {0}...".format(self.full_name))
+                connection.async_request(
+                    self.manager_path("/setTargetPools"),
+                    method="POST",
+                    data={"targetPools": self.target_pool_urls(defn.target_pools)},
+                )
+                self.target_pools = defn.target_pools
+
+            if self.autoscaling != defn.autoscaling:
+                if defn.autoscaling is None:
+                    self.log("removing the autoscaler of {0}...".format(self.full_name))
+                    connection.async_request(self.autoscaler_path(), method="DELETE")
+                    # the group keeps the size the autoscaler left it at
+                    self.target_size = None
+                else:
+                    self.log("updating the autoscaler of {0}...".format(self.full_name))
+                    connection.async_request(
+                        "/zones/{0}/autoscalers".format(self.region),
+                        method="PUT" if self.autoscaling else "POST",
+                        data=self.autoscaler_body(defn.autoscaling),
+                    )
+                self.autoscaling = defn.autoscaling
+
+            if self.autoscaling is None and self.target_size != defn.target_size:
+                self.log(
+                    "resizing {0} to {1} instances...".format(
+                        self.full_name, defn.target_size
+                    )
+                )
+                connection.async_request(
+                    self.manager_path("/resize"),
+                    method="POST",
+                    params={"size": defn.target_size},
+                )
+                self.target_size = defn.target_size
+        except libcloud.common.google.ResourceNotFoundError:
+            raise Exception(
+                "{0} has been deleted behind our back; "
+                "please run 'deploy --check' to fix this".format(self.full_name)
+            )
+
+    def destroy(self, wipe=False):
+        if self.state == self.UP:
+            try:
+                self.manager()
+                if not self.depl.logger.confirm(
+                    "are you sure you want to destroy {0}?".format(self.full_name)
+                ):
+                    return False
+                self.log("destroying {0}...".format(self.full_name))
+                self.destroy_manager()
+            except libcloud.common.google.ResourceNotFoundError:
+                self.warn(
+                    "tried to destroy {0} which didn't exist".format(self.full_name)
+                )
+        return True
+
+    def create_after(self, resources, defn):
+        return {
+            r
+            for r in resources
+            if isinstance(r, GCEInstanceTemplateState)
+            or isinstance(r, GCETargetPoolState)
+        }
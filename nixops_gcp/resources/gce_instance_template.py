@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# Automatic provisioning of GCE Instance Templates.
+
+import libcloud.common.google
+
+from nixops.util import attr_property
+from nixops_gcp.gcp_common import ResourceDefinition, ResourceState, retrieve_gce_image
+from nixops_gcp.resources.gce_image import GCEImageState
+from nixops_gcp.resources.gce_network import GCENetworkState
+from .types.gce_instance_template import GceInstanceTemplateOptions
+
+
+class GCEInstanceTemplateDefinition(ResourceDefinition):
+    """Definition of a GCE Instance Template"""
+
+    config: GceInstanceTemplateOptions
+
+    @classmethod
+    def get_type(cls):
+        return "gce-instance-template"
+
+    @classmethod
+    def get_resource_type(cls):
+        return "gceInstanceTemplates"
+
+    def __init__(self, name, config):
+        super().__init__(name, config)
+
+        self.template_name = self.config.name
+        self.instance_type = self.config.instanceType
+        self.image = self.config.image
+        self.root_disk_size = self.config.rootDiskSize
+        self.root_disk_type = self.config.rootDiskType
+        self.network = self.config.network
+        self.tags = sorted(self.config.tags)
+        self.labels = dict(self.config.labels)
+        self.metadata = dict(self.config.metadata)
+        self.preemptible = self.config.preemptible
+        self.can_ip_forward = self.config.canIpForward
+
+    def show_type(self):
+        return "{0} [{1}]".format(self.get_type(), self.instance_type)
+
+
+class GCEInstanceTemplateState(ResourceState):
+    """State of a GCE Instance Template"""
+
+    template_name = attr_property("gce.name", None)
+    instance_type = attr_property("gce.instanceType", None)
+    root_disk_size = attr_property("gce.rootDiskSize", None, int)
+    root_disk_type = attr_property("gce.rootDiskType", None)
+    network = attr_property("gce.network", None)
+    tags = attr_property("gce.tags", [], "json")
+    labels = attr_property("gce.labels", {}, "json")
+    metadata = attr_property("gce.metadata", {}, "json")
+    preemptible = attr_property("gce.preemptible", False, bool)
+    can_ip_forward = attr_property("gce.canIpForward", False, bool)
+
+    @classmethod
+    def get_type(cls):
+        return "gce-instance-template"
+
+    def __init__(self, depl, name, id):
+        ResourceState.__init__(self, depl, name, id)
+
+    def show_type(self):
+        s = super().show_type()
+        if self.state == self.UP:
+            s = "{0} [{1}]".format(s, self.instance_type)
+        return s
+
+    @property
+    def resource_id(self):
+        return self.template_name
+
+    nix_name = "gceInstanceTemplates"
+
+    @property
+    def full_name(self):
+        return "GCE instance template '{0}'".format(self.template_name)
+
+    def instancetemplate(self):
+        return self.connect().ex_get_instancetemplate(self.template_name)
+
+    # instance templates can't be modified, only replaced by one with
+    # another name; changing the image has no effect, as for disks
+    defn_properties = [
+        "instance_type",
+        "root_disk_size",
+        "root_disk_type",
+        "network",
+        "tags",
+        "labels",
+        "metadata",
+        "preemptible",
+        "can_ip_forward",
+    ]
+
+    def template_properties(self, defn, image):
+        connection = self.connect().connection
+        disk_params = {
+            "sourceImage": image.extra["selfLink"],
+            "diskType": "pd-" + defn.root_disk_type,
+        }
+        if defn.root_disk_size:
+            disk_params["diskSizeGb"] = defn.root_disk_size
+        return {
+            "machineType": defn.instance_type,
+            "canIpForward": defn.can_ip_forward,
+            "tags": {"items": defn.tags},
+            "labels": defn.labels,
+            "metadata": {
+                "items": [{"key": k, "value": v} for k, v in defn.metadata.items()]
+            },
+            "scheduling": {
+                "preemptible": defn.preemptible,
+                "automaticRestart": not defn.preemptible,
+                "onHostMaintenance": "TERMINATE" if defn.preemptible else "MIGRATE",
+            },
+            "disks": [
+                {
+                    "boot": True,
+                    "autoDelete": True,
+                    "type": "PERSISTENT",
+                    "initializeParams": disk_params,
+                }
+            ],
+            "networkInterfaces": [
+                {
+                    "network": connection.resource_url(
+                        "global/networks/{0}".format(defn.network or "default")
+                    ),
+                    "accessConfigs": [
+                        {"name": "External NAT", "type": "ONE_TO_ONE_NAT"}
+                    ],
+                }
+            ],
+        }
+
+    def create(self, defn, check, allow_reboot, allow_recreate):
+        self.no_project_change(defn)
+        if self.is_deployed() and self.template_name != defn.template_name:
+            # creating the renamed template here would leave the old one,
+            # which the group managers using it still need, behind
+            raise Exception(
+                "cannot rename {0}, as instance templates can't be modified; "
+                "please define the new template as another resource, so that "
+                "the old one is destroyed once nothing uses it".format(self.full_name)
+            )
+        for attr in self.defn_properties:
+            self.no_property_change(defn, attr)
+
+        self.copy_credentials(defn)
+        self.template_name = defn.template_name
+
+        if check:
+            try:
+                template = self.instancetemplate()
+                if self.state == self.UP:
+                    self.handle_changed_property(
+                        "instance_type",
+                        template.extra["properties"]["machineType"],
+                        can_fix=False,
+                    )
+                else:
+                    self.warn_not_supposed_to_exist()
+                    self.confirm_destroy(template, self.full_name)
+
+            except libcloud.common.google.ResourceNotFoundError:
+                self.warn_missing_resource()
+
+        if self.state != self.UP:
+            self.log("creating {0}...".format(self.full_name))
+
+            img = defn.image
+            if hasattr(img, "_type") and img._type == "gce-image":
+                img = self.depl.active_resources.get(img._name).image()
+            else:
+                img = retrieve_gce_image(self.connect(), img=img)
+
+            try:
+                self.connect().connection.async_request(
+                    "/global/instanceTemplates",
+                    method="POST",
+                    data={
+                        "name": defn.template_name,
+                        "properties": self.template_properties(defn, img),
+                    },
+                )
+            except libcloud.common.google.ResourceExistsError:
+                raise Exception(
+                    "tried creating an instance template that already exists; "
+                    "please run 'deploy --check' to fix this"
+                )
+            self.state = self.UP
+            self.copy_properties(defn)
+
+    def destroy(self, wipe=False):
+        if self.state == self.UP:
+            try:
+                template = self.instancetemplate()
+                return self.confirm_destroy(template, self.full_name, abort=False)
+            except libcloud.common.google.ResourceNotFoundError:
+                self.warn(
+                    "tried to destroy {0} which didn't exist".format(self.full_name)
+                )
+        return True
+
+    def create_after(self, resources, defn):
+        return {
+            r
+            for r in resources
+            if isinstance(r, GCEImageState) or isinstance(r, GCENetworkState)
+        }
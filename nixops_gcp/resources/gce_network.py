@@ -2,6 +2,7 @@
 
 # Automatic provisioning of GCE Networks.
 
+import functools
 import os
 import libcloud.common.google
 from libcloud.compute.types import Provider
@@ -9,6 +10,7 @@ from libcloud.compute.providers import get_driver
 
 from nixops.util import attr_property
 from nixops_gcp.gcp_common import ResourceDefinition, ResourceState
+from nixops_gcp.provisioning import firewall_fan_out, limit_chains, run_chains
 from .types.gce_network import GceNetworkOptions, FirewallOptions
 
 
@@ -16,6 +18,15 @@ def normalize_list(tags):
     return sorted(tags or [])
 
 
+def trans_allowed(attrs):
+    return [
+        dict(
+            [("IPProtocol", proto)] + ([("ports", ports)] if ports is not None else [])
+        )
+        for proto, ports in attrs.items()
+    ]
+
+
 class GCENetworkDefinition(ResourceDefinition):
     """Definition of a GCE Network"""
 
@@ -102,13 +113,25 @@ class GCENetworkState(ResourceState):
     def network(self):
         return self.connect().ex_get_network(self.network_name)
 
+    def list_firewalls(self):
+        """
+        Return the firewall rules of this network as returned by the API,
+        listing only this network's rules.
+        """
+        return self.connect().connection.request_filtered_items(
+            "/global/firewalls",
+            'network eq ".*/global/networks/{0}"'.format(self.network_name),
+        )
+
     def update_firewall(self, k, v):
-        x = self.firewall
-        if v == None:
-            x.pop(k, None)
-        else:
-            x[k] = v
-        self.firewall = x
+        # rules are applied concurrently
+        with self._batch_lock:
+            x = self.firewall
+            if v == None:
+                x.pop(k, None)
+            else:
+                x[k] = v
+            self.firewall = x
 
     def firewall_name(self, name):
         return "{0}-{1}".format(self.network_name, name)
@@ -131,7 +154,9 @@ class GCENetworkState(ResourceState):
         self.log("destroying {0}...".format(self.full_firewall_name(fwname)))
         try:
             fw_n = self.firewall_name(fwname)
-            self.connect().ex_get_firewall(fw_n).destroy()
+            self.connect().connection.async_request(
+                "/global/firewalls/{0}".format(fw_n), method="DELETE"
+            )
         except libcloud.common.google.ResourceNotFoundError:
             self.warn(
                 "tried to destroy {0} which didn't exist".format(
@@ -170,118 +195,109 @@ class GCENetworkState(ResourceState):
             self.state = self.UP
 
         # handle firewall rules
-        def trans_allowed(attrs):
-            return [
-                dict(
-                    [("IPProtocol", proto)]
-                    + ([("ports", ports)] if ports is not None else [])
-                )
-                for proto, ports in attrs.items()
-            ]
-
         if check:
-            firewalls = [
-                f
-                for f in self.connect().ex_list_firewalls()
-                if f.network.name == defn.network_name
-            ]
-
-            # delete stray rules and mark changed ones for update
-            for fw in firewalls:
-                fw_name = next(
-                    (
-                        k
-                        for (k, v) in self.firewall.items()
-                        if fw.name == self.firewall_name(k)
-                    ),
-                    None,
-                )
-                if fw_name:
-                    rule = self.firewall[fw_name]
-
-                    rule["sourceRanges"] = self.warn_if_firewall_changed(
-                        fw_name,
-                        rule["sourceRanges"],
-                        normalize_list(fw.source_ranges),
-                        "source ranges",
-                    )
-                    rule["sourceTags"] = self.warn_if_firewall_changed(
-                        fw_name,
-                        rule["sourceTags"],
-                        normalize_list(fw.source_tags),
-                        "source tags",
-                    )
-                    rule["targetTags"] = self.warn_if_firewall_changed(
-                        fw_name,
-                        rule["targetTags"],
-                        normalize_list(fw.target_tags),
-                        "target tags",
-                    )
+            firewalls = self.list_firewalls()
+            # rule names in the state by firewall name, and listed firewalls
+            rule_names = {self.firewall_name(k): k for k in self.firewall.keys()}
+            listed = {fw["name"] for fw in firewalls}
+
+            with self.state_batch():
+                # delete stray rules and mark changed ones for update
+                for fw in firewalls:
+                    fw_name = rule_names.get(fw["name"])
+                    if fw_name:
+                        rule = self.firewall[fw_name]
+
+                        rule["sourceRanges"] = self.warn_if_firewall_changed(
+                            fw_name,
+                            rule["sourceRanges"],
+                            normalize_list(fw.get("sourceRanges")),
+                            "source ranges",
+                        )
+                        rule["sourceTags"] = self.warn_if_firewall_changed(
+                            fw_name,
+                            rule["sourceTags"],
+                            normalize_list(fw.get("sourceTags")),
+                            "source tags",
+                        )
+                        rule["targetTags"] = self.warn_if_firewall_changed(
+                            fw_name,
+                            rule["targetTags"],
+                            normalize_list(fw.get("targetTags")),
+                            "target tags",
+                        )
 
-                    if fw.allowed != trans_allowed(rule["allowed"]):
+                        if fw.get("allowed") != trans_allowed(rule["allowed"]):
+                            self.warn(
+                                "{0} allowed ports and protocols have changed unexpectedly".format(
+                                    self.full_firewall_name(fw_name)
+                                )
+                            )
+                            rule["allowed"] = {}  # mark for update
+
+                        self.update_firewall(fw_name, rule)
+                    else:
                         self.warn(
-                            "{0} allowed ports and protocols have changed unexpectedly".format(
-                                self.full_firewall_name(fw_name)
+                            "deleting {0} which isn't supposed to exist...".format(
+                                fw["name"]
                             )
                         )
-                        rule["allowed"] = {}  # mark for update
-
-                    self.update_firewall(fw_name, rule)
-                else:
-                    self.warn(
-                        "deleting {0} which isn't supposed to exist...".format(
-                            self.firewall_name(fw_name)
+                        self.connect().connection.async_request(
+                            "/global/firewalls/{0}".format(fw["name"]), method="DELETE"
                         )
-                    )
-                    fw.destroy()
-
-            # find missing firewall rules
-            for k, v in self.firewall.items():
-                if not any(fw.name == self.firewall_name(k) for fw in firewalls):
-                    self.warn("firewall rule '{0}' has disappeared...".format(k))
-                    self.update_firewall(k, None)
-
-        # add new and update changed
-        for k, v in defn.firewall.items():
-            if k in self.firewall:
-                if v == self.firewall[k]:
-                    continue
-                self.log("updating {0}...".format(self.firewall_name(k)))
-                try:
-                    firewall = self.connect().ex_get_firewall(self.firewall_name(k))
-                    firewall.allowed = trans_allowed(v["allowed"])
-                    firewall.source_ranges = v["sourceRanges"]
-                    firewall.source_tags = v["sourceTags"]
-                    firewall.target_tags = v["targetTags"]
-                    firewall.update()
-                except libcloud.common.google.ResourceNotFoundError:
-                    raise Exception(
-                        "tried updating a firewall rule that doesn't exist; "
-                        "please run 'deploy --check' to fix this"
-                    )
 
-            else:
-                self.log("creating {0}...".format(self.full_firewall_name(k)))
-                try:
-                    self.connect().ex_create_firewall(
-                        self.firewall_name(k),
-                        trans_allowed(v["allowed"]),
-                        network=self.network_name,
-                        source_ranges=v["sourceRanges"],
-                        source_tags=v["sourceTags"],
-                        target_tags=v["targetTags"],
-                    )
-                except libcloud.common.google.ResourceExistsError:
-                    raise Exception(
-                        "tried creating a firewall rule that already exists; "
-                        "please run 'deploy --check' to fix this"
-                    )
+                # find missing firewall rules
+                for k, v in self.firewall.items():
+                    if self.firewall_name(k) not in listed:
+                        self.warn("firewall rule '{0}' has disappeared...".format(k))
+                        self.update_firewall(k, None)
+
+        # add new, update changed and delete unneeded rules; the rules are
+        # independent, so they are applied concurrently
+        chains = [
+            [functools.partial(self.apply_firewall, k, v)]
+            for k, v in defn.firewall.items()
+            if self.firewall.get(k) != v
+        ] + [
+            [functools.partial(self.destroy_firewall, k)]
+            for k in set(self.firewall.keys()) - set(defn.firewall.keys())
+        ]
+        run_chains(limit_chains(chains, firewall_fan_out()))
+
+    def apply_firewall(self, k, v):
+        if k in self.firewall:
+            self.log("updating {0}...".format(self.firewall_name(k)))
+            try:
+                firewall = self.connect().ex_get_firewall(self.firewall_name(k))
+                firewall.allowed = trans_allowed(v["allowed"])
+                firewall.source_ranges = v["sourceRanges"]
+                firewall.source_tags = v["sourceTags"]
+                firewall.target_tags = v["targetTags"]
+                firewall.update()
+            except libcloud.common.google.ResourceNotFoundError:
+                raise Exception(
+                    "tried updating a firewall rule that doesn't exist; "
+                    "please run 'deploy --check' to fix this"
+                )
 
-            self.update_firewall(k, v)
+        else:
+            self.log("creating {0}...".format(self.full_firewall_name(k)))
+            try:
+                self.connect().ex_create_firewall(
+                    self.firewall_name(k),
+                    trans_allowed(v["allowed"]),
+                    network=self.network_name,
+                    source_ranges=v["sourceRanges"],
+                    source_tags=v["sourceTags"],
+                    target_tags=v["targetTags"],
+                )
+            except libcloud.common.google.ResourceExistsError:
+                raise Exception(
+                    "tried creating a firewall rule that already exists; "
+                    "please run 'deploy --check' to fix this"
+                )
 
-        # delete unneeded
-        for k in set(self.firewall.keys()) - set(defn.firewall.keys()):
-            self.destroy_firewall(k)
+        self.update_firewall(k, v)
 
     def destroy(self, wipe=False):
         if self.state == self.UP:
@@ -292,8 +308,15 @@ class GCENetworkState(ResourceState):
                 ):
                     return False
 
-                for k in self.firewall.keys():
-                    self.destroy_firewall(k)
+                run_chains(
+                    limit_chains(
+                        [
+                            [functools.partial(self.destroy_firewall, k)]
+                            for k in self.firewall.keys()
+                        ],
+                        firewall_fan_out(),
+                    )
+                )
 
                 self.log("destroying {0}...".format(self.full_name))
                 network.destroy()
@@ -88,7 +88,9 @@ class GCEStaticIPState(ResourceState):
 
         if check:
             try:
-                address = self.address()
+                address = self.inventory().address(
+                    self.connect(), self.addr_name, self.region
+                )
                 if self.state == self.UP:
                     self.handle_changed_property(
                         "ip_address", address.address, property_name=""
@@ -99,6 +101,7 @@ class GCEStaticIPState(ResourceState):
                 else:
                     self.warn_not_supposed_to_exist(valuable_resource=True)
                     self.confirm_destroy(address, self.full_name)
+                    self.inventory_changed("addresses", self.addr_name)
 
             except libcloud.common.google.ResourceNotFoundError:
                 self.warn_missing_resource()
@@ -115,6 +118,7 @@ class GCEStaticIPState(ResourceState):
                     "please run 'deploy --check' to fix this"
                 )
 
+            self.inventory_changed("addresses", defn.addr_name)
             self.log("reserved IP address: {0}".format(address.address))
             self.state = self.UP
             self.region = defn.region
@@ -124,11 +128,13 @@ class GCEStaticIPState(ResourceState):
         if self.state == self.UP:
             try:
                 address = self.address()
-                return self.confirm_destroy(
+                destroyed = self.confirm_destroy(
                     address,
                     "{0} ({1})".format(self.full_name, self.ip_address),
                     abort=False,
                 )
+                self.inventory_changed("addresses", self.addr_name)
+                return destroyed
             except libcloud.common.google.ResourceNotFoundError:
                 self.warn(
                     "tried to destroy {0} which didn't exist".format(self.full_name)
@@ -93,6 +93,36 @@ class GCETargetPoolState(ResourceState):
 
     defn_properties = ["region", "health_check"]
 
+    # instances per addInstance or removeInstance call
+    members_per_request = 100
+
+    def update_members(self, action, uris):
+        """
+        Add or remove instances with as few addInstance or removeInstance
+        calls as possible, yielding the set of instances each call covered
+        once its operation completed.
+        """
+        uris = sorted(uris)
+        for i in range(0, len(uris), self.members_per_request):
+            chunk = uris[i : i + self.members_per_request]
+            self.connect().connection.async_request(
+                "/regions/{0}/targetPools/{1}/{2}".format(
+                    self.region, self.targetpool_name, action
+                ),
+                method="POST",
+                data={
+                    "instances": [{"instance": self.instance_url(uri)} for uri in chunk]
+                },
+            )
+            yield set(chunk)
+
+    def instance_url(self, uri):
+        if uri.startswith("https://"):
+            return uri
+        # machine names are resolved from one listing of the project's
+        # instances rather than a lookup each
+        return self.inventory().node_url(self.connect(), uri)
+
     def create(self, defn, check, allow_reboot, allow_recreate):
         self.no_project_change(defn)
         self.no_region_change(defn)
@@ -183,13 +213,16 @@ class GCETargetPoolState(ResourceState):
 
             if machines_state != machines_defn:
                 self.log("updating the machine list of {0}...".format(self.full_name))
-                for uri in machines_state - machines_defn:
-                    tp.remove_node(uri)
-                    machines_state.remove(uri)
-                for uri in machines_defn - machines_state:
-                    tp.add_node(uri)
-                    machines_state.add(uri)
-                self.machines = list(machines_state)
+                for chunk in self.update_members(
+                    "removeInstance", machines_state - machines_defn
+                ):
+                    machines_state -= chunk
+                    self.machines = list(machines_state)
+                for chunk in self.update_members(
+                    "addInstance", machines_defn - machines_state
+                ):
+                    machines_state |= chunk
+                    self.machines = list(machines_state)
 
     def destroy(self, wipe=False):
         if self.state == self.UP:
@@ -2,23 +2,38 @@
 
 # Automatic provisioning of GSE Buckets
 
+import copy
+import json
 import os
 import re
+import threading
 import libcloud.common.google
 
 from nixops.util import attr_property
+from nixops_gcp.cassette import CassetteConnection, cassette
 from nixops_gcp.gcp_common import (
     ResourceDefinition,
     ResourceState,
     optional_string,
     optional_int,
     optional_bool,
+    api_endpoint,
+    instrumented_request,
+    use_api_endpoint,
 )
+from nixops_gcp.metrics import current_resource
+from nixops_gcp.token_cache import SharedCredential, offline_token_file, token_cache
 
 from typing import Dict, Optional
 from .types.gse_bucket import GseBucketOptions, LifecycleOptions, ConditionsOptions
 
 
+def sorted_rules(rules):
+    # rules are dicts, which can't be compared, so they are ordered by
+    # their JSON form
+    return sorted(rules, key=lambda r: json.dumps(r, sort_keys=True))
+
+
 class GSEResponse(libcloud.common.google.GoogleResponse):
     pass
 
@@ -28,17 +43,96 @@ class GSEConnection(libcloud.common.google.GoogleBaseConnection):
 
     host = "www.googleapis.com"
     responseCls = GSEResponse
+    conn_class = CassetteConnection
 
     def __init__(self, user_id, key, secure, **kwargs):
         self.scope = ["https://www.googleapis.com/auth/devstorage.read_write"]
-        super(GSEConnection, self).__init__(user_id, key, secure=secure, **kwargs)
+        endpoint = api_endpoint()
+        if endpoint is None and not cassette.replaying:
+            # share the cached token of the compute driver for this account
+            # and key
+            token_path = token_cache.path(user_id, key)
+            with token_cache.locked(token_path):
+                super(GSEConnection, self).__init__(
+                    user_id, key, secure=secure, credential_file=token_path, **kwargs
+                )
+            self.oauth2_credential = SharedCredential(
+                self.oauth2_credential, token_path
+            )
+        else:
+            super(GSEConnection, self).__init__(
+                user_id,
+                key,
+                secure=secure,
+                auth_type="IA",
+                credential_file=offline_token_file(),
+                **kwargs
+            )
+            if endpoint is not None:
+                use_api_endpoint(self, endpoint)
         self.request_path = "/storage/v1/b"
 
-    def _get_token_info_from_file(self):
-        return None
+    def request(
+        self, action, params=None, data=None, headers=None, method="GET", **kwargs
+    ):
+        return instrumented_request(
+            self,
+            action,
+            method,
+            lambda: super(GSEConnection, self).request(
+                action,
+                params=params,
+                data=data,
+                headers=headers,
+                method=method,
+                **kwargs
+            ),
+        )
+
+
+class GSEConnectionPool(object):
+    """
+    Process-wide registry of GSE connections keyed by
+    (service account, access key path).
+
+    As with nixops_gcp.gcp_common.GCEDriverPool, each thread gets its own
+    connection, cloned from a single authenticated one whose credential
+    they share.
+    """
 
-    def _write_token_info_to_file(self):
-        return
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._local = threading.local()
+
+    def get(self, service_account, access_key_path):
+        key = (service_account, access_key_path)
+        connections = self._local.__dict__.setdefault("connections", {})
+        connection = connections.get(key)
+        if connection is None:
+            connection = self._clone(self._template(key))
+            connections[key] = connection
+        return connection
+
+    def _template(self, key):
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None:
+                template = GSEConnection(*key, secure=True)
+                self._templates[key] = template
+            return template
+
+    @staticmethod
+    def _clone(template):
+        connection = copy.copy(template)
+        # the clone gets its own HTTP connection and request state
+        connection.connection = None
+        connection.context = {}
+        connection.connect()
+        return connection
+
+
+gse_connections = GSEConnectionPool()
 
 
 class GSEBucketDefinition(ResourceDefinition):
@@ -59,9 +153,17 @@ class GSEBucketDefinition(ResourceDefinition):
 
         self.bucket_name = self.config.name
 
-        self.cors = dict(self.config.cors)
-        self.cors["methods"] = list(self.config.cors.methods)
-        self.cors["origins"] = list(self.config.cors.origins)
+        self.cors = sorted_rules(
+            [
+                {
+                    "origins": sorted(c.origins),
+                    "methods": sorted(c.methods),
+                    "response_headers": sorted(c.responseHeaders),
+                    "max_age_seconds": c.maxAgeSeconds,
+                }
+                for c in self.config.cors
+            ]
+        )
 
         def parse_lifecycle(x: LifecycleOptions) -> Dict:
             created_before = x.conditions.createdBefore
@@ -84,7 +186,9 @@ class GSEBucketDefinition(ResourceDefinition):
                 "number_of_newer_versions": x.conditions.numberOfNewerVersions,
             }
 
-        self.lifecycle = [parse_lifecycle(x) for x in self.config.lifecycle]
+        self.lifecycle = sorted_rules(
+            [parse_lifecycle(x) for x in self.config.lifecycle]
+        )
 
         if any(
             all(v is None for k, v in r.items() if k != "action")
@@ -148,9 +252,8 @@ class GSEBucketState(ResourceState):
         return "GSE bucket '{0}'".format(self.bucket_name)
 
     def connect(self):
-        if not self._conn:
-            self._conn = GSEConnection(self.service_account, self.access_key_path, True)
-        return self._conn
+        current_resource.set(self.name)
+        return gse_connections.get(self.service_account, self.access_key_path)
 
     defn_properties = [
         "cors",
@@ -266,7 +369,7 @@ class GSEBucketState(ResourceState):
                         b.get("website", {}).get("notFoundPage", None),
                     )
 
-                    actual_cors = sorted(
+                    actual_cors = sorted_rules(
                         [
                             {
                                 "origins": sorted(c.get("origin", [])),
@@ -281,7 +384,7 @@ class GSEBucketState(ResourceState):
                         "cors", actual_cors, property_name="CORS config"
                     )
 
-                    actual_lifecycle = sorted(
+                    actual_lifecycle = sorted_rules(
                         [
                             {
                                 "action": r.get("action", {}).get("type", None),
@@ -0,0 +1,22 @@
+from typing import Optional, Sequence
+from nixops.resources import ResourceOptions
+
+
+class AutoscalingOptions(ResourceOptions):
+    coolDownPeriod: int
+    cpuUtilization: float
+    maxReplicas: Optional[int]
+    minReplicas: int
+
+
+class GceInstanceGroupManagerOptions(ResourceOptions):
+    accessKey: str
+    autoscaling: AutoscalingOptions
+    baseInstanceName: str
+    instanceTemplate: str
+    name: str
+    project: str
+    region: str
+    serviceAccount: str
+    targetPools: Sequence[str]
+    targetSize: int
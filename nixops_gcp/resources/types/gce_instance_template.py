@@ -0,0 +1,21 @@
+from typing import Mapping, Optional, Sequence
+from nixops.resources import ResourceOptions
+
+from nixops_gcp.backends.options import ImageOptions
+
+
+class GceInstanceTemplateOptions(ResourceOptions):
+    accessKey: str
+    canIpForward: bool
+    image: ImageOptions
+    instanceType: str
+    labels: Mapping[str, str]
+    metadata: Mapping[str, str]
+    name: str
+    network: Optional[str]
+    preemptible: bool
+    project: str
+    rootDiskSize: Optional[int]
+    rootDiskType: str
+    serviceAccount: str
+    tags: Sequence[str]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Retention of machine backups: which backups to keep when keeping the
+# newest backup of each of the last N hours, days and weeks.
+
+import datetime
+
+# format of the backup ids nixops generates
+BACKUP_ID_FORMAT = "%Y%m%d%H%M%S"
+
+# strftime keys identifying the period a backup falls into
+PERIODS = [
+    ("hourly", "%Y%m%d%H"),
+    ("daily", "%Y%m%d"),
+    ("weekly", "%G%V"),
+]
+
+
+def backup_time(backup_id):
+    try:
+        return datetime.datetime.strptime(backup_id, BACKUP_ID_FORMAT)
+    except ValueError:
+        return None
+
+
+def backups_to_prune(backup_ids, policy, keep=()):
+    """
+    Return the ids of the backups which the policy doesn't retain, newest
+    first.
+
+    policy maps "hourly", "daily" and "weekly" to the number of such
+    periods to keep the newest backup of, or None. A backup is kept if
+    any period keeps it; nothing is pruned if no count is set. Ids which
+    aren't timestamps, and those in keep, e.g. the backup just taken, are
+    never pruned.
+    """
+    for name, _ in PERIODS:
+        count = policy.get(name)
+        if count is not None and count < 1:
+            raise Exception(
+                "backupRetention.{0} must be a positive integer".format(name)
+            )
+    counts = [(policy.get(name), key) for name, key in PERIODS]
+    if all(count is None for count, _ in counts):
+        return []
+
+    dated = sorted(
+        ((backup_time(b), b) for b in backup_ids if backup_time(b) is not None),
+        reverse=True,
+    )
+    keep = set(keep)
+    for count, key in counts:
+        if count is None:
+            continue
+        periods = set()
+        for time, backup_id in dated:
+            period = time.strftime(key)
+            if period in periods:
+                continue
+            if len(periods) == count:
+                break
+            periods.add(period)
+            keep.add(backup_id)
+    return [b for _, b in dated if b not in keep]
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Rate limiting and retries of GCE API calls.
+#
+# Requests are spread over time with a token bucket per project and quota
+# (read or write requests), so that a deployment with a large fan-out
+# stays below the per-minute API quotas instead of tripping them. Calls
+# which are throttled or fail transiently anyway are retried with jittered
+# exponential backoff, honoring the Retry-After header if the API sent one.
+
+import email.utils
+import os
+import random
+import threading
+import time
+
+from libcloud.common.google import GoogleBaseError
+
+# reasons the API gives for throttled requests; these are never carried out,
+# so they can be retried whatever the method
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+RATE_LIMIT_STATUSES = {429}
+
+# transient server errors; the request may have been carried out, so only
+# idempotent requests are retried
+TRANSIENT_REASONS = {"backendError", "internalError"}
+TRANSIENT_STATUSES = {500, 502, 503, 504}
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+
+
+class TokenBucket(object):
+    """
+    Hands out up to rate tokens per second, allowing bursts of up to burst
+    tokens. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available and take them."""
+        if self.rate <= 0:
+            return
+        # calls costing more than a burst, e.g. large batches, drain the
+        # bucket and wait for it to refill
+        tokens = min(tokens, self.burst)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def penalize(self, delay):
+        """Hand out no tokens for the next delay seconds."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._tokens = min(self._tokens, 0) - delay * self.rate
+
+
+class RateLimiter(object):
+    """
+    Token buckets keyed by (project, quota).
+
+    The rates are $NIXOPS_GCP_READ_RATE and $NIXOPS_GCP_WRITE_RATE
+    requests per second (20 and 10 if unset), matching the default
+    per-minute Compute API quotas; 0 disables the limit.
+    """
+
+    def __init__(self, rates=None):
+        self.rates = rates or {
+            "read": float(os.environ.get("NIXOPS_GCP_READ_RATE", 20)),
+            "write": float(os.environ.get("NIXOPS_GCP_WRITE_RATE", 10)),
+        }
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, project, quota):
+        with self._lock:
+            key = (project, quota)
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rates[quota])
+            return self._buckets[key]
+
+
+class RetryPolicy(object):
+    """
+    Retries API calls failing with retryable errors.
+
+    A call is tried up to $NIXOPS_GCP_MAX_RETRIES more times (5 if unset).
+    The n-th retry waits for a random time up to base * 2**n seconds,
+    capped at max_delay, or as long as the API asked with Retry-After if
+    that is longer.
+    """
+
+    base = 1.0
+    max_delay = 32.0
+
+    def __init__(self, max_retries=None):
+        if max_retries is None:
+            max_retries = int(os.environ.get("NIXOPS_GCP_MAX_RETRIES", 5))
+        self.max_retries = max_retries
+
+    def is_retryable(self, error, idempotent):
+        if not isinstance(error, GoogleBaseError):
+            return False
+        if error.http_code in RATE_LIMIT_STATUSES or error.code in RATE_LIMIT_REASONS:
+            return True
+        if not idempotent:
+            return False
+        return error.http_code in TRANSIENT_STATUSES or error.code in TRANSIENT_REASONS
+
+    def delay(self, attempt, error=None):
+        delay = random.uniform(0, min(self.max_delay, self.base * 2**attempt))
+        return max(delay, retry_after(error))
+
+    def call(self, request, idempotent, bucket=None):
+        """
+        Call request() until it succeeds, it fails with an error which
+        isn't retryable or the retries are used up. Transient server
+        errors are only retried if the request is idempotent. If the API
+        asked to wait, bucket is emptied for as long, so that concurrent
+        calls back off too.
+        """
+        attempt = 0
+        while True:
+            try:
+                return request()
+            except GoogleBaseError as e:
+                if attempt >= self.max_retries or not self.is_retryable(e, idempotent):
+                    raise
+                delay = self.delay(attempt, e)
+                if bucket is not None and retry_after(e):
+                    bucket.penalize(delay)
+                time.sleep(delay)
+                attempt += 1
+
+
+def retry_after(error):
+    """Return the seconds to wait the Retry-After header of an error asked for."""
+    value = getattr(error, "retry_after", None)
+    if not value:
+        return 0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    return max(0.0, when.timestamp() - time.time())
+
+
+rate_limits = RateLimiter()
+retry_policy = RetryPolicy()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of OAuth2 tokens shared by the GCE and GSE connections.
+
+import atexit
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+
+# same format libcloud uses for the "expire_time" field of a token
+EXPIRE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def default_cache_dir():
+    return os.environ.get("NIXOPS_GCP_TOKEN_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "nixops-gcp",
+        "tokens",
+    )
+
+
+def key_digest(key):
+    """
+    Return a digest of a service account key, given as the path of the
+    key file or as the key itself, as libcloud accepts both. A key file
+    is hashed by its contents, so that a rotated key gets tokens of its
+    own.
+    """
+    if key is None:
+        return None
+    try:
+        with open(key, "rb") as f:
+            data = f.read()
+    except (OSError, TypeError, ValueError):
+        data = key.encode("utf-8") if isinstance(key, str) else key
+    return hashlib.sha256(data).hexdigest()
+
+
+class TokenCache(object):
+    """
+    Directory of cached OAuth2 tokens, one file per service account, key
+    and scope set, in the format libcloud reads and writes.
+
+    Readers and writers take an exclusive lock on a side file so that
+    concurrent nixops processes don't clobber each other's tokens.
+    """
+
+    # tokens expiring within this many seconds are treated as expired
+    expiry_margin = 120
+
+    def __init__(self, directory=None):
+        self.directory = directory or default_cache_dir()
+
+    def path(self, user_id, key=None, scopes=None):
+        digest = hashlib.sha256(
+            json.dumps([user_id, key_digest(key), sorted(scopes or [])]).encode("utf-8")
+        ).hexdigest()[:16]
+        safe_user_id = re.sub("[^A-Za-z0-9@._-]", "_", user_id or "")
+        return os.path.join(self.directory, "{0}-{1}".format(safe_user_id, digest))
+
+    @contextlib.contextmanager
+    def locked(self, path):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        with open(path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def is_valid(self, token):
+        try:
+            expire_time = datetime.datetime.strptime(
+                token["expire_time"], EXPIRE_TIME_FORMAT
+            )
+        except (KeyError, TypeError, ValueError):
+            return False
+        margin = datetime.timedelta(seconds=self.expiry_margin)
+        return expire_time - margin > datetime.datetime.utcnow()
+
+    def load(self, path):
+        """Return the cached token at path, or None if it is missing or stale."""
+        try:
+            with open(path) as f:
+                token = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return token if self.is_valid(token) else None
+
+    def store(self, path, token):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".token-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(token, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+token_cache = TokenCache()
+
+_offline_token_file = None
+_offline_token_lock = threading.Lock()
+
+
+def offline_token_file():
+    """
+    Return the path of a credential file holding a token that never
+    expires, for connections to an API endpoint which doesn't check
+    tokens, e.g. nixops_gcp.fake_gcp, or replaying a cassette. The file
+    is removed on exit.
+    """
+    global _offline_token_file
+    with _offline_token_lock:
+        if _offline_token_file is None:
+            fd, path = tempfile.mkstemp(prefix="nixops-gcp-token-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(
+                    {
+                        "access_token": "offline",
+                        "token_type": "Bearer",
+                        "expire_time": "2999-12-31T23:59:59Z",
+                    },
+                    f,
+                )
+            atexit.register(os.unlink, path)
+            _offline_token_file = path
+        return _offline_token_file
+
+
+class SharedCredential(object):
+    """
+    Wrapper around a libcloud OAuth2 credential which lets several
+    connections use it at once. Token refreshes are serialized and go
+    through the on-disk cache, so a token refreshed by another process is
+    picked up instead of requesting a new one.
+    """
+
+    def __init__(self, credential, path, cache=token_cache):
+        self._credential = credential
+        self._path = path
+        self._cache = cache
+        self._lock = threading.Lock()
+
+    @property
+    def access_token(self):
+        with self._lock:
+            credential = self._credential
+            if not self._cache.is_valid(credential.token):
+                with self._cache.locked(self._path):
+                    token = self._cache.load(self._path)
+                    if token is None:
+                        token = credential.oauth2_conn.refresh_token(credential.token)
+                        self._cache.store(self._path, token)
+                    credential.token = token
+            return credential.token["access_token"]
+
+    def __getattr__(self, name):
+        return getattr(self._credential, name)
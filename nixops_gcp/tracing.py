@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# Tracing of resource lifecycle phases.
+#
+# If $NIXOPS_GCP_TRACE_FILE is set, the create, create_node, _check, backup,
+# restore, destroy and after_activation methods of every resource, the API
+# requests they make and the operations they wait for are recorded as spans
+# of a single trace per nixops command. The spans are appended to that file
+# as OTLP/JSON lines, which the OpenTelemetry collector's otlpjsonfile
+# receiver and most trace viewers can import, so the critical path of a
+# deploy can be looked at.
+
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+# the span new spans of the current thread are children of
+current_span = contextvars.ContextVar("nixops_gcp_span", default=None)
+
+
+class Span(object):
+    """A timed operation, exported once it ended."""
+
+    def __init__(self, tracer, name, parent, kind, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.kind = kind
+        self.attributes = attributes
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        self.end_time = time.time_ns()
+        self.error = error
+        self.tracer._finish(self)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.tracer.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": otlp_attributes(self.attributes),
+            "status": {"code": STATUS_UNSET},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            span["status"] = {"code": STATUS_ERROR, "message": str(self.error)}
+        return span
+
+
+class _NoSpan(object):
+    """Stands in for spans while tracing is disabled."""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def end(self, error=None):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Tracer(object):
+    """
+    Records spans and exports them in batches of batch_size, and the rest
+    when the process exits. Spans without a parent are children of a root
+    span covering the whole command.
+    """
+
+    batch_size = 512
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("NIXOPS_GCP_TRACE_FILE")
+        self.trace_id = os.urandom(16).hex()
+        self.root = None
+        self._finished = []
+        self._lock = threading.Lock()
+        if self.path:
+            self.root = Span(
+                self, "nixops", None, SPAN_KIND_INTERNAL, {"command": sys.argv}
+            )
+            atexit.register(self.shutdown)
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def start_span(self, name, kind=SPAN_KIND_INTERNAL, parent=None, **attributes):
+        """
+        Start a span, by default a child of the current one; it is
+        exported once its end() is called.
+        """
+        if not self.enabled:
+            return NO_SPAN
+        return Span(
+            self, name, parent or current_span.get() or self.root, kind, attributes
+        )
+
+    @contextlib.contextmanager
+    def span(self, name, kind=SPAN_KIND_INTERNAL, **attributes):
+        """Record the block as a span and make it the current one."""
+        span = self.start_span(name, kind, **attributes)
+        if span is NO_SPAN:
+            yield span
+            return
+        token = current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            current_span.reset(token)
+            span.end(error)
+
+    def _finish(self, span):
+        with self._lock:
+            self._finished.append(span)
+            if len(self._finished) >= self.batch_size:
+                self._export()
+
+    def _export(self):
+        spans, self._finished = self._finished, []
+        if not spans:
+            return
+        record = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": otlp_attributes(
+                            {"service.name": "nixops", "process.pid": os.getpid()}
+                        )
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "nixops_gcp"},
+                            "spans": [s.to_otlp() for s in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def shutdown(self):
+        self.root.end()
+        with self._lock:
+            self._export()
+
+
+def otlp_attributes(attributes):
+    return [
+        {"key": key, "value": otlp_value(value)}
+        for key, value in attributes.items()
+        if value is not None
+    ]
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def traced_method(method, name):
+    """
+    Wrap a method of a resource so that each call is recorded as a span
+    named after the resource type and the method.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with tracer.span(
+            "{0} {1}".format(self.get_type(), name), **{"nixops.resource": self.name}
+        ):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+tracer = Tracer()
@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+import unittest
+
+from libcloud.common.google import ResourceNotFoundError
+
+from nixops_gcp.batch import CallCoalescer, ComputeBatch, parse_multipart
+from nixops_gcp.fake_gcp import FakeGCP, serve_batch
+
+
+class Response(object):
+    def __init__(self, content_type, body, status=200):
+        self.headers = {"content-type": content_type}
+        self.body = body
+        self.status = status
+
+
+class FakeConnection(object):
+    """Sends batch requests to a FakeGCP, keeping what was sent."""
+
+    request_path = "/compute/v1/projects/test-project"
+    pool_key = ("test-project", None, None)
+
+    def __init__(self):
+        self.api = FakeGCP()
+        self.requests = []
+
+    def morph_action_hook(self, action):
+        return self.request_path + action
+
+    def pooled_connection(self):
+        return lambda: self
+
+    def request(self, action, method, data, headers, **kwargs):
+        self.requests.append((action, method, data, headers))
+        boundary, body = serve_batch(self.api, data, headers["Content-Type"])
+        return Response("multipart/mixed; boundary=" + boundary, body)
+
+
+class ParseMultipartTest(unittest.TestCase):
+    def test_parts_are_mapped_by_content_id(self):
+        body = (
+            "--batch_x\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-ID: <response-1>\r\n"
+            "\r\n"
+            "HTTP/1.1 404 Not Found\r\n"
+            "Content-Type: application/json\r\n"
+            "\r\n"
+            '{"error": {"code": 404}}\r\n'
+            "--batch_x\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-ID: <response-0>\r\n"
+            "\r\n"
+            "HTTP/1.1 200 OK\r\n"
+            "\r\n"
+            '{"name": "a"}\r\n'
+            "--batch_x--\r\n"
+        )
+        parts = list(
+            parse_multipart(Response('multipart/mixed; boundary="batch_x"', body))
+        )
+        self.assertEqual(
+            parts, [(1, 404, '{"error": {"code": 404}}'), (0, 200, '{"name": "a"}')]
+        )
+
+
+class ComputeBatchTest(unittest.TestCase):
+    def test_round_trip(self):
+        connection = FakeConnection()
+        batch = ComputeBatch(connection)
+        network = batch.add("/global/networks/default", method="GET")
+        missing = batch.add("/zones/europe-west1-b/disks/missing", method="GET")
+        address = batch.add(
+            "/regions/europe-west1/addresses", data={"name": "ip"}, resource="ip"
+        )
+
+        with self.assertRaises(ResourceNotFoundError):
+            batch.execute(wait=False)
+
+        [(action, method, data, headers)] = connection.requests
+        self.assertEqual(method, "POST")
+        self.assertTrue(
+            headers["Content-Type"].startswith("multipart/mixed; boundary=batch_")
+        )
+        self.assertIn(
+            "GET /compute/v1/projects/test-project/global/networks/default", data
+        )
+        self.assertIn(json.dumps({"name": "ip"}), data)
+
+        self.assertEqual(network.object["name"], "default")
+        self.assertIsNone(network.error)
+        self.assertIsInstance(missing.error, ResourceNotFoundError)
+        self.assertEqual(address.object["kind"], "compute#operation")
+
+
+class CallCoalescerTest(unittest.TestCase):
+    action = "/zones/europe-west1-b/instances"
+
+    def test_a_lone_call_is_sent_right_away(self):
+        connection = FakeConnection()
+        coalescer = CallCoalescer(window=5)
+        started = time.time()
+
+        call = coalescer.call(connection, self.action, {"name": "a"})
+
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(call.object["status"], "DONE")
+        self.assertEqual(len(connection.requests), 1)
+
+    def test_expected_calls_are_sent_together(self):
+        connection = FakeConnection()
+        coalescer = CallCoalescer(window=5)
+        expecting = threading.Barrier(3)
+        calls = {}
+
+        def create(name):
+            with coalescer.expecting(connection.pool_key):
+                expecting.wait()
+                calls[name] = coalescer.call(connection, self.action, {"name": name})
+
+        threads = [threading.Thread(target=create, args=(n,)) for n in "abc"]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # no need to wait for the window once everybody joined
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(len(connection.requests), 1)
+        self.assertEqual(sorted(calls), ["a", "b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
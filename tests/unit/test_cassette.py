@@ -0,0 +1,216 @@
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from nixops_gcp import (
+    batch,
+    cassette,
+    gcp_common,
+    image_cache,
+    inventory,
+    operations,
+)
+from nixops_gcp.benchmark import SyntheticDeployment, deployment_spec
+from nixops_gcp.fake_gcp import FakeGCP, FakeGCPServer
+from nixops_gcp.resources import gse_bucket
+
+# a machine with a data disk, a network with a firewall rule and a bucket
+SPEC = dict(deployment_spec(1, 2, 1, 1, 1), target_pools=0)
+
+# recorded by CassetteTest.record() against nixops_gcp.fake_gcp with
+# --operation-duration 0.05
+DEPLOY_CASSETTE = os.path.join(os.path.dirname(__file__), "cassettes", "deploy.jsonl")
+
+
+def summary(d):
+    machine, network, bucket = (
+        d.states["machine-0"],
+        d.states["network"],
+        d.states["bucket-0"],
+    )
+    # what a deploy got from the API
+    return (
+        machine.vm_id,
+        machine.public_ipv4,
+        sorted(machine.block_device_mapping),
+        network.network_name,
+        sorted(network.firewall),
+        bucket.bucket_name,
+        bucket.region,
+    )
+
+
+def recorded_waits(path):
+    with open(path) as f:
+        return [i for i in map(json.loads, f) if i["url"].endswith("/wait")]
+
+
+class CassetteTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.state_files = (
+            os.path.join(self.directory, "state-{0}.nixops".format(i))
+            for i in itertools.count()
+        )
+
+    def use(self, c, endpoint=None):
+        """
+        Run the plugin as a new command would, with the cassette c and
+        requests going to endpoint, and return its operation waiter.
+        """
+        # responses to the same URL are replayed in the recorded order,
+        # which disk listings depend on, so disks are created one by one
+        environ = {"HOME": self.directory, "NIXOPS_GCP_DISK_PARALLEL": "1"}
+        if endpoint is not None:
+            environ["NIXOPS_GCP_API_ENDPOINT"] = endpoint
+        waiter = operations.OperationWaiter()
+        # operations of the fake API take 50ms
+        waiter.min_interval = 0.05
+        patchers = [
+            mock.patch.dict(os.environ, environ),
+            mock.patch.object(cassette, "cassette", c),
+            mock.patch.object(gcp_common, "cassette", c),
+            mock.patch.object(gse_bucket, "cassette", c),
+            mock.patch.object(gcp_common, "gce_drivers", gcp_common.GCEDriverPool()),
+            mock.patch.object(gcp_common, "gce_images", image_cache.ImageCache()),
+            mock.patch.object(
+                gcp_common, "gce_inventories", inventory.InventoryCache()
+            ),
+            mock.patch.object(
+                gse_bucket, "gse_connections", gse_bucket.GSEConnectionPool()
+            ),
+            mock.patch.object(gcp_common, "operation_waiter", waiter),
+            mock.patch.object(batch, "operation_waiter", waiter),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        if endpoint is None:
+            os.environ.pop("NIXOPS_GCP_API_ENDPOINT", None)
+        return waiter
+
+    def deployment(self):
+        return SyntheticDeployment(SPEC, next(self.state_files))
+
+    def record(self, path, poll=False):
+        """
+        Deploy to a fake API while recording into the cassette at path,
+        polling operations if poll is set, and return the deployment.
+        """
+        server = FakeGCPServer(FakeGCP(operation_duration=0.05)).start()
+        try:
+            recorder = cassette.Cassette(path, "record")
+            waiter = self.use(recorder, server.url)
+            waiter.use_wait_endpoint = not poll
+            d = self.deployment()
+            d.create()
+            recorder.save()
+            return d
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_replay_serves_what_was_recorded(self):
+        path = os.path.join(self.directory, "deploy.jsonl.gz")
+        recorded = self.record(path)
+
+        # the server is gone, so every response comes from the cassette
+        c = cassette.Cassette(path, "replay", 0)
+        self.use(c)
+        replayed = self.deployment()
+        replayed.create()
+
+        self.assertEqual(summary(replayed), summary(recorded))
+        self.assertTrue(all(i["used"] for v in c._load().values() for i in v))
+
+    def test_polled_operations_are_polled_on_replay(self):
+        path = os.path.join(self.directory, "deploy.jsonl")
+        recorded = self.record(path, poll=True)
+        self.assertEqual(recorded_waits(path), [])
+
+        waiter = self.use(cassette.Cassette(path, "replay", 0))
+        replayed = self.deployment()
+        replayed.create()
+
+        self.assertEqual(summary(replayed), summary(recorded))
+        self.assertFalse(waiter.use_wait_endpoint)
+
+    def test_recorded_deploy_is_replayed(self):
+        self.assertNotEqual(recorded_waits(DEPLOY_CASSETTE), [])
+        waiter = self.use(cassette.Cassette(DEPLOY_CASSETTE, "replay", 0))
+        d = self.deployment()
+
+        d.create()
+
+        machine, network, bucket = (
+            d.states["machine-0"],
+            d.states["network"],
+            d.states["bucket-0"],
+        )
+        self.assertEqual(machine.vm_id, "machine-0")
+        self.assertIsNotNone(machine.public_ipv4)
+        self.assertEqual(
+            sorted(machine.block_device_mapping),
+            sorted(d.definitions["machine-0"].block_device_mapping),
+        )
+        self.assertEqual(network.state, network.UP)
+        self.assertEqual(
+            sorted(network.firewall), sorted(d.definitions["network"].firewall)
+        )
+        self.assertEqual(bucket.state, bucket.UP)
+        self.assertTrue(waiter.use_wait_endpoint)
+
+    def test_recorded_deploy_is_replayed_with_scaled_timing(self):
+        c = cassette.Cassette(DEPLOY_CASSETTE, "replay", 2)
+        self.use(c)
+        d = self.deployment()
+
+        # the network and its firewall rule are created one call after the
+        # other, so the replay takes at least as long as those calls did
+        started = time.monotonic()
+        d.states["network"].create(
+            d.definitions["network"],
+            check=False,
+            allow_reboot=False,
+            allow_recreate=False,
+        )
+        elapsed = time.monotonic() - started
+
+        used = [i for v in c._load().values() for i in v if i["used"]]
+        self.assertTrue(used)
+        self.assertGreaterEqual(elapsed, 2 * sum(i["duration"] for i in used))
+
+    def test_unrecorded_requests_fail(self):
+        self.use(cassette.Cassette(DEPLOY_CASSETTE, "replay", 0))
+        d = self.deployment()
+        network = d.states["network"]
+        network.copy_credentials(d.definitions["network"])
+        with self.assertRaisesRegex(Exception, "no response to GET"):
+            network.connect().ex_get_network("unknown")
+
+    def test_invalid_settings_fail_on_first_use(self):
+        with mock.patch.dict(
+            os.environ,
+            {"NIXOPS_GCP_CASSETTE": DEPLOY_CASSETTE, "NIXOPS_GCP_CASSETTE_MODE": "x"},
+        ):
+            c = cassette.Cassette()
+            with self.assertRaisesRegex(Exception, "must be 'record' or 'replay'"):
+                c.replaying
+
+        with mock.patch.dict(
+            os.environ,
+            {"NIXOPS_GCP_CASSETTE": DEPLOY_CASSETTE, "NIXOPS_GCP_REPLAY_SCALE": "x"},
+        ):
+            c = cassette.Cassette()
+            with self.assertRaisesRegex(Exception, "must be a number"):
+                c.replaying
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,23 @@
+import unittest
+
+from nixops_gcp.gcp_common import GCEConnection
+
+
+class DefaultHeadersTest(unittest.TestCase):
+    def setUp(self):
+        # only the host is needed to add the default headers
+        self.connection = GCEConnection.__new__(GCEConnection)
+        self.connection.host = "www.googleapis.com"
+
+    def test_content_type_of_batch_requests_is_kept(self):
+        content_type = "multipart/mixed; boundary=batch_x"
+        headers = self.connection.add_default_headers({"Content-Type": content_type})
+        self.assertEqual(headers["Content-Type"], content_type)
+
+    def test_requests_default_to_json(self):
+        headers = self.connection.add_default_headers({})
+        self.assertEqual(headers["Content-Type"], "application/json")
+
+
+if __name__ == "__main__":
+    unittest.main()
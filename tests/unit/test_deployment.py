@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from nixops_gcp import gcp_common, image_cache, inventory
+from nixops_gcp.benchmark import (
+    PROJECT,
+    ZONE,
+    SyntheticDeployment,
+    deployment_spec,
+    options,
+)
+from nixops_gcp.fake_gcp import FakeGCP, FakeGCPServer
+from nixops_gcp.resources import gse_bucket
+from nixops_gcp.resources.types.gse_bucket import CorsOptions
+
+
+class DeploymentTest(unittest.TestCase):
+    """Deploys a synthetic deployment of the given spec to a fake API."""
+
+    spec = None
+
+    def setUp(self):
+        # operations take long enough for a concurrent one to be rejected
+        self.api = FakeGCP(operation_duration=0.05)
+        server = FakeGCPServer(self.api).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+
+        # the driver pools and snapshots are fresh, as in a new command
+        for patcher in [
+            mock.patch.dict(
+                os.environ, {"NIXOPS_GCP_API_ENDPOINT": server.url, "HOME": home}
+            ),
+            mock.patch.object(gcp_common, "gce_drivers", gcp_common.GCEDriverPool()),
+            mock.patch.object(gcp_common, "gce_images", image_cache.ImageCache()),
+            mock.patch.object(
+                gcp_common, "gce_inventories", inventory.InventoryCache()
+            ),
+            mock.patch.object(
+                gse_bucket, "gse_connections", gse_bucket.GSEConnectionPool()
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.deployment = SyntheticDeployment(
+            self.spec, os.path.join(home, "state.nixops")
+        )
+
+
+class MachineUpdateTest(DeploymentTest):
+    spec = deployment_spec(1, 1, 0, 1, 0)
+
+    def instance(self):
+        status, body = self.api.handle(
+            "GET",
+            "/compute/v1/projects/{0}/zones/{1}/instances/machine-0".format(
+                PROJECT, ZONE
+            ),
+            {},
+            None,
+        )
+        self.assertEqual(status, 200)
+        return body
+
+    def test_labels_metadata_and_tags_change_together(self):
+        d = self.deployment
+        d.create()
+        d.definitions["machine-0"] = d.machine(
+            "machine-0",
+            labels={"deployment": "benchmark", "role": "db"},
+            metadata={"role": "db"},
+            tags=["benchmark", "db"],
+        )
+
+        d.create()
+
+        instance = self.instance()
+        self.assertEqual(instance["labels"], {"deployment": "benchmark", "role": "db"})
+        self.assertIn(
+            {"key": "role", "value": "db"}, instance["metadata"].get("items", [])
+        )
+        self.assertEqual(instance["tags"]["items"], ["benchmark", "db"])
+        machine = d.states["machine-0"]
+        self.assertEqual(machine.labels, {"deployment": "benchmark", "role": "db"})
+        self.assertEqual(machine.metadata, {"role": "db"})
+        self.assertEqual(machine.tags, ["benchmark", "db"])
+
+
+class BucketTest(DeploymentTest):
+    spec = deployment_spec(0, 0, 0, 1, 1)
+
+    def test_cors_rules_are_checked(self):
+        d = self.deployment
+        rules = [
+            options(
+                CorsOptions,
+                origins=["https://b.example.com"],
+                methods=["GET"],
+                maxAgeSeconds=60,
+            ),
+            options(
+                CorsOptions,
+                origins=["https://a.example.com"],
+                methods=["PUT", "GET"],
+                maxAgeSeconds=3600,
+            ),
+        ]
+        d.definitions["bucket-0"] = d.bucket("bucket-0", cors=rules)
+        d.create()
+
+        d.deploy_check()
+
+        bucket = d.states["bucket-0"]
+        self.assertEqual(len(bucket.cors), 2)
+        self.assertEqual(bucket.cors, d.definitions["bucket-0"].cors)
+        # the order of the rules doesn't matter
+        reordered = d.bucket("bucket-0", cors=rules[::-1])
+        self.assertEqual(reordered.cors, d.definitions["bucket-0"].cors)
@@ -0,0 +1,65 @@
+import unittest
+import urllib.parse
+
+import libcloud.compute.drivers.gce
+
+from nixops_gcp.fake_gcp import FakeGCP, FakeGCPServer
+from nixops_gcp.inventory import Inventory
+from nixops_gcp.token_cache import offline_token_file
+
+ZONE = "europe-west1-b"
+
+
+def driver(endpoint):
+    d = libcloud.compute.drivers.gce.GCENodeDriver(
+        "test@test-project.iam.gserviceaccount.com",
+        "key",
+        project="test-project",
+        auth_type="IA",
+        credential_file=offline_token_file(),
+    )
+    parts = urllib.parse.urlsplit(endpoint)
+    d.connection.host, d.connection.port = parts.hostname, parts.port
+    d.connection.secure = False
+    d.connection.connection = None
+    return d
+
+
+class InventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGCPServer(FakeGCP()).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.driver = driver(self.server.url)
+        boot = self.driver.create_volume(10, "machine-root", location=ZONE)
+        self.driver.create_node(
+            "machine", "n1-standard-1", None, location=ZONE, ex_boot_disk=boot
+        )
+
+    def test_nodes_are_resolved_from_the_snapshot(self):
+        inventory = Inventory.fetch(self.driver)
+        calls = sum(self.server.api.calls.values())
+        volumes = self.driver._ex_volume_dict
+
+        node = inventory.node(self.driver, "machine", ZONE)
+
+        self.assertEqual(node.name, "machine")
+        self.assertEqual(node.extra["boot_disk"].name, "machine-root")
+        self.assertEqual(len(node.extra["disks"]), 1)
+        self.assertEqual(sum(self.server.api.calls.values()), calls)
+        # the driver's own volume cache is left alone
+        self.assertIs(self.driver._ex_volume_dict, volumes)
+
+    def test_nodes_missing_from_the_snapshot_are_fetched(self):
+        inventory = Inventory.fetch(self.driver)
+        inventory.forget("instances", "machine")
+        gets = self.server.api.calls["GET instances"]
+
+        node = inventory.node(self.driver, "machine", ZONE)
+
+        self.assertEqual(node.extra["boot_disk"].name, "machine-root")
+        self.assertEqual(self.server.api.calls["GET instances"], gets + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
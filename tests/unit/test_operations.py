@@ -0,0 +1,111 @@
+import threading
+import unittest
+
+from libcloud.common.google import InvalidRequestError, ResourceNotFoundError
+
+from nixops_gcp.operations import OperationWaiter
+
+
+class Response(object):
+    def __init__(self, object):
+        self.object = object
+
+
+def operation(name, status="RUNNING"):
+    return {
+        "name": name,
+        "status": status,
+        "operationType": "insert",
+        "selfLink": "/zones/europe-west1-b/operations/" + name,
+    }
+
+
+class FakeConnection(object):
+    """
+    Answers a GET of an operation as done, after waiting for an event if
+    one is given, and a wait with the given error.
+    """
+
+    def __init__(self, event=None, wait_error=None, get_error=None):
+        self.event = event
+        self.wait_error = wait_error
+        self.get_error = get_error
+        self.requests = []
+
+    def request(self, action, method):
+        self.requests.append((method, action))
+        if action.endswith("/wait"):
+            raise self.wait_error
+        if self.get_error is not None:
+            raise self.get_error
+        if self.event is not None:
+            self.event.wait(5)
+        return Response(operation(action.split("/")[-1], "DONE"))
+
+
+class Waiter(OperationWaiter):
+    min_interval = 0.01
+
+
+class PollTest(unittest.TestCase):
+    def test_a_slow_poll_doesnt_hold_up_the_others(self):
+        waiter = Waiter()
+        slow = threading.Event()
+        slow_future = waiter.submit(
+            Response(operation("slow")), lambda: FakeConnection(slow)
+        )
+        fast_future = waiter.submit(Response(operation("fast")), FakeConnection)
+
+        self.assertEqual(fast_future.result(5).object["name"], "fast")
+        self.assertFalse(slow_future.done())
+        slow.set()
+        self.assertEqual(slow_future.result(5).object["name"], "slow")
+
+    def test_a_failing_poll_fails_only_its_operation(self):
+        waiter = Waiter()
+        record_duration = waiter._record_duration
+
+        def fail_for_broken(operation, duration):
+            if operation["name"] == "broken":
+                raise ValueError("broken")
+            record_duration(operation, duration)
+
+        waiter._record_duration = fail_for_broken
+        failing = waiter.submit(Response(operation("broken")), FakeConnection)
+        with self.assertRaises(ValueError):
+            failing.result(5)
+
+        future = waiter.submit(Response(operation("fine")), FakeConnection)
+        self.assertEqual(future.result(5).object["name"], "fine")
+
+
+class WaitEndpointTest(unittest.TestCase):
+    def test_missing_endpoint_falls_back_to_polling(self):
+        waiter = Waiter()
+        connection = FakeConnection(wait_error=ResourceNotFoundError("", 404, None))
+
+        response = waiter.wait(Response(operation("a")), connection)
+
+        self.assertEqual(response.object["status"], "DONE")
+        self.assertFalse(waiter.use_wait_endpoint)
+
+    def test_missing_operation_is_raised(self):
+        waiter = Waiter()
+        error = ResourceNotFoundError("", 404, None)
+        connection = FakeConnection(wait_error=error, get_error=error)
+
+        with self.assertRaises(ResourceNotFoundError):
+            waiter.wait(Response(operation("a")), connection)
+        self.assertTrue(waiter.use_wait_endpoint)
+
+    def test_other_errors_are_raised(self):
+        waiter = Waiter()
+        connection = FakeConnection(wait_error=InvalidRequestError("", 400, None))
+
+        with self.assertRaises(InvalidRequestError):
+            waiter.wait(Response(operation("a")), connection)
+        self.assertTrue(waiter.use_wait_endpoint)
+        self.assertEqual(
+            connection.requests,
+            [("POST", "/zones/europe-west1-b/operations/a/wait")],
+        )
@@ -0,0 +1,81 @@
+import unittest
+
+from nixops_gcp.retention import backups_to_prune
+
+# hourly backups over three days, the last two in the same hour
+BACKUPS = [
+    "20260101100000",
+    "20260101110000",
+    "20260102100000",
+    "20260102110000",
+    "20260103100000",
+    "20260103110000",
+    "20260103113000",
+]
+
+
+class BackupsToPruneTest(unittest.TestCase):
+    def test_nothing_is_pruned_without_a_policy(self):
+        self.assertEqual(backups_to_prune(BACKUPS, {}), [])
+        self.assertEqual(backups_to_prune(BACKUPS, {"hourly": None, "daily": None}), [])
+
+    def test_hourly_keeps_the_newest_backup_of_each_hour(self):
+        self.assertEqual(
+            backups_to_prune(BACKUPS, {"hourly": 2}),
+            [
+                "20260103110000",
+                "20260102110000",
+                "20260102100000",
+                "20260101110000",
+                "20260101100000",
+            ],
+        )
+
+    def test_mixed_periods_keep_the_union(self):
+        self.assertEqual(
+            backups_to_prune(BACKUPS, {"hourly": 1, "daily": 2}),
+            [
+                "20260103110000",
+                "20260103100000",
+                "20260102100000",
+                "20260101110000",
+                "20260101100000",
+            ],
+        )
+
+    def test_weekly_uses_iso_weeks(self):
+        # 2026-01-04 is a Sunday, 2026-01-05 starts a new ISO week
+        self.assertEqual(
+            backups_to_prune(
+                ["20260103100000", "20260104100000", "20260105100000"],
+                {"weekly": 1},
+            ),
+            ["20260104100000", "20260103100000"],
+        )
+
+    def test_ids_which_arent_timestamps_are_kept(self):
+        self.assertEqual(
+            backups_to_prune(
+                ["manual", "20260101100000", "20260102100000"], {"daily": 1}
+            ),
+            ["20260101100000"],
+        )
+
+    def test_kept_ids_are_never_pruned(self):
+        self.assertEqual(
+            backups_to_prune(
+                ["20260101100000", "20260101110000"],
+                {"daily": 1},
+                keep=["20260101100000"],
+            ),
+            [],
+        )
+
+    def test_counts_below_one_are_rejected(self):
+        for count in (0, -1):
+            with self.assertRaises(Exception):
+                backups_to_prune(BACKUPS, {"hourly": count})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import threading
+import unittest
+
+import nixops.resources
+from nixops.util import attr_property
+
+from nixops_gcp.gcp_common import ResourceState
+
+
+class StoredState(nixops.resources.ResourceState):
+    # keeps attributes as the state file does: in a text column
+    def __init__(self):
+        self.stored = {}
+
+    def _get_attr(self, name, default=nixops.util.undefined):
+        return self.stored.get(name, default)
+
+    def _set_attrs(self, attrs):
+        for name, value in attrs.items():
+            if value is None:
+                self.stored.pop(name, None)
+            elif isinstance(value, bool):
+                self.stored[name] = "1" if value else "0"
+            else:
+                self.stored[name] = str(value)
+
+
+class BatchedState(ResourceState, StoredState):
+    flag = attr_property("test.flag", False, bool)
+    count = attr_property("test.count", None, int)
+    settings = attr_property("test.settings", {}, "json")
+
+    def __init__(self):
+        StoredState.__init__(self)
+        self._batch_lock = threading.RLock()
+
+
+class StateBatchTest(unittest.TestCase):
+    def test_pending_values_read_like_stored_ones(self):
+        state = BatchedState()
+        with state.state_batch():
+            state.flag = True
+            state.count = 3
+            state.settings = {"a": [1, 2]}
+            self.assertEqual(state.stored, {})
+            self.assertIs(state.flag, True)
+            self.assertEqual(state.count, 3)
+            self.assertEqual(state.settings, {"a": [1, 2]})
+        self.assertIs(state.flag, True)
+        self.assertEqual(state.count, 3)
+        self.assertEqual(state.settings, {"a": [1, 2]})
+
+    def test_deleted_values_read_as_defaults(self):
+        state = BatchedState()
+        state.flag = True
+        with state.state_batch():
+            state.flag = False
+            self.assertIs(state.flag, False)
+        self.assertNotIn("test.flag", state.stored)
+
+
+if __name__ == "__main__":
+    unittest.main()